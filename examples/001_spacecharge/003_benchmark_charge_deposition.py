@@ -0,0 +1,74 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+# Compares the charge deposition strategies of TriLinearInterpolatedFieldMap
+# for different numbers of particles and OpenMP threads
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xfields as xf
+
+###################
+# Choose contexts #
+###################
+
+contexts = [xo.ContextCpu(omp_num_threads=nn) for nn in [0, 1, 2, 4, 8]]
+#contexts = [xo.ContextCupy(default_block_size=256)]
+
+n_macroparticles_list = [int(1e4), int(1e5), int(1e6), int(1e7)]
+nx, ny, nz = 256, 256, 50
+sigma_x = 3e-3
+sigma_y = 2e-3
+sigma_z = 30e-2
+n_repetitions = 5
+
+def time_deposition(fmap, x, y, z, ncharges, context, deposition):
+    kwargs = dict(x_p=x, y_p=y, z_p=z, ncharges_p=ncharges,
+                  q0_coulomb=1.602176634e-19, update_phi=False,
+                  deposition=deposition)
+    fmap.update_from_particles(**kwargs) # warm up (compilation)
+    context.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(n_repetitions):
+        fmap.update_from_particles(**kwargs)
+    context.synchronize()
+    return (time.perf_counter() - t0) / n_repetitions
+
+print(f'{"context":<30} {"n_part":>10} '
+      f'{"atomic":>12} {"private_grids":>14} {"sorted":>12}')
+for context in contexts:
+    if isinstance(context, xo.ContextCpu):
+        label = f'ContextCpu({context.omp_num_threads} threads)'
+    else:
+        label = type(context).__name__
+    fmap = xf.TriLinearInterpolatedFieldMap(
+            _context=context,
+            x_range=(-5*sigma_x, 5*sigma_x),
+            y_range=(-5*sigma_y, 5*sigma_y),
+            z_range=(-5*sigma_z, 5*sigma_z),
+            nx=nx, ny=ny, nz=nz)
+    for n_macroparticles in n_macroparticles_list:
+        x = context.nparray_to_context_array(
+                np.random.normal(0, sigma_x, n_macroparticles))
+        y = context.nparray_to_context_array(
+                np.random.normal(0, sigma_y, n_macroparticles))
+        z = context.nparray_to_context_array(
+                np.random.normal(0, sigma_z, n_macroparticles))
+        ncharges = context.nparray_to_context_array(
+                np.ones(n_macroparticles))
+
+        timings = {}
+        for deposition in ['atomic', 'private_grids', 'sorted']:
+            try:
+                timings[deposition] = f'{1e3*time_deposition(fmap, x, y, z, ncharges, context, deposition):.3f} ms'
+            except NotImplementedError:
+                timings[deposition] = 'n/a'
+
+        print(f'{label:<30} {n_macroparticles:>10} '
+              f'{timings["atomic"]:>12} {timings["private_grids"]:>14} '
+              f'{timings["sorted"]:>12}')
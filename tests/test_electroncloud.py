@@ -3,7 +3,10 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import os
+
 import numpy as np
+import pytest
 from numpy.random import default_rng
 import xobjects as xo
 import xpart as xp
@@ -102,3 +105,338 @@ def test_tricubic_interpolation(test_context):
     assert np.allclose(part.px[mask_p], true_px, atol=1.e-13, rtol=1.e-13)
     assert np.allclose(part.py[mask_p], true_py, atol=1.e-13, rtol=1.e-13)
     assert np.allclose(part.ptau[mask_p], true_ptau, atol=1.e-13, rtol=1.e-13)
+
+
+@for_all_test_contexts
+def test_tricubic_coefficient_cache(test_context):
+    nx, ny, nz = 11, 9, 7
+    x_grid = np.linspace(-0.5, 0.5, nx)
+    y_grid = np.linspace(-0.4, 0.4, ny)
+    z_grid = np.linspace(-0.3, 0.3, nz)
+    rng = default_rng(2345)
+    phi_taylor = rng.normal(size=nx*ny*nz*8)
+
+    n_parts = 1000
+    x_test = rng.random(n_parts) * 0.6 - 0.5
+    y_test = rng.normal(0, 0.05, n_parts)
+    tau_test = rng.random(n_parts) * 0.5 - 0.25
+    p0c = 450e9
+
+    tracked = []
+    for cache_coefficients in [False, True, 40]:
+        fieldmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+                x_grid=x_grid, y_grid=y_grid, z_grid=z_grid, mirror_x=1,
+                cache_coefficients=cache_coefficients)
+        fieldmap._phi_taylor[:] = test_context.nparray_to_context_array(
+                                                                phi_taylor)
+        if cache_coefficients is True:
+            fieldmap.update_coefficient_cache()
+            assert fieldmap.n_cached_cells == (nx - 1) * (ny - 1) * (nz - 1)
+        elif cache_coefficients:
+            with pytest.raises(ValueError):
+                fieldmap.update_coefficient_cache()
+            fieldmap.update_coefficient_cache(x=x_test, y=y_test, z=tau_test)
+            assert fieldmap.n_cached_cells == 40
+            slots = test_context.nparray_from_context_array(
+                                        fieldmap._coefficient_slots)
+            assert np.sum(slots >= 0) == 40
+
+        ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                  _buffer=fieldmap._buffer)
+        part = xp.Particles(_context=test_context, x=x_test, y=y_test,
+                            zeta=tau_test, p0c=p0c)
+        part.zeta *= part.beta0
+        ecloud.track(part)
+        part.move(_context=xo.ContextCpu())
+        tracked.append(part)
+
+    part_ref = tracked[0]
+    assert np.all(part_ref.state > 0)
+    for part in tracked[1:]:
+        for name in ['px', 'py', 'ptau']:
+            xo.assert_allclose(getattr(part, name), getattr(part_ref, name),
+                               rtol=1e-12, atol=1e-14)
+
+
+@for_all_test_contexts
+def test_tricubic_coefficient_cache_after_update(test_context):
+    nx, ny, nz = 11, 9, 7
+    x_grid = np.linspace(-0.5, 0.5, nx)
+    y_grid = np.linspace(-0.4, 0.4, ny)
+    z_grid = np.linspace(-0.3, 0.3, nz)
+    rng = default_rng(2346)
+    phi_taylor = rng.normal(size=(nz, ny, nx, 8))
+
+    n_points = 1000
+    x_test = test_context.nparray_to_context_array(
+                                rng.random(n_points) * 0.8 - 0.4)
+    y_test = test_context.nparray_to_context_array(
+                                rng.random(n_points) * 0.6 - 0.3)
+    z_test = test_context.nparray_to_context_array(
+                                rng.random(n_points) * 0.5 - 0.25)
+
+    fieldmaps = [xf.TriCubicInterpolatedFieldMap(_context=test_context,
+                    x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                    phi_taylor=phi_taylor, cache_coefficients=cache)
+                 for cache in [False, True]]
+
+    p2np = test_context.nparray_from_context_array
+    dphi_dx_before = p2np(fieldmaps[1].get_values_at_points(
+                    x_test, y_test, z_test, return_phi=False,
+                    return_dphi_dy=False, return_dphi_dz=False)[0]).copy()
+
+    # The cached coefficients of the cells touching the slice are discarded
+    new_slice = rng.normal(size=(1, ny, nx, 8))
+    for fieldmap in fieldmaps:
+        fieldmap.update_phi_taylor(new_slice, first_slice=3)
+    slots = p2np(fieldmaps[1]._coefficient_slots).reshape(
+                                                nz - 1, ny - 1, nx - 1)
+    assert np.all(slots[2:4] == -1)
+    assert np.all(slots[:2] >= 0) and np.all(slots[4:] >= 0)
+
+    values = [[p2np(vv) for vv in ff.get_values_at_points(
+                    x_test, y_test, z_test)] for ff in fieldmaps]
+    assert not np.allclose(values[1][1], dphi_dx_before)
+    for vv_cached, vv_ref in zip(values[1], values[0]):
+        xo.assert_allclose(vv_cached, vv_ref, rtol=1e-12, atol=1e-14)
+
+    # Same after the cache is filled again
+    fieldmaps[1].update_coefficient_cache()
+    for vv_cached, vv_ref in zip(fieldmaps[1].get_values_at_points(
+                                        x_test, y_test, z_test), values[0]):
+        xo.assert_allclose(p2np(vv_cached), vv_ref, rtol=1e-12, atol=1e-14)
+
+
+@for_all_test_contexts
+def test_tricubic_get_values_at_points(test_context):
+    from numpy.polynomial import polynomial as P
+
+    rng = default_rng(3456)
+    coefs = rng.normal(size=(4, 4, 4))
+    def der(orders):
+        cc = coefs
+        for axis, order in enumerate(orders):
+            cc = P.polyder(cc, m=order, axis=axis)
+        return cc
+
+    nx, ny, nz = 9, 8, 7
+    x_grid = np.linspace(-0.5, 0.5, nx)
+    y_grid = np.linspace(-0.4, 0.4, ny)
+    z_grid = np.linspace(-0.3, 0.3, nz)
+    dx = x_grid[1] - x_grid[0]
+    dy = y_grid[1] - y_grid[0]
+    dz = z_grid[1] - z_grid[0]
+
+    zz, yy, xx = np.meshgrid(z_grid, y_grid, x_grid, indexing='ij')
+    phi_taylor = np.zeros((nz, ny, nx, 8))
+    for ll, (orders, scale) in enumerate([
+            ((0, 0, 0), 1.), ((1, 0, 0), dx), ((0, 1, 0), dy),
+            ((0, 0, 1), dz), ((1, 1, 0), dx*dy), ((1, 0, 1), dx*dz),
+            ((0, 1, 1), dy*dz), ((1, 1, 1), dx*dy*dz)]):
+        phi_taylor[:, :, :, ll] = P.polyval3d(xx, yy, zz, der(orders)) * scale
+
+    fieldmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid)
+    fieldmap._phi_taylor[:] = test_context.nparray_to_context_array(
+                                                    phi_taylor.flatten())
+
+    n_points = 1000
+    x = rng.random(n_points) * 1.2 - 0.6
+    y = rng.random(n_points) * 1.2 - 0.6
+    z = rng.random(n_points) * 0.8 - 0.4
+    inside = ((np.abs(x) < 0.5) & (np.abs(y) < 0.4) & (np.abs(z) < 0.3))
+
+    x_ctx = test_context.nparray_to_context_array(x)
+    y_ctx = test_context.nparray_to_context_array(y)
+    z_ctx = test_context.nparray_to_context_array(z)
+    values = fieldmap.get_values_at_points(x=x_ctx, y=y_ctx, z=z_ctx)
+    assert len(values) == 4
+    for val, orders in zip(values, [(0, 0, 0), (1, 0, 0), (0, 1, 0),
+                                    (0, 0, 1)]):
+        val = test_context.nparray_from_context_array(val)
+        expected = np.where(inside, P.polyval3d(x, y, z, der(orders)), 0.)
+        xo.assert_allclose(val, expected, rtol=1e-10, atol=1e-10)
+
+    dphi_dy, = fieldmap.get_values_at_points(x=x_ctx, y=y_ctx, z=z_ctx,
+            return_phi=False, return_dphi_dx=False, return_dphi_dz=False)
+    xo.assert_allclose(test_context.nparray_from_context_array(dphi_dy),
+                       test_context.nparray_from_context_array(values[2]),
+                       rtol=0, atol=0)
+
+    with pytest.raises(NotImplementedError):
+        fieldmap.get_values_at_points(x=x_ctx, y=y_ctx, z=z_ctx,
+                                      return_rho=True)
+
+
+@for_all_test_contexts
+def test_tricubic_compressed_storage(test_context):
+    nx, ny, nz = 11, 9, 7
+    x_grid = np.linspace(-0.5, 0.5, nx)
+    y_grid = np.linspace(-0.4, 0.4, ny)
+    z_grid = np.linspace(-0.3, 0.3, nz)
+    rng = default_rng(4567)
+    phi_taylor = rng.normal(size=(nz, ny, nx, 8))
+
+    n_points = 1000
+    x = test_context.nparray_to_context_array(rng.random(n_points) - 0.5)
+    y = test_context.nparray_to_context_array(rng.random(n_points)*0.8 - 0.4)
+    z = test_context.nparray_to_context_array(rng.random(n_points)*0.6 - 0.3)
+
+    values = {}
+    for dtype in ['float64', 'float32', 'int16']:
+        fieldmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+                x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                phi_taylor=phi_taylor[:3], phi_taylor_dtype=dtype)
+        # Set the rest slice by slice
+        for iz in range(3, nz):
+            fieldmap.update_phi_taylor(phi_taylor[iz], first_slice=iz)
+        values[dtype] = np.array([test_context.nparray_from_context_array(vv)
+                    for vv in fieldmap.get_values_at_points(x=x, y=y, z=z)])
+
+        def check_storage_error(fmap):
+            storage_error = fmap.phi_taylor_storage_error()
+            assert len(storage_error) == 8
+            max_error = max(storage_error.values())
+            if dtype == 'float64':
+                assert max_error == 0
+            elif dtype == 'float32':
+                assert 0 < max_error < 1e-7
+            else:
+                assert 0 < max_error <= 0.5 / 32767 * (1 + 1e-12)
+        check_storage_error(fieldmap)
+
+        # Fieldmap built from the xobject
+        fieldmap_xo = xf.TriCubicInterpolatedFieldMap(
+                                            _xobject=fieldmap._xobject)
+        assert max(fieldmap_xo.phi_taylor_storage_error().values()) == 0
+        fieldmap_xo.update_phi_taylor(phi_taylor[0], first_slice=0)
+        check_storage_error(fieldmap_xo)
+
+    ref = values['float64']
+    assert np.all(np.abs(ref).max(axis=1) > 0)
+    for dtype, rtol in [('float32', 1e-6), ('int16', 1e-3)]:
+        xo.assert_allclose(values[dtype], ref, rtol=0,
+                           atol=rtol*np.abs(ref).max())
+
+    with pytest.raises(ValueError):
+        xf.TriCubicInterpolatedFieldMap(_context=test_context,
+                x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                phi_taylor_dtype='float16')
+
+
+@for_all_test_contexts
+def test_electroncloud_fieldmap_npy_cache(test_context, tmp_path):
+    h5py = pytest.importorskip('h5py')
+
+    nx, ny, nz = 7, 6, 9
+    rng = default_rng(5678)
+    h5_name = str(tmp_path / 'ecloud.h5')
+    with h5py.File(h5_name, 'w') as ff:
+        ff['grid/xg'] = np.linspace(-0.01, 0.01, nx)
+        ff['grid/yg'] = np.linspace(-0.01, 0.01, ny)
+        ff['grid/zg'] = np.linspace(-0.2, 0.2, nz)
+        ff['settings/symmetric2D'] = 0
+        for iz in range(nz):
+            ff[f'slices/slice{iz}/phi'] = rng.normal(size=(nx, ny, 8))
+
+    npy_name = str(tmp_path / 'ecloud.npy')
+    fieldmaps = []
+    for npy_cache in [None, npy_name, npy_name]:
+        fieldmaps.append(xf.config_tools.get_electroncloud_fieldmap_from_h5(
+            filename=h5_name, tau_max=0.1, buffer=test_context.new_buffer(),
+            npy_cache=npy_cache))
+    assert np.load(npy_name, mmap_mode='r').shape == (nz, ny, nx, 8)
+
+    phi_taylor_ref = test_context.nparray_from_context_array(
+                                                fieldmaps[0]._phi_taylor)
+    assert np.all(phi_taylor_ref != 0)
+    for fieldmap in fieldmaps[1:]:
+        assert fieldmap.nz == fieldmaps[0].nz
+        xo.assert_allclose(
+            test_context.nparray_from_context_array(fieldmap._phi_taylor),
+            phi_taylor_ref, rtol=0, atol=0)
+
+    # A cache written for another grid is not used, even if more recent
+    h5_name_2 = str(tmp_path / 'ecloud_2.h5')
+    with h5py.File(h5_name, 'r') as ff, h5py.File(h5_name_2, 'w') as ff_2:
+        ff_2['grid/xg'] = np.linspace(-0.02, 0.02, nx)
+        for name in ['grid/yg', 'grid/zg', 'settings/symmetric2D']:
+            ff_2[name] = ff[name][()]
+        for iz in range(nz):
+            ff_2[f'slices/slice{iz}/phi'] = ff[f'slices/slice{iz}/phi'][()]
+    os.utime(npy_name, (os.path.getmtime(h5_name_2) + 10,) * 2)
+    fieldmaps_2 = [xf.config_tools.get_electroncloud_fieldmap_from_h5(
+            filename=h5_name_2, tau_max=0.1, buffer=test_context.new_buffer(),
+            npy_cache=npy_cache) for npy_cache in [None, npy_name]]
+    xo.assert_allclose(
+        test_context.nparray_from_context_array(fieldmaps_2[1]._phi_taylor),
+        test_context.nparray_from_context_array(fieldmaps_2[0]._phi_taylor),
+        rtol=0, atol=0)
+    # No temporary files are left
+    assert sorted(pp.name for pp in tmp_path.iterdir()) == [
+                                'ecloud.h5', 'ecloud.npy', 'ecloud_2.h5']
+
+
+def test_shared_fieldmaps(tmp_path):
+    context = xo.ContextCpu()
+    rng = default_rng(6789)
+    grids = dict(x_grid=np.linspace(-0.5, 0.5, 11),
+                 y_grid=np.linspace(-0.4, 0.4, 9),
+                 z_grid=np.linspace(-0.3, 0.3, 7))
+    buffer = context.new_buffer()
+    fieldmaps = {
+        'mb': xf.TriCubicInterpolatedFieldMap(_buffer=buffer,
+                    phi_taylor=rng.normal(size=11*9*7*8), **grids),
+        'mq': xf.TriCubicInterpolatedFieldMap(_buffer=buffer, mirror_x=1,
+                    phi_taylor=rng.normal(size=11*9*7*8),
+                    phi_taylor_dtype='int16', **grids)}
+
+    filename = str(tmp_path / 'fieldmaps.bin')
+    xf.save_shared_fieldmaps(fieldmaps, filename, extra_capacity=2**20)
+    with open(filename, 'rb') as fid:
+        file_content = fid.read()
+
+    x = rng.random(100) - 0.5
+    y = rng.random(100)*0.8 - 0.4
+    z = rng.random(100)*0.6 - 0.3
+
+    # Two attachments, as from two processes
+    attached = [xf.attach_shared_fieldmaps(filename, _context=context)
+                for _ in range(2)]
+    for shared_fieldmaps in attached:
+        assert set(shared_fieldmaps.keys()) == {'mb', 'mq'}
+        shared_buffer = shared_fieldmaps['mb']._buffer
+        assert isinstance(shared_buffer.buffer, np.memmap)
+        for name, fieldmap in fieldmaps.items():
+            shared = shared_fieldmaps[name]
+            assert shared._buffer is shared_buffer
+            assert not shared.updatable
+            assert max(shared.phi_taylor_storage_error().values()) == 0
+            assert shared.nx == fieldmap.nx
+            xo.assert_allclose(shared.dz, fieldmap.dz, rtol=1e-14, atol=0)
+
+            ecloud = xf.ElectronCloud(length=1, fieldmap=shared,
+                                      _buffer=shared_buffer)
+            ecloud_ref = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                          _buffer=buffer)
+            tracked = []
+            for el in [ecloud, ecloud_ref]:
+                part = xp.Particles(_context=context, x=x, y=y, zeta=z,
+                                    p0c=450e9)
+                el.track(part)
+                tracked.append(part)
+            for nn in ['px', 'py', 'ptau']:
+                xo.assert_allclose(getattr(tracked[0], nn),
+                                   getattr(tracked[1], nn), rtol=0, atol=0)
+        # The elements are in the private part of the buffer
+        assert shared_buffer.capacity == len(file_content)
+
+        # The buffer does not grow into a private copy of the file
+        with pytest.raises(MemoryError):
+            shared_buffer.allocate(2**21)
+        assert isinstance(shared_buffer.buffer, np.memmap)
+        assert shared_buffer.capacity == len(file_content)
+
+    # The file is never modified
+    with open(filename, 'rb') as fid:
+        assert fid.read() == file_content
@@ -0,0 +1,448 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import gc
+import threading
+
+import numpy as np
+import pytest
+
+import xobjects as xo
+from xobjects.test_helpers import for_all_test_contexts
+
+import xfields as xf
+from xfields.solvers.fftsolvers import (FFTSolver2p5D, RFFTSolver3D,
+                                        RFFTSolver2p5D)
+
+
+def _gaussian_rho(nx, ny, nz, dx, dy, dz, sigma=(2e-3, 1e-3, 5e-2)):
+    x = (np.arange(nx) - nx/2) * dx
+    y = (np.arange(ny) - ny/2) * dy
+    z = (np.arange(nz) - nz/2) * dz
+    XX, YY, ZZ = np.meshgrid(x, y, z, indexing='ij')
+    rho = np.exp(-XX**2/(2*sigma[0]**2) - YY**2/(2*sigma[1]**2)
+                 - ZZ**2/(2*sigma[2]**2))
+    return np.asfortranarray(rho)
+
+
+@pytest.mark.parametrize('solver_class', [xf.FFTSolver3D, FFTSolver2p5D])
+@for_all_test_contexts
+def test_fft_solver_shared_workspace(solver_class, test_context):
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    solver_a = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                            context=test_context)
+    solver_b = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                            context=test_context)
+
+    # Solvers on the same grid share the workspace and the fft plan
+    assert solver_a._workspace is solver_b._workspace
+    assert solver_a.fftplan is solver_b.fftplan
+
+    rho_1 = _gaussian_rho(nx, ny, nz, dx, dy, dz)
+    rho_2 = np.roll(rho_1, 5, axis=0)**2
+    rho_1_dev = test_context.nparray_to_context_array(rho_1)
+    rho_2_dev = test_context.nparray_to_context_array(rho_2)
+
+    p2np = test_context.nparray_from_context_array
+    phi_1 = p2np(solver_a.solve(rho_1_dev)).copy()
+    phi_2 = p2np(solver_b.solve(rho_2_dev)).copy()
+    phi_1_again = p2np(solver_a.solve(rho_1_dev)).copy()
+
+    # Padding is cleared between solves
+    xo.assert_allclose(phi_1_again, phi_1, rtol=1e-10, atol=0)
+    assert not np.allclose(phi_2, phi_1)
+
+    # The results are not overwritten by other solvers using the workspace
+    phi_1_dev = solver_a.solve(rho_1_dev)
+    solver_b.solve(rho_2_dev)
+    xo.assert_allclose(p2np(phi_1_dev), phi_1, rtol=1e-10, atol=0)
+
+    # Solvers given their own fft plan do not share the workspace
+    axes = (0,1,2) if solver_class is xf.FFTSolver3D else (0,1)
+    fftplan = test_context.plan_FFT(solver_a._workspace_dev.copy(order='F'),
+                                    axes=axes)
+    solver_c = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                            context=test_context, fftplan=fftplan)
+    assert solver_c._workspace is not solver_a._workspace
+    xo.assert_allclose(p2np(solver_c.solve(rho_1_dev)), phi_1,
+                       rtol=1e-10, atol=0)
+
+
+@pytest.mark.parametrize('solver_classes', [(xf.FFTSolver3D, RFFTSolver3D),
+                                            (FFTSolver2p5D, RFFTSolver2p5D)])
+@for_all_test_contexts
+def test_rfft_solvers(solver_classes, test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('Real-to-complex solvers not available on PyOpenCL')
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    complex_class, real_class = solver_classes
+    solver_complex = complex_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                   context=test_context)
+    solver_real = real_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                             context=test_context)
+
+    # Half spectrum, real valued
+    assert solver_real._gint_rep_transf_dev.dtype == np.float64
+    assert (solver_real._gint_rep_transf_dev.size
+            < 0.6 * solver_complex._gint_rep_transf_dev.size)
+
+    rho = _gaussian_rho(nx, ny, nz, dx, dy, dz)
+    rho_dev = test_context.nparray_to_context_array(rho)
+
+    p2np = test_context.nparray_from_context_array
+    phi_complex = p2np(solver_complex.solve(rho_dev)).copy()
+    phi_real = p2np(solver_real.solve(rho_dev)).copy()
+    phi_real_again = p2np(solver_real.solve(rho_dev)).copy()
+
+    xo.assert_allclose(phi_real, phi_complex,
+                       rtol=0, atol=1e-10*np.max(np.abs(phi_complex)))
+    xo.assert_allclose(phi_real_again, phi_real, rtol=1e-12, atol=0)
+
+    # The potential can be written directly into a provided array
+    phi_dev = test_context.zeros((nx, ny, nz), dtype=np.float64, order='F')
+    solver_real.solve_into(rho_dev, phi_dev)
+    xo.assert_allclose(p2np(phi_dev), phi_real, rtol=1e-12, atol=0)
+
+
+@for_all_test_contexts
+def test_fft_solver_2p5d_skips_empty_slices(test_context):
+
+    nx, ny, nz = 32, 16, 12
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+    empty_slices = [0, 1, 5, 10, 11]
+
+    rho = _gaussian_rho(nx, ny, nz, dx, dy, dz)
+    rho[:, :, empty_slices] = 0
+    rho[:, :, 6] *= 1e-6
+    rho_dev = test_context.nparray_to_context_array(rho)
+
+    solver = FFTSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                           context=test_context)
+    p2np = test_context.nparray_from_context_array
+    phi = p2np(solver.solve(rho_dev)).copy()
+
+    # Reference: each slice solved independently
+    phi_ref = np.zeros_like(phi)
+    solver_slice = FFTSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=1,
+                                 context=test_context)
+    for iz in range(nz):
+        rho_slice = test_context.nparray_to_context_array(
+                                    np.asfortranarray(rho[:, :, iz:iz+1]))
+        phi_ref[:, :, iz] = p2np(solver_slice.solve(rho_slice))[:, :, 0]
+
+    xo.assert_allclose(phi, phi_ref,
+                       rtol=0, atol=1e-12*np.max(np.abs(phi_ref)))
+    assert np.all(phi[:, :, empty_slices] == 0)
+    assert sorted(solver._batch_workspaces.keys()) == [8, nz]
+
+    # The index arrays are uploaded only when the occupied slices change
+    batch_to_slice_dev = solver._batch_to_slice_dev
+    solver.solve(2 * rho_dev)
+    assert solver._batch_to_slice_dev is batch_to_slice_dev
+    rho_shifted_dev = test_context.nparray_to_context_array(
+                                    np.asfortranarray(np.roll(rho, 1, axis=2)))
+    phi_shifted = p2np(solver.solve(rho_shifted_dev)).copy()
+    assert solver._batch_to_slice_dev is not batch_to_slice_dev
+    xo.assert_allclose(phi_shifted, np.roll(phi_ref, 1, axis=2),
+                       rtol=0, atol=1e-12*np.max(np.abs(phi_ref)))
+
+    # Slices with negligible charge are skipped when a threshold is given
+    solver_thr = FFTSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                               context=test_context,
+                               slice_charge_threshold=1e-3)
+    phi_thr = p2np(solver_thr.solve(rho_dev)).copy()
+    assert np.all(phi_thr[:, :, 6] == 0)
+    mask = np.ones(nz, dtype=bool)
+    mask[6] = False
+    xo.assert_allclose(phi_thr[:, :, mask], phi_ref[:, :, mask],
+                       rtol=0, atol=1e-12*np.max(np.abs(phi_ref)))
+
+    # No charge at all
+    phi_zero = p2np(solver.solve(test_context.zeros((nx, ny, nz),
+                                    dtype=np.float64, order='F')))
+    assert np.all(phi_zero == 0)
+
+
+@pytest.mark.parametrize('solver', ['FFTSolver3D', 'FFTSolver2p5D',
+                                    'FFTSolver2p5DAveraged', 'RFFTSolver3D',
+                                    'RFFTSolver2p5D'])
+@for_all_test_contexts
+def test_fft_solvers_single_precision(solver, test_context):
+
+    if (isinstance(test_context, xo.ContextPyopencl)
+            and solver.startswith('RFFT')):
+        pytest.skip('Real-to-complex solvers not available on PyOpenCL')
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    rho = _gaussian_rho(nx, ny, nz, dx, dy, dz)
+
+    fmaps = {}
+    for dtype in [np.float64, np.float32]:
+        fmaps[dtype] = xf.TriLinearInterpolatedFieldMap(
+                _context=test_context, rho=rho,
+                x_range=(0, (nx-1)*dx), y_range=(0, (ny-1)*dy),
+                z_range=(0, (nz-1)*dz), nx=nx, ny=ny, nz=nz,
+                solver=solver, solver_dtype=dtype)
+    assert fmaps[np.float32].solver.dtype == np.float32
+
+    p2np = test_context.nparray_from_context_array
+    phi_32 = p2np(fmaps[np.float32].solver.solve(fmaps[np.float32].rho))
+    assert phi_32.dtype == np.float32
+
+    for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+        val_64 = p2np(getattr(fmaps[np.float64], nn))
+        val_32 = p2np(getattr(fmaps[np.float32], nn))
+        xo.assert_allclose(val_32, val_64,
+                           rtol=0, atol=1e-4*np.max(np.abs(val_64)))
+
+
+@for_all_test_contexts
+def test_green_function_cache(test_context, tmp_path):
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    cache = xf.solvers.green_function_cache
+    cache.clear()
+    cache_dir_before = cache.cache_dir
+    cache.cache_dir = tmp_path
+    try:
+        solver_a = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                  context=test_context)
+        solver_b = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                  context=test_context)
+        # Same grid, same Green function
+        assert solver_a._gint_rep_transf_dev is solver_b._gint_rep_transf_dev
+        assert len(list(tmp_path.glob('*.npy'))) == 1
+
+        # Different cell size, different Green function
+        solver_c = xf.FFTSolver3D(dx=dx, dy=dy, dz=2*dz, nx=nx, ny=ny, nz=nz,
+                                  context=test_context)
+        assert (solver_c._gint_rep_transf_dev
+                is not solver_a._gint_rep_transf_dev)
+        assert len(list(tmp_path.glob('*.npy'))) == 2
+
+        # Green function loaded from disk
+        cache.clear()
+        solver_d = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                  context=test_context)
+        assert (solver_d._gint_rep_transf_dev
+                is not solver_a._gint_rep_transf_dev)
+        p2np = test_context.nparray_from_context_array
+        xo.assert_allclose(p2np(solver_d._gint_rep_transf_dev),
+                           p2np(solver_a._gint_rep_transf_dev),
+                           rtol=0, atol=0)
+    finally:
+        cache.cache_dir = cache_dir_before
+        cache.clear()
+
+
+@for_all_test_contexts
+def test_green_function_cache_is_bounded(test_context):
+
+    nx, ny, nz = 16, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    cache = xf.solvers.green_function_cache
+    cache.clear()
+
+    # Grid rescaled at every step, as with adaptive grids
+    solver = None
+    for ii in range(20):
+        solver = xf.FFTSolver3D(dx=dx*(1 + 0.01*ii), dy=dy, dz=dz,
+                                nx=nx, ny=ny, nz=nz, context=test_context)
+        gc.collect()
+        # Only the Green function of the live solver is kept
+        assert len(cache._arrays) == 1
+
+    del solver
+    gc.collect()
+    assert len(cache._arrays) == 0
+
+
+def test_integrated_green_function_chunks(monkeypatch):
+
+    from xfields.solvers import fftsolvers
+
+    nx, ny, nz = 12, 10, 7
+    dx, dy, dz = 1e-3, 2e-3, 2e-2
+
+    gint_one_chunk = fftsolvers._integrated_green_function_3d(
+                                            dx, dy, dz, nx, ny, nz)
+    monkeypatch.setattr(fftsolvers, '_green_function_chunk_size', 300)
+    gint_chunked = fftsolvers._integrated_green_function_3d(
+                                            dx, dy, dz, nx, ny, nz)
+
+    assert np.all(gint_chunked == gint_one_chunk)
+
+    # Replicas (even function on the doubled grid)
+    ii = (-np.arange(2*nx)) % (2*nx)
+    jj = (-np.arange(2*ny)) % (2*ny)
+    kk = (-np.arange(2*nz)) % (2*nz)
+    assert np.all(gint_chunked[ii, :, :] == gint_chunked)
+    assert np.all(gint_chunked[:, jj, :] == gint_chunked)
+    assert np.all(gint_chunked[:, :, kk] == gint_chunked)
+
+
+@for_all_test_contexts
+def test_dst_solvers(test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('DST solvers not available on PyOpenCL')
+
+    from scipy.constants import epsilon_0
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 2e-3, 2e-2
+
+    rho = _gaussian_rho(nx, ny, nz, dx, dy, dz)
+    rho_dev = test_context.nparray_to_context_array(rho)
+
+    solver_2d = xf.solvers.DSTSolver2D(dx=dx, dy=dy, nx=nx, ny=ny,
+                                       context=test_context)
+    fmap = xf.TriLinearInterpolatedFieldMap(
+            _context=test_context, rho=rho,
+            x_range=(0, (nx-1)*dx), y_range=(0, (ny-1)*dy),
+            z_range=(0, (nz-1)*dz), nx=nx, ny=ny, nz=nz,
+            solver='DSTSolver2p5D')
+    assert isinstance(fmap.solver, xf.solvers.DSTSolver2p5D)
+
+    p2np = test_context.nparray_from_context_array
+    phi = p2np(fmap.phi)
+
+    # Batched solve is equivalent to solving each slice
+    for iz in range(nz):
+        rho_slice = test_context.nparray_to_context_array(
+                                    np.asfortranarray(rho[:, :, iz]))
+        phi_slice = p2np(solver_2d.solve(rho_slice))
+        xo.assert_allclose(phi[:, :, iz], phi_slice,
+                           rtol=0, atol=1e-12*np.max(np.abs(phi)))
+
+    # Discrete Poisson equation with zero potential on the pipe
+    phi_ext = np.zeros((nx+2, ny+2, nz))
+    phi_ext[1:-1, 1:-1, :] = phi
+    lapl = ((phi_ext[2:, 1:-1] - 2*phi + phi_ext[:-2, 1:-1]) / dx**2
+          + (phi_ext[1:-1, 2:] - 2*phi + phi_ext[1:-1, :-2]) / dy**2)
+    xo.assert_allclose(-epsilon_0 * lapl, rho,
+                       rtol=0, atol=1e-10*np.max(rho))
+
+
+@for_all_test_contexts
+def test_fft_solver_2d(test_context):
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    rho = _gaussian_rho(nx, ny, nz, dx, dy, dz)
+    rho_dev = test_context.nparray_to_context_array(rho)
+
+    solver_2d = xf.solvers.FFTSolver2D(dx=dx, dy=dy, nx=nx, ny=ny,
+                                       context=test_context)
+    solver_2p5d = FFTSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                context=test_context)
+
+    p2np = test_context.nparray_from_context_array
+    phi_2p5d = p2np(solver_2p5d.solve(rho_dev)).copy()
+
+    # Stack of maps solved in one call
+    phi_stack = p2np(solver_2d.solve(rho_dev)).copy()
+    assert phi_stack.shape == (nx, ny, nz)
+    xo.assert_allclose(phi_stack, phi_2p5d,
+                       rtol=0, atol=1e-12*np.max(np.abs(phi_2p5d)))
+
+    # Single map
+    for iz in [0, nz//2]:
+        rho_slice = test_context.nparray_to_context_array(
+                                    np.asfortranarray(rho[:, :, iz]))
+        phi_slice = p2np(solver_2d.solve(rho_slice)).copy()
+        assert phi_slice.shape == (nx, ny)
+        xo.assert_allclose(phi_slice, phi_2p5d[:, :, iz],
+                           rtol=0, atol=1e-12*np.max(np.abs(phi_2p5d)))
+
+
+@for_all_test_contexts
+def test_solve_async(test_context):
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    rho_1 = _gaussian_rho(nx, ny, nz, dx, dy, dz)
+    rho_2 = np.roll(rho_1, 5, axis=0)**2
+
+    fmaps = [xf.TriLinearInterpolatedFieldMap(
+                _context=test_context, rho=rr,
+                x_range=(0, (nx-1)*dx), y_range=(0, (ny-1)*dy),
+                z_range=(0, (nz-1)*dz), nx=nx, ny=ny, nz=nz,
+                solver='FFTSolver2p5D') for rr in [rho_1, rho_2]]
+    # Same grid, shared workspace
+    assert fmaps[0].solver._workspace is fmaps[1].solver._workspace
+
+    p2np = test_context.nparray_from_context_array
+    phi_sync = [p2np(ff.phi).copy() for ff in fmaps]
+    dphi_dx_sync = [p2np(ff.dphi_dx).copy() for ff in fmaps]
+
+    # Solver
+    futures = [fmaps[0].solver.solve_async(ff.rho) for ff in fmaps]
+    for ff, pp in zip(futures, phi_sync):
+        assert ff.result().flags.f_contiguous
+        xo.assert_allclose(p2np(ff.result()), pp, rtol=1e-12, atol=0)
+
+    # Fieldmap
+    for ff in fmaps:
+        ff.phi[:, :, :] = 0
+        ff.dphi_dx[:, :, :] = 0
+    futures = [ff.update_phi_from_rho_async() for ff in fmaps]
+    for ff in futures:
+        assert ff.result() is None
+    for ff, pp, dd in zip(fmaps, phi_sync, dphi_dx_sync):
+        xo.assert_allclose(p2np(ff.phi), pp, rtol=1e-12, atol=0)
+        xo.assert_allclose(p2np(ff.dphi_dx), dd, rtol=1e-12, atol=0)
+
+
+@for_all_test_contexts
+def test_sync_solve_waits_for_async_solves(test_context):
+
+    from xfields.solvers.base import _get_context_lock
+
+    nx, ny, nz = 32, 16, 8
+    dx, dy, dz = 1e-3, 1e-3, 2e-2
+
+    solver = xf.FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                            context=test_context)
+    rho_dev = test_context.nparray_to_context_array(
+                                    _gaussian_rho(nx, ny, nz, dx, dy, dz))
+
+    # The lock of the context is held while a solve uses the workspace
+    started = threading.Event()
+    release = threading.Event()
+    def hold_lock():
+        with _get_context_lock(test_context).lock:
+            started.set()
+            release.wait()
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    started.wait()
+
+    done = threading.Event()
+    def sync_solve():
+        solver.solve(rho_dev)
+        done.set()
+    solver_thread = threading.Thread(target=sync_solve)
+    solver_thread.start()
+    assert not done.wait(0.2)
+
+    release.set()
+    thread.join()
+    solver_thread.join()
+    assert done.is_set()
@@ -0,0 +1,780 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+import pytest
+from scipy.constants import e as qe
+
+import xobjects as xo
+import xtrack as xt
+from xobjects.test_helpers import for_all_test_contexts
+
+import xfields as xf
+
+
+@for_all_test_contexts
+def test_adaptive_grid(test_context):
+
+    nx, ny, nz = 32, 32, 16
+
+    fmap = xf.TriLinearInterpolatedFieldMap(
+            _context=test_context,
+            x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+            z_range=(-0.3, 0.3), nx=nx, ny=ny, nz=nz,
+            solver='FFTSolver2p5D', adaptive_grid='xy')
+
+    dz_before = fmap.dz
+    z_grid_before = fmap.z_grid.copy()
+
+    rng = np.random.default_rng(1)
+    n_part = 100000
+    beams = {}
+    for sigma_x in [1e-3, 0.3e-3]:
+        beams[sigma_x] = xt.Particles(_context=test_context, p0c=7e12,
+                    x=rng.normal(1e-4, sigma_x, n_part),
+                    y=rng.normal(0, 0.5e-3, n_part),
+                    zeta=rng.normal(0, 5e-2, n_part))
+        # Lost particles are ignored
+        beams[sigma_x].x[:10] = 1.
+        beams[sigma_x].state[:10] = 0
+
+    solvers = {}
+    for sigma_x in [1e-3, 0.3e-3, 1e-3]:
+        particles = beams[sigma_x]
+        fmap.update_from_particles(particles=particles)
+
+        x = test_context.nparray_from_context_array(particles.x)[10:]
+        y = test_context.nparray_from_context_array(particles.y)[10:]
+        for vv, grid in [(x, fmap.x_grid), (y, fmap.y_grid)]:
+            coverage = (vv.max() - vv.min()) / (grid[-1] - grid[0])
+            # Within one step of the cell size sequence
+            assert 0.8 * 2**(-1/8) < coverage < 0.8 * 2**(1/8)
+            xo.assert_allclose(0.5 * (grid[0] + grid[-1]),
+                               0.5 * (vv.min() + vv.max()),
+                               rtol=0, atol=1e-12)
+
+        # Struct used by the C code is consistent with the grid
+        xo.assert_allclose(fmap._x_min, fmap.x_grid[0], rtol=0, atol=1e-15)
+        xo.assert_allclose(fmap._dx, fmap.dx, rtol=1e-12, atol=0)
+        xo.assert_allclose(fmap.solver.dx, fmap.dx, rtol=1e-12, atol=0)
+
+        # All charge deposited
+        total_charge = (test_context.nparray_from_context_array(fmap.rho).sum()
+                        * fmap.dx * fmap.dy * fmap.dz)
+        xo.assert_allclose(total_charge,
+                           (n_part - 10) * particles.q0 * qe,
+                           rtol=1e-3, atol=0)
+
+        solvers.setdefault(fmap._grid_steps, fmap.solver)
+        assert fmap.solver is solvers[fmap._grid_steps]
+
+    # Solvers are reused when the beam size comes back (the initial one is
+    # also kept)
+    assert len(solvers) == 2
+    assert len(fmap._adaptive_solvers) <= 3
+    # Longitudinal grid is fixed
+    assert fmap.dz == dz_before
+    assert np.all(fmap.z_grid == z_grid_before)
+
+    # Only the most recently used solvers are kept
+    fmap.max_adaptive_solvers = 2
+    grid_steps_last = fmap._grid_steps
+    fmap.update_from_particles(particles=xt.Particles(_context=test_context,
+                    p0c=7e12, x=rng.normal(0, 0.6e-3, n_part),
+                    y=rng.normal(0, 0.5e-3, n_part),
+                    zeta=rng.normal(0, 5e-2, n_part)))
+    assert fmap._grid_steps not in solvers
+    assert list(fmap._adaptive_solvers.keys()) == [grid_steps_last,
+                                                   fmap._grid_steps]
+
+
+@for_all_test_contexts
+def test_deposition_strategies(test_context):
+
+    rng = np.random.default_rng(2)
+    n_part = 50000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                x=rng.normal(0, 1e-3, n_part),
+                y=rng.normal(0, 0.5e-3, n_part),
+                zeta=rng.normal(0, 5e-2, n_part),
+                weight=rng.uniform(0.5, 1.5, n_part))
+    # Lost particles and particles outside the grid are ignored
+    particles.state[:10] = 0
+    particles.x[10:20] = 1.
+
+    fmap = xf.TriLinearInterpolatedFieldMap(
+            _context=test_context,
+            x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+            z_range=(-0.3, 0.3), nx=32, ny=32, nz=16)
+
+    fmap.update_from_particles(particles=particles, update_phi=False)
+    rho_atomic = test_context.nparray_from_context_array(fmap.rho).copy()
+    assert rho_atomic.sum() > 0
+
+    strategies = ['sorted']
+    if isinstance(test_context, xo.ContextCpu):
+        strategies.append('private_grids')
+    if isinstance(test_context, xo.ContextPyopencl):
+        strategies = []
+
+    for deposition in strategies:
+        fmap.update_from_particles(particles=particles, update_phi=False,
+                                   deposition=deposition)
+        rho = test_context.nparray_from_context_array(fmap.rho)
+        xo.assert_allclose(rho, rho_atomic, rtol=1e-12,
+                           atol=1e-12*np.abs(rho_atomic).max())
+
+        # Arrays interface, adding to the stored charge density
+        fmap.update_from_particles(x_p=particles.x, y_p=particles.y,
+                                   z_p=particles.zeta,
+                                   ncharges_p=particles.weight,
+                                   state_p=particles.state,
+                                   q0_coulomb=qe,
+                                   reset=False, update_phi=False,
+                                   deposition=deposition)
+        rho = test_context.nparray_from_context_array(fmap.rho)
+        xo.assert_allclose(rho, 2*rho_atomic, rtol=1e-12,
+                           atol=1e-12*np.abs(rho_atomic).max())
+
+
+def test_private_grids_count(monkeypatch):
+
+    from xfields.fieldmaps import interpolated
+
+    context = xo.ContextCpu(omp_num_threads=4)
+    nx, ny, nz = 16, 16, 8
+    nelem = nx * ny * nz
+    fmap = xf.TriLinearInterpolatedFieldMap(
+            _context=context,
+            x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+            z_range=(-0.3, 0.3), nx=nx, ny=ny, nz=nz)
+
+    # One copy per thread only with enough particles per copy
+    assert fmap._n_private_grids(100 * nelem) == 4
+    assert fmap._n_private_grids(2 * nelem) == 2
+    assert fmap._n_private_grids(nelem // 2) == 1
+    # Memory budget
+    monkeypatch.setattr(interpolated, '_private_grids_max_bytes',
+                        3 * 8 * nelem)
+    assert fmap._n_private_grids(100 * nelem) == 3
+
+    # Same result with several copies and with the atomic fallback
+    rng = np.random.default_rng(5)
+    for n_part in [3 * nelem, nelem // 2]:
+        x, y, z = [rng.normal(0, ss, n_part) for ss in (1e-3, 0.5e-3, 5e-2)]
+        kwargs = dict(x_p=x, y_p=y, z_p=z, ncharges_p=np.ones(n_part),
+                      q0_coulomb=1e-19, update_phi=False)
+        fmap.update_from_particles(**kwargs)
+        rho_atomic = fmap.rho.copy()
+        fmap.update_from_particles(deposition='private_grids', **kwargs)
+        xo.assert_allclose(fmap.rho, rho_atomic, rtol=1e-12,
+                           atol=1e-12*np.abs(rho_atomic).max())
+
+
+@for_all_test_contexts
+def test_deposition_without_state(test_context):
+
+    rng = np.random.default_rng(4)
+    n_part = 20000
+    x, y, z = [test_context.nparray_to_context_array(
+                    rng.normal(0, ss, n_part)) for ss in (1e-3, 0.5e-3, 5e-2)]
+    ncharges = test_context.nparray_to_context_array(
+                    rng.uniform(0.5, 1.5, n_part))
+    all_alive = test_context.nparray_to_context_array(
+                    np.ones(n_part, dtype=np.int64))
+
+    strategies = ['atomic', 'sorted']
+    if isinstance(test_context, xo.ContextCpu):
+        strategies.append('private_grids')
+    if isinstance(test_context, xo.ContextPyopencl):
+        strategies = ['atomic']
+
+    p2np = test_context.nparray_from_context_array
+    for particle_shape in ['cic', 'tsc']:
+        fmap = xf.TriLinearInterpolatedFieldMap(
+                _context=test_context,
+                x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=32, ny=32, nz=16,
+                particle_shape=particle_shape)
+        for deposition in strategies:
+            if particle_shape != 'cic' and deposition != 'atomic':
+                continue
+            kwargs = dict(x_p=x, y_p=y, z_p=z, ncharges_p=ncharges,
+                          q0_coulomb=2e-19, update_phi=False,
+                          deposition=deposition)
+            fmap.update_from_particles(state_p=all_alive, **kwargs)
+            rho_ref = p2np(fmap.rho).copy()
+            assert rho_ref.sum() > 0
+            # No state: all particles are deposited
+            fmap.update_from_particles(**kwargs)
+            xo.assert_allclose(p2np(fmap.rho), rho_ref, rtol=1e-12,
+                               atol=1e-12*np.abs(rho_ref).max())
+
+
+@for_all_test_contexts
+def test_update_without_rho_storage(test_context):
+
+    rng = np.random.default_rng(3)
+    n_part = 50000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                x=rng.normal(0, 1e-3, n_part),
+                y=rng.normal(0, 0.5e-3, n_part),
+                zeta=rng.normal(0, 5e-2, n_part))
+
+    fmaps = {}
+    for solver in ['FFTSolver2p5D', 'FFTSolver3D']:
+        for store_rho in [True, False]:
+            fmap = xf.TriLinearInterpolatedFieldMap(
+                    _context=test_context,
+                    x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                    z_range=(-0.3, 0.3), nx=32, ny=24, nz=16,
+                    solver=solver, store_rho=store_rho)
+            assert fmap.store_rho == store_rho
+            fmap.update_from_particles(particles=particles)
+            fmaps[store_rho] = fmap
+
+        p2np = test_context.nparray_from_context_array
+        phi = p2np(fmaps[True].phi)
+        for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+            xo.assert_allclose(p2np(getattr(fmaps[False], nn)),
+                               p2np(getattr(fmaps[True], nn)),
+                               rtol=0, atol=1e-13*np.abs(phi).max()
+                                   / min(fmap.dx, fmap.dy, fmap.dz))
+
+        # Gradient computed in a single kernel
+        for nn, axis, dd in [('dphi_dx', 0, fmap.dx), ('dphi_dy', 1, fmap.dy),
+                             ('dphi_dz', 2, fmap.dz)]:
+            dphi = np.zeros_like(phi)
+            sl = [slice(None)] * 3
+            sl_p, sl_m = list(sl), list(sl)
+            sl[axis] = slice(1, -1)
+            sl_p[axis] = slice(2, None)
+            sl_m[axis] = slice(None, -2)
+            dphi[tuple(sl)] = (phi[tuple(sl_p)] - phi[tuple(sl_m)]) / (2*dd)
+            xo.assert_allclose(p2np(getattr(fmaps[True], nn)), dphi,
+                               rtol=1e-12, atol=1e-12*np.abs(dphi).max())
+
+    with pytest.raises(ValueError):
+        fmaps[False].rho
+    with pytest.raises(AssertionError):
+        fmaps[False].update_phi_from_rho()
+
+
+@for_all_test_contexts
+def test_transverse_only_fieldmap(test_context):
+
+    rng = np.random.default_rng(4)
+    n_part = 20000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                x=rng.normal(0, 1e-3, n_part),
+                y=rng.normal(0, 0.5e-3, n_part),
+                zeta=rng.normal(0, 5e-2, n_part))
+
+    sc = {}
+    for store_dphi_dz in [True, False]:
+        sc[store_dphi_dz] = xf.SpaceCharge3D(
+                _context=test_context, length=1., update_on_track=True,
+                apply_z_kick=False, store_dphi_dz=store_dphi_dz,
+                x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=32, ny=24, nz=16,
+                solver='FFTSolver2p5D')
+    # Driven by apply_z_kick by default
+    assert not xf.SpaceCharge3D(
+                _context=test_context, length=1., apply_z_kick=False,
+                x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=8, ny=8, nz=4,
+                solver='FFTSolver2p5D').fieldmap.store_dphi_dz
+
+    fmap = sc[False].fieldmap
+    assert not fmap.store_dphi_dz
+    assert fmap._dphi_dz.size == 0
+    with pytest.raises(ValueError):
+        fmap.dphi_dz
+
+    p2np = test_context.nparray_from_context_array
+    # The order of the atomic additions in the deposition is not
+    # deterministic with several threads, the results agree to rounding
+    tracked = {}
+    for store_dphi_dz in [True, False]:
+        part = particles.copy()
+        sc[store_dphi_dz].track(part)
+        tracked[store_dphi_dz] = part
+        for nn in ['phi', 'dphi_dx', 'dphi_dy']:
+            ref = p2np(getattr(sc[True].fieldmap, nn))
+            xo.assert_allclose(p2np(getattr(sc[store_dphi_dz].fieldmap, nn)),
+                               ref, rtol=0, atol=1e-12*np.abs(ref).max())
+    for nn in ['px', 'py', 'delta']:
+        ref = p2np(getattr(tracked[True], nn))
+        xo.assert_allclose(p2np(getattr(tracked[False], nn)),
+                           ref, rtol=0, atol=1e-12*np.abs(ref).max())
+
+    # z kick cannot be enabled without dphi_dz
+    sc[False].apply_z_kick = True
+    with pytest.raises(ValueError):
+        sc[False].track(particles.copy())
+
+
+@for_all_test_contexts
+def test_particle_shapes(test_context):
+
+    rng = np.random.default_rng(5)
+    n_part = 100000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                x=rng.normal(0, 1e-3, n_part),
+                y=rng.normal(0, 0.8e-3, n_part),
+                zeta=rng.normal(0, 5e-2, n_part))
+
+    p2np = test_context.nparray_from_context_array
+    kicks = {}
+    for particle_shape in ['cic', 'tsc', 'cubic']:
+        fmap = xf.TriLinearInterpolatedFieldMap(
+                _context=test_context,
+                x_range=(-6e-3, 6e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=48, ny=40, nz=24,
+                particle_shape=particle_shape)
+        assert fmap.particle_shape == particle_shape
+
+        # Charge is conserved
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        total_charge = p2np(fmap.rho).sum() * fmap.dx * fmap.dy * fmap.dz
+        xo.assert_allclose(total_charge,
+                           n_part * particles.q0 * qe,
+                           rtol=1e-10, atol=0)
+
+        # Linear maps are reproduced exactly
+        XX, YY, ZZ = np.meshgrid(fmap.x_grid, fmap.y_grid, fmap.z_grid,
+                                 indexing='ij')
+        fmap.update_phi(
+            test_context.nparray_to_context_array(
+                np.asfortranarray(3*XX - 2*YY + 0.5*ZZ + 1)), force=True)
+        x_test = rng.uniform(-4e-3, 4e-3, 100)
+        y_test = rng.uniform(-3e-3, 3e-3, 100)
+        z_test = rng.uniform(-0.2, 0.2, 100)
+        phi_test, dphi_dx_test = fmap.get_values_at_points(
+                *[test_context.nparray_to_context_array(vv)
+                  for vv in (x_test, y_test, z_test)],
+                return_rho=False, return_dphi_dy=False, return_dphi_dz=False)
+        xo.assert_allclose(p2np(phi_test),
+                           3*x_test - 2*y_test + 0.5*z_test + 1,
+                           rtol=1e-12, atol=1e-12)
+        xo.assert_allclose(p2np(dphi_dx_test), 3., rtol=1e-10, atol=0)
+
+        sc = xf.SpaceCharge3D(_context=test_context, length=1.,
+                x_range=(-6e-3, 6e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=48, ny=40, nz=24,
+                solver='FFTSolver2p5D', particle_shape=particle_shape)
+        part = particles.copy()
+        sc.track(part)
+        kicks[particle_shape] = p2np(part.px)
+
+    # Smoother shapes give similar kicks on a well resolved beam (the
+    # additional smoothing slightly reduces the peak kicks)
+    for particle_shape in ['tsc', 'cubic']:
+        xo.assert_allclose(kicks[particle_shape], kicks['cic'],
+                           rtol=0, atol=0.1*np.abs(kicks['cic']).max())
+
+    with pytest.raises(ValueError):
+        xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                x_range=(-1, 1), y_range=(-1, 1), z_range=(-1, 1),
+                nx=4, ny=4, nz=4, particle_shape='ngp')
+
+
+@for_all_test_contexts
+def test_sort_particles(test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('Sorting not available on PyOpenCL')
+
+    rng = np.random.default_rng(6)
+    n_part = 20000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                x=rng.normal(0, 1e-3, n_part),
+                y=rng.normal(0, 0.8e-3, n_part),
+                zeta=rng.normal(0, 5e-2, n_part))
+    particles.x[:100] = 1. # outside the grid
+    particles.state[100:200] = 0 # lost
+
+    sc = xf.SpaceCharge3D(_context=test_context, length=1.,
+            x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+            z_range=(-0.3, 0.3), nx=32, ny=32, nz=16,
+            solver='FFTSolver2p5D', sort_particles_every=2)
+    fmap = sc.fieldmap
+
+    p2np = test_context.nparray_from_context_array
+    part_ref = particles.copy()
+    sc.track(particles) # sorted at the first update
+    part_ref_kicked = part_ref.copy()
+    xf.SpaceCharge3D(_context=test_context, length=1.,
+            x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+            z_range=(-0.3, 0.3), nx=32, ny=32, nz=16,
+            solver='FFTSolver2p5D').track(part_ref_kicked)
+
+    # Same particles and same kicks, in a different order
+    pid = p2np(particles.particle_id)
+    state = p2np(particles.state)
+    n_active = n_part - 100
+    assert np.all(state[:n_active] > 0)
+    assert np.all(state[n_active:n_part] == 0)
+    assert np.all(np.sort(pid[:n_part]) == np.arange(n_part))
+    pid_ref = p2np(part_ref_kicked.particle_id)
+    for nn in ['x', 'y', 'zeta', 'px', 'py', 'delta']:
+        vv = p2np(getattr(particles, nn))[:n_part]
+        vv_ref = p2np(getattr(part_ref_kicked, nn))[:n_part]
+        xo.assert_allclose(vv[np.argsort(pid)], vv_ref[np.argsort(pid_ref)],
+                           rtol=1e-12, atol=1e-20)
+
+    # Cell index is non decreasing, particles outside the grid at the end
+    x = p2np(particles.x)[:n_active]
+    y = p2np(particles.y)[:n_active]
+    z = p2np(particles.zeta)[:n_active]
+    ix = np.floor((x - fmap.x_grid[0]) / fmap.dx).astype(int)
+    iy = np.floor((y - fmap.y_grid[0]) / fmap.dy).astype(int)
+    iz = np.floor((z - fmap.z_grid[0]) / fmap.dz).astype(int)
+    inside = ((ix >= 0) & (ix < fmap.nx - 1) & (iy >= 0) & (iy < fmap.ny - 1)
+              & (iz >= 0) & (iz < fmap.nz - 1))
+    assert np.all(inside[:inside.sum()])
+    cell = (ix + iy*fmap.nx + iz*fmap.nx*fmap.ny)[inside]
+    assert np.all(np.diff(cell) >= 0)
+
+    # Sorted only every two updates
+    assert fmap._n_updates_since_sort == 1
+    sc.track(particles)
+    assert fmap._n_updates_since_sort == 2
+    sc.track(particles) # sorted
+    assert fmap._n_updates_since_sort == 1
+
+
+@for_all_test_contexts
+def test_gather_at_points(test_context):
+
+    fmap = xf.TriLinearInterpolatedFieldMap(
+            _context=test_context,
+            x_range=(-1., 1.), y_range=(-2., 2.), z_range=(-3., 3.),
+            nx=21, ny=41, nz=31, store_dphi_dz=False)
+
+    XX, YY, ZZ = np.meshgrid(fmap.x_grid, fmap.y_grid, fmap.z_grid,
+                             indexing='ij')
+    fmap.update_phi(
+        test_context.nparray_to_context_array(
+            np.asfortranarray(2*XX - YY + 4*ZZ)), force=True)
+
+    rng = np.random.default_rng(3)
+    n_points = 1000
+    x, y, z = [test_context.nparray_to_context_array(
+                    rng.uniform(-0.8*ll, 0.8*ll, n_points))
+               for ll in (1., 2., 3.)]
+
+    p2np = test_context.nparray_from_context_array
+    out = test_context.zeros(shape=(3, n_points), dtype=np.float64)
+    res = fmap.gather_at_points(x, y, z,
+                quantities=('phi', 'dphi_dx', 'dphi_dy'), out=out)
+    assert res is out
+    xo.assert_allclose(p2np(out[0, :]),
+                       2*p2np(x) - p2np(y) + 4*p2np(z),
+                       rtol=1e-12, atol=1e-12)
+    xo.assert_allclose(p2np(out[1, :]), 2., rtol=1e-10, atol=0)
+    xo.assert_allclose(p2np(out[2, :]), -1., rtol=1e-10, atol=0)
+
+    # Same result as get_values_at_points
+    phi, dphi_dy = fmap.get_values_at_points(x, y, z, return_rho=False,
+            return_dphi_dx=False, return_dphi_dz=False)
+    xo.assert_allclose(p2np(phi), p2np(out[0, :]), rtol=0, atol=0)
+    xo.assert_allclose(p2np(dphi_dy), p2np(out[2, :]), rtol=0, atol=0)
+
+    # Offsets are computed once for each set of quantities
+    assert len(fmap._gather_offsets_cache) == 2
+
+    # The offsets follow the fieldmap when it is copied or moved (at another
+    # offset than in the original buffer)
+    buffer = test_context.new_buffer()
+    buffer.allocate(4096)
+    fmap_copy = fmap.copy(_buffer=buffer)
+    fmap.move(_buffer=buffer)
+    for ff in [fmap, fmap_copy]:
+        res = ff.gather_at_points(x, y, z,
+                    quantities=('phi', 'dphi_dx', 'dphi_dy'))
+        xo.assert_allclose(p2np(res), p2np(out), rtol=0, atol=0)
+
+    with pytest.raises(ValueError):
+        fmap.gather_at_points(x, y, z, quantities=('dphi_dz',))
+    with pytest.raises(ValueError):
+        fmap.get_values_at_points(x, y, z, return_dphi_dz=True)
+
+    # By default only the stored maps are returned
+    rho, phi, dphi_dx, dphi_dy = fmap.get_values_at_points(x, y, z)
+    xo.assert_allclose(p2np(phi), p2np(out[0, :]), rtol=0, atol=0)
+    with pytest.raises(ValueError):
+        fmap.gather_at_points(x, y, z, quantities=('ex',))
+
+
+@for_all_test_contexts
+def test_nested_fieldmap(test_context):
+
+    # Gaussian core with a uniform halo
+    rng = np.random.default_rng(11)
+    n_core = 100000
+    n_halo = 10000
+    x = np.concatenate([rng.normal(0, 3e-4, n_core),
+                        rng.uniform(-5e-3, 5e-3, n_halo)])
+    y = np.concatenate([rng.normal(0, 3e-4, n_core),
+                        rng.uniform(-5e-3, 5e-3, n_halo)])
+    z = rng.normal(0, 5e-2, n_core + n_halo)
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                             x=x, y=y, zeta=z, weight=1e6)
+
+    grid_kwargs = dict(x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                       z_range=(-0.3, 0.3), nz=16, solver='FFTSolver2p5D')
+    nmap = xf.NestedTriLinearInterpolatedFieldMap(_context=test_context,
+                nx=33, ny=33, fine_x_range=(-2e-3, 2e-3),
+                fine_y_range=(-2e-3, 2e-3), refinement=(4, 4, 1),
+                **grid_kwargs)
+    nmap.update_from_particles(particles=particles)
+
+    # Uniform maps with the cell sizes of the two grids
+    fine_uniform = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                dx=nmap.fine.dx, dy=nmap.fine.dy, **grid_kwargs)
+    fine_uniform.update_from_particles(particles=particles)
+    coarse_uniform = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                nx=33, ny=33, **grid_kwargs)
+    coarse_uniform.update_from_particles(particles=particles)
+
+    p2np = test_context.nparray_from_context_array
+
+    # Charge is conserved on both grids
+    xo.assert_allclose(p2np(nmap.coarse.rho).sum() * nmap.coarse.dx
+                       * nmap.coarse.dy * nmap.coarse.dz,
+                       (n_core + n_halo) * 1e6 * qe,
+                       rtol=1e-10, atol=0)
+
+    x_test = np.linspace(-6e-3, 6e-3, 241)
+    y_test = 0 * x_test + 1e-4
+    z_test = 0 * x_test
+    x_test, y_test, z_test = [test_context.nparray_to_context_array(vv)
+                              for vv in (x_test, y_test, z_test)]
+    kick_nested = p2np(nmap.gather_at_points(x_test, y_test, z_test)[0, :])
+    kick_fine = p2np(fine_uniform.gather_at_points(x_test, y_test, z_test,
+                                        quantities=('dphi_dx',))[0, :])
+    kick_coarse = p2np(coarse_uniform.gather_at_points(x_test, y_test, z_test,
+                                        quantities=('dphi_dx',))[0, :])
+
+    # The nested map is close to the uniform fine one, the coarse one is not
+    scale = np.abs(kick_fine).max()
+    assert np.abs(kick_nested - kick_fine).max() < 0.03 * scale
+    assert np.abs(kick_coarse - kick_fine).max() > 0.3 * scale
+
+    # Tracking
+    sc = xf.NestedSpaceCharge3D(fieldmap=nmap, length=1.,
+                                apply_z_kick=False)
+    part = particles.copy()
+    sc.track(part)
+    assert np.all(np.isfinite(p2np(part.px)))
+    assert np.abs(p2np(part.px)).max() > 0
+
+
+@for_all_test_contexts
+def test_nested_fieldmap_storage(test_context):
+
+    rng = np.random.default_rng(12)
+    n_part = 20000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                             x=rng.normal(0, 1e-3, n_part),
+                             y=rng.normal(0, 1e-3, n_part),
+                             zeta=rng.normal(0, 5e-2, n_part))
+
+    nmap = xf.NestedTriLinearInterpolatedFieldMap(_context=test_context,
+                x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                z_range=(-0.3, 0.3), nx=16, ny=16, nz=8,
+                fine_x_range=(-3e-3, 3e-3), fine_y_range=(-3e-3, 3e-3))
+    nmap.update_from_particles(particles=particles, update_phi=False)
+
+    p2np = test_context.nparray_from_context_array
+    rho_fine = p2np(nmap.fine.rho).copy()
+    rho_coarse = p2np(nmap.coarse.rho).copy()
+    assert rho_fine.sum() > 0
+
+    # Memory allocated in the same buffer does not overlap the maps
+    other = xf.TriLinearInterpolatedFieldMap(_buffer=nmap._buffer,
+                x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                z_range=(-0.3, 0.3), nx=16, ny=16, nz=8)
+    other.rho[:,:,:] = 1.
+    other.phi[:,:,:] = 1.
+
+    assert np.all(p2np(nmap.fine.rho) == rho_fine)
+    assert np.all(p2np(nmap.coarse.rho) == rho_coarse)
+
+    # The maps written by the deposition are the ones read by the kernels
+    x_test = test_context.nparray_to_context_array(np.array([1e-4, 8e-3]))
+    y_test = test_context.nparray_to_context_array(np.array([1e-4, 8e-3]))
+    z_test = test_context.nparray_to_context_array(np.array([0., 0.]))
+    rho_nested = p2np(nmap.gather_at_points(x_test, y_test, z_test,
+                                            quantities=('rho',)))[0, :]
+    rho_expected = [
+        p2np(nmap.fine.gather_at_points(x_test, y_test, z_test,
+                                        quantities=('rho',)))[0, 0],
+        p2np(nmap.coarse.gather_at_points(x_test, y_test, z_test,
+                                          quantities=('rho',)))[0, 1]]
+    xo.assert_allclose(rho_nested, rho_expected, rtol=1e-14, atol=0)
+
+
+@for_all_test_contexts
+def test_particle_indices(test_context):
+
+    rng = np.random.default_rng(6)
+    n_part = 20000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                x=rng.normal(0, 1e-3, n_part),
+                y=rng.normal(0, 0.5e-3, n_part),
+                zeta=rng.normal(0, 5e-2, n_part))
+    state = np.ones(n_part, dtype=np.int64)
+    state[rng.uniform(size=n_part) < 0.7] = 0
+    particles.state[:] = test_context.nparray_to_context_array(state)
+
+    p2np = test_context.nparray_from_context_array
+    for particle_shape in ['cic', 'tsc']:
+        fmap = xf.TriLinearInterpolatedFieldMap(
+                _context=test_context,
+                x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=32, ny=32, nz=16,
+                solver='FFTSolver2p5D', particle_shape=particle_shape)
+
+        indices = fmap.alive_particle_indices(particles)
+        assert np.all(p2np(indices) == np.flatnonzero(state))
+
+        fmap.update_from_particles(particles=particles)
+        rho_ref = p2np(fmap.rho).copy()
+        kicks_ref = p2np(fmap.gather_at_points(particles.x, particles.y,
+                                               particles.zeta))
+
+        fmap.update_from_particles(particles=particles,
+                                   particle_indices=indices)
+        xo.assert_allclose(p2np(fmap.rho), rho_ref, rtol=1e-12,
+                           atol=1e-12*np.abs(rho_ref).max())
+
+        # Arrays interface
+        fmap.update_from_particles(x_p=particles.x, y_p=particles.y,
+                z_p=particles.zeta, ncharges_p=particles.weight,
+                q0_coulomb=qe, particle_indices=indices)
+        xo.assert_allclose(p2np(fmap.rho), rho_ref, rtol=1e-12,
+                           atol=1e-12*np.abs(rho_ref).max())
+
+        kicks = p2np(fmap.gather_at_points(particles.x, particles.y,
+                                           particles.zeta, indices=indices))
+        assert kicks.shape == (3, len(indices))
+        xo.assert_allclose(kicks, kicks_ref[:, state > 0], rtol=1e-12,
+                           atol=1e-12*np.abs(kicks_ref).max())
+
+    with pytest.raises(NotImplementedError):
+        fmap.update_from_particles(particles=particles,
+                                   particle_indices=indices,
+                                   deposition='sorted')
+
+
+@for_all_test_contexts
+def test_incremental_rho_update(test_context):
+
+    rng = np.random.default_rng(7)
+    n_part = 20000
+    x0 = rng.normal(0, 1e-3, n_part)
+    y0 = rng.normal(0, 0.5e-3, n_part)
+    z0 = rng.normal(0, 5e-2, n_part)
+
+    def make_particles(scale):
+        return xt.Particles(_context=test_context, p0c=7e12,
+                            x=scale*x0, y=scale*y0, zeta=z0)
+
+    fmap_kwargs = dict(_context=test_context,
+                x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                z_range=(-0.3, 0.3), nx=32, ny=32, nz=16,
+                solver='FFTSolver2p5D')
+    p2np = test_context.nparray_from_context_array
+
+    # Reference charge densities
+    fmap_ref = xf.TriLinearInterpolatedFieldMap(**fmap_kwargs)
+    fmap_ref.update_from_particles(particles=make_particles(1.))
+    rho_1 = p2np(fmap_ref.rho).copy()
+    fmap_ref.update_from_particles(particles=make_particles(1.2))
+    rho_2 = p2np(fmap_ref.rho).copy()
+    phi_2 = p2np(fmap_ref.phi).copy()
+
+    # Exponential moving average
+    fmap = xf.TriLinearInterpolatedFieldMap(rho_update_weight=0.25,
+                                            **fmap_kwargs)
+    fmap.update_from_particles(particles=make_particles(1.))
+    xo.assert_allclose(p2np(fmap.rho), rho_1, rtol=1e-12,
+                       atol=1e-12*np.abs(rho_1).max())
+    fmap.update_from_particles(particles=make_particles(1.2))
+    xo.assert_allclose(p2np(fmap.rho), 0.25*rho_2 + 0.75*rho_1, rtol=1e-12,
+                       atol=1e-12*np.abs(rho_1).max())
+
+    # Solve skipped for small changes of the charge density
+    fmap = xf.TriLinearInterpolatedFieldMap(rho_change_threshold=0.05,
+                                            **fmap_kwargs)
+    fmap.update_from_particles(particles=make_particles(1.))
+    phi_1 = p2np(fmap.phi).copy()
+    fmap.update_from_particles(particles=make_particles(1.001))
+    assert fmap._n_solves_skipped == 1
+    xo.assert_allclose(p2np(fmap.phi), phi_1, rtol=0, atol=0)
+    fmap.update_from_particles(particles=make_particles(1.2))
+    assert fmap._n_solves_skipped == 1
+    xo.assert_allclose(p2np(fmap.phi), phi_2, rtol=1e-10,
+                       atol=1e-10*np.abs(phi_2).max())
+
+    with pytest.raises(AssertionError):
+        xf.TriLinearInterpolatedFieldMap(rho_update_weight=0.5,
+                                         store_rho=False, **fmap_kwargs)
+
+
+@for_all_test_contexts
+def test_fieldmap_from_xobject(test_context):
+
+    rng = np.random.default_rng(7)
+    n_part = 10000
+    particles = xt.Particles(_context=test_context, p0c=7e12,
+                x=rng.normal(0, 1e-3, n_part),
+                y=rng.normal(0, 0.5e-3, n_part),
+                zeta=rng.normal(0, 5e-2, n_part))
+
+    fmap = xf.TriLinearInterpolatedFieldMap(
+            _context=test_context,
+            x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+            z_range=(-0.3, 0.3), nx=16, ny=16, nz=8)
+    fmap.update_from_particles(particles=particles, update_phi=False)
+    rho = test_context.nparray_from_context_array(fmap.rho).copy()
+
+    # The attributes not stored in the xobject take their defaults
+    fmap_xo = xf.TriLinearInterpolatedFieldMap(_xobject=fmap._xobject)
+    assert fmap_xo.sort_particles_every is None
+    assert fmap_xo.adaptive_grid is None
+    assert fmap_xo.rho_update_weight == 1.
+    assert fmap_xo.rho_change_threshold is None
+    xo.assert_allclose(fmap_xo.x_grid, fmap.x_grid, rtol=0, atol=1e-15)
+
+    fmap_xo.update_from_particles(particles=particles, update_phi=False,
+                                  force=True)
+    xo.assert_allclose(test_context.nparray_from_context_array(fmap_xo.rho),
+                       rho, rtol=1e-12, atol=1e-12*np.abs(rho).max())
+
+
+@for_all_test_contexts
+def test_fieldmap_settings_kept_by_containers(test_context):
+
+    bb = xf.BeamBeamPIC3D(phi=0., alpha=0.,
+                          x_range=(-5e-3, 5e-3), dx=5e-4,
+                          y_range=(-5e-3, 5e-3), dy=5e-4,
+                          z_range=(-0.3, 0.3), dz=0.05,
+                          _context=test_context)
+    bb.fieldmap_other.rho_update_weight = 0.5
+    bb.fieldmap_other.sort_particles_every = 5
+    solver = bb.fieldmap_other.solver
+
+    # The fieldmaps are dressed again when the element is moved or copied
+    bb.move(_buffer=test_context.new_buffer())
+    bb_copy = bb.copy()
+    for element in [bb, bb_copy]:
+        assert element.fieldmap_other.rho_update_weight == 0.5
+        assert element.fieldmap_other.sort_particles_every == 5
+        assert element.fieldmap_other.solver is solver
+        assert element.fieldmap_self.rho_update_weight == 1.
+        assert element.fieldmap_self.sort_particles_every is None
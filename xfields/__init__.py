@@ -9,7 +9,9 @@ from .longitudinal_profiles import LongitudinalProfileQGaussian
 from .ibs import IBSAnalyticalKick, IBSKineticKick
 
 from .fieldmaps import TriLinearInterpolatedFieldMap
+from .fieldmaps import NestedTriLinearInterpolatedFieldMap
 from .fieldmaps import TriCubicInterpolatedFieldMap
+from .fieldmaps import save_shared_fieldmaps, attach_shared_fieldmaps
 from .fieldmaps import BiGaussianFieldMap, mean_and_std
 
 from .slicers import UniformBinSlicer
@@ -17,6 +19,7 @@ from .slicers import UniformBinSlicer
 from .solvers.fftsolvers import FFTSolver3D
 
 from .beam_elements.spacecharge import SpaceCharge3D, SpaceChargeBiGaussian
+from .beam_elements.spacecharge import NestedSpaceCharge3D
 from .beam_elements.beambeam2d import BeamBeamBiGaussian2D
 from .beam_elements.beambeam2d import ConfigForUpdateBeamBeamBiGaussian2D
 from .beam_elements.beambeam3d import BeamBeamBiGaussian3D
@@ -131,11 +131,14 @@ class BeamBeamPIC3D(xt.BeamElement):
                 _cos_alpha=kwargs.get('cos_alpha', None))
 
         self._working_on_bunch = None
+        # Work arrays for the coordinates in the reference system of the
+        # other beam and for the gathered fields (allocated when first needed)
+        self._coords_buffer = None
+        self._gather_buffer = None
 
     def track(self, particles):
 
         pp = particles
-        mask_alive = pp.state > 0
 
         if self._working_on_bunch is None:
             # Starting a new interaction
@@ -162,7 +165,7 @@ class BeamBeamPIC3D(xt.BeamElement):
             self.fieldmap_self.update_from_particles(particles=pp,
                                                     update_phi=False)
 
-            at_turn = pp.at_turn[mask_alive][0]
+            at_turn = pp.at_turn[pp.state > 0][0]
 
             # Pass charge density to partner
             communication_send_id_data = dict(
@@ -203,32 +206,42 @@ class BeamBeamPIC3D(xt.BeamElement):
         # Compute potential
         self.fieldmap_other.update_phi_from_rho()
 
-        # Compute particles coordinates in the reference system of the other beam
+        # The kernel relies on the contiguity of pp for element-wise multiplying
+        # with dphi_d{x,y,z}, the alive particles are moved to the beginning
+        n_alive, _ = pp.reorganize()
+
+        # Compute particles coordinates in the reference system of the other
+        # beam (written in preallocated buffers, y is unchanged)
         z_step_self = self._z_steps_self[self._i_step]
-        mask_alive = pp.state > 0
         z_step_other = self._z_steps_other[self._i_step]
+        if (self._coords_buffer is None
+                or self._coords_buffer.shape[1] < n_alive):
+            self._coords_buffer = self._context.zeros(
+                                        shape=(2, n_alive), dtype=np.float64)
+            self._gather_buffer = self._context.zeros(
+                                        shape=(3 * n_alive,), dtype=np.float64)
+        x_other = self._coords_buffer[0, :n_alive]
+        z_other = self._coords_buffer[1, :n_alive]
+        y_other = pp.y[:n_alive]
         # For now assuming symmetric ultra-relativistic beams
-        z_other = (-pp.zeta[mask_alive] + z_step_other + z_step_self)
-        x_other = -pp.x[mask_alive]
-        y_other = pp.y[mask_alive]
+        z_other[:] = pp.zeta[:n_alive]
+        z_other *= -1
+        z_other += z_step_other
+        z_other += z_step_self
+        x_other[:] = pp.x[:n_alive]
+        x_other *= -1
 
         # Get fields in the reference system of the other beam
-        dphi_dx, dphi_dy, dphi_dz = self.fieldmap_other.get_values_at_points(
+        dphi_dx, dphi_dy, dphi_dz = self.fieldmap_other.gather_at_points(
             x=x_other, y=y_other, z=z_other,
-            return_rho=False,
-            return_phi=False,
-            return_dphi_dx=True,
-            return_dphi_dy=True,
-            return_dphi_dz=True,
+            quantities=('dphi_dx', 'dphi_dy', 'dphi_dz'),
+            out=self._gather_buffer[:3 * n_alive].reshape(3, n_alive),
         )
 
         # Transform fields to self reference frame (dphi_dy is unchanged)
         dphi_dx *= -1
         dphi_dz *= -1
 
-        # The kernel relies on the contiguity of pp for element-wise multiplying
-        # with dphi_d{x,y,z}
-        pp.reorganize()
         self.kick_and_propagate_transverse_coords_back(
             pp, dphi_dx=dphi_dx, dphi_dy=dphi_dy, dphi_dz=dphi_dz,
             z_step_other=z_step_other)
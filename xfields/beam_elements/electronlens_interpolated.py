@@ -9,8 +9,9 @@ import xobjects as xo
 import xtrack as xt
 import xpart as xp
 
-from ..fieldmaps import TriLinearInterpolatedFieldMap
 from ..fieldmaps import TriCubicInterpolatedFieldMap
+from ..fieldmaps.interpolated import _configure_grid
+from ..solvers.fftsolvers import FFTSolver2D
 
 from ..fieldmaps import TriCubicInterpolatedFieldMap
 from ..general import _pkg_root
@@ -58,19 +59,19 @@ class ElectronLensInterpolated(xt.BeamElement):
         nz = 11 
         z_range=(-1,1) 
 
-        fieldmap = TriLinearInterpolatedFieldMap(x_range=x_range, y_range=y_range, 
-                                z_range=z_range, nx=nx, ny=ny, nz=nz, 
-                                dx=dx, dy=dy, 
-                                x_grid=x_grid, y_grid=y_grid,
-                                solver="FFTSolver2p5D")
+        x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
+        y_grid = _configure_grid('y', y_grid, dy, y_range, ny)
+        z_grid = _configure_grid('z', None, None, z_range, nz)
 
-        for ii in range(nz):
-            fieldmap.rho[:,:,ii] = rho
-        fieldmap.update_phi_from_rho()
+        # The potential is computed only once, with a 2D solver
+        solver = FFTSolver2D(dx=x_grid[1] - x_grid[0],
+                             dy=y_grid[1] - y_grid[0],
+                             nx=len(x_grid), ny=len(y_grid))
+        phi_2d = np.array(solver.solve(np.asfortranarray(rho)))
 
-        tc_fieldmap = TriCubicInterpolatedFieldMap(x_grid=fieldmap._x_grid, 
-                                                   y_grid=fieldmap._y_grid, 
-                                                   z_grid=fieldmap._z_grid,
+        tc_fieldmap = TriCubicInterpolatedFieldMap(x_grid=x_grid, 
+                                                   y_grid=y_grid, 
+                                                   z_grid=z_grid,
                                                   )
 
         nx = tc_fieldmap.nx
@@ -83,7 +84,7 @@ class ElectronLensInterpolated(xt.BeamElement):
                 dx * dy, dx * dz, dy * dz, 
                 dx * dy * dz]
 
-        phi = fieldmap.phi
+        phi = np.repeat(phi_2d[:, :, np.newaxis], nz, axis=2)
         #print(phi.shape)
 
         ##########################################################################
@@ -7,6 +7,7 @@ import numpy as np
 
 from xfields import BiGaussianFieldMap, mean_and_std
 from xfields import TriLinearInterpolatedFieldMap
+from xfields import NestedTriLinearInterpolatedFieldMap
 from ..longitudinal_profiles import LongitudinalProfileQGaussian
 from ..fieldmaps import BiGaussianFieldMap
 from ..general import _pkg_root
@@ -61,12 +62,40 @@ class SpaceCharge3D(xt.BeamElement):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DAveraged``, ``RFFTSolver3D``,
+            ``RFFTSolver2p5D`` and ``DSTSolver2p5D`` (rectangular conducting
+            pipe one cell outside the grid). A Xfields solver object can also
+            be provided.
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
         gamma0 (float): Relativistic gamma factor of the beam. This is required
-            only if the solver is ``FFTSolver3D``.
+            only if the solver is ``FFTSolver3D`` or ``RFFTSolver3D``.
+        solver_dtype (np.dtype): Floating point precision of the Poisson
+            solver, ``np.float64`` (default) or ``np.float32``.
+        store_rho (bool): If ``False`` the charge density is not stored in
+            the fieldmap, the charge is deposited in the buffer of the
+            potential and overwritten by the solver. The default is ``True``.
+        store_dphi_dz (bool): If ``False`` the longitudinal derivative of the
+            potential is not computed nor stored in the fieldmap. By default
+            it is stored only if ``apply_z_kick`` is ``True``.
+        particle_shape (str): Shape of the macroparticles used for the charge
+            deposition and the interpolation of the fields, ``'cic'``
+            (default), ``'tsc'`` or ``'cubic'`` (see
+            :class:`TriLinearInterpolatedFieldMap`).
+        sort_particles_every (int): If provided, the particles are reordered
+            in memory by grid cell once every ``sort_particles_every``
+            updates of the fieldmap (i.e. turns, if the fieldmap is not
+            shared with other elements), to speed up the deposition and the
+            kicks. The default is ``None`` (no reordering).
+        rho_update_weight (float): Weight of the newly deposited charge
+            density in the exponential moving average of the charge density
+            (see :class:`TriLinearInterpolatedFieldMap`). The default is 1
+            (no averaging).
+        rho_change_threshold (float): If provided, the potential is
+            recomputed only when the relative change of the charge density
+            since the last solve exceeds this threshold. The default is
+            ``None`` (the potential is recomputed at each update).
     Returns:
         (SpaceCharge3D): A space-charge 3D beam element.
     """
@@ -79,6 +108,8 @@ class SpaceCharge3D(xt.BeamElement):
     _extra_c_sources = [
         _pkg_root.joinpath('headers/constants.h'),
         _pkg_root.joinpath('headers','particle_states.h'),
+        xt.general._pkg_root.joinpath('headers/atomicadd.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/particle_shapes.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/linear_interpolators.h'),
         _pkg_root.joinpath('beam_elements/spacecharge_src/spacecharge3d.h'),
     ]
@@ -108,12 +139,19 @@ class SpaceCharge3D(xt.BeamElement):
                  rho=None, phi=None,
                  solver=None,
                  gamma0=None,
-                 fftplan=None):
+                 fftplan=None,
+                 solver_dtype=np.float64,
+                 store_rho=True,
+                 store_dphi_dz=None,
+                 particle_shape='cic',
+                 sort_particles_every=None,
+                 rho_update_weight=1.,
+                 rho_change_threshold=None):
 
         self.update_on_track = update_on_track
 
-        if solver=='FFTSolver3D':
-            assert gamma0 is not None, ('To use FFTSolver3D '
+        if solver in ('FFTSolver3D', 'RFFTSolver3D'):
+            assert gamma0 is not None, (f'To use {solver} '
                                         'gamma0 must be provided')
 
         if gamma0 is not None:
@@ -139,6 +177,9 @@ class SpaceCharge3D(xt.BeamElement):
                     _context = xo.context_default
                 _buffer = _context.new_buffer(capacity=64)
 
+        if store_dphi_dz is None:
+            store_dphi_dz = bool(apply_z_kick)
+
         if fieldmap is None:
             fieldmap = TriLinearInterpolatedFieldMap(
                         _buffer=_buffer,
@@ -150,7 +191,14 @@ class SpaceCharge3D(xt.BeamElement):
                         solver=solver,
                         scale_coordinates_in_solver=scale_coordinates_in_solver,
                         updatable=update_on_track,
-                        fftplan=fftplan)
+                        fftplan=fftplan,
+                        solver_dtype=solver_dtype,
+                        store_rho=store_rho,
+                        store_dphi_dz=store_dphi_dz,
+                        particle_shape=particle_shape,
+                        sort_particles_every=sort_particles_every,
+                        rho_update_weight=rho_update_weight,
+                        rho_change_threshold=rho_change_threshold)
 
         self.xoinitialize(
                  _buffer=_buffer,
@@ -159,6 +207,12 @@ class SpaceCharge3D(xt.BeamElement):
                  length=length)
 
         self.apply_z_kick = apply_z_kick
+        self._check_z_kick()
+
+    def _check_z_kick(self):
+        if self.apply_z_kick and not self.fieldmap.store_dphi_dz:
+            raise ValueError('apply_z_kick requires a fieldmap storing '
+                             'dphi_dz (store_dphi_dz=True)')
 
     @property
     def iscollective(self):
@@ -175,6 +229,8 @@ class SpaceCharge3D(xt.BeamElement):
             particles (Particles Object): Particles to be tracked.
         """
 
+        self._check_z_kick()
+
         if self.update_on_track:
             self.fieldmap.update_from_particles(
                 particles=particles)
@@ -182,6 +238,102 @@ class SpaceCharge3D(xt.BeamElement):
         # call C tracking kernel
         super().track(particles)
 
+class NestedSpaceCharge3D(xt.BeamElement):
+
+    """
+    Simulates the effect of space charge on a bunch using a nested field map
+    (see :class:`NestedTriLinearInterpolatedFieldMap`), e.g. to resolve the
+    core of the beam with a fine grid while a coarse grid covers the halo.
+
+    Args:
+        fieldmap (NestedTriLinearInterpolatedFieldMap): Nested field map
+            used to compute the forces. It must be allocated in the buffer
+            of the beam element.
+        update_on_track (bool): If ``True`` the field map is updated at each
+            interaction. If ``False`` the field map is used as it is (frozen
+            model). The default is ``True``.
+        length (float): the length of the space-charge interaction in
+            meters.
+        apply_z_kick (bool): If ``True``, the longitudinal kick on the
+            particles is applied.
+    Returns:
+        (NestedSpaceCharge3D): A space-charge 3D beam element.
+    """
+
+    _xofields = {
+        'fieldmap': xo.Ref(NestedTriLinearInterpolatedFieldMap),
+        'length': xo.Float64,
+        'apply_z_kick': xo.Int64,
+        }
+
+    _extra_c_sources = [
+        _pkg_root.joinpath('headers/constants.h'),
+        _pkg_root.joinpath('headers','particle_states.h'),
+        xt.general._pkg_root.joinpath('headers/atomicadd.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/particle_shapes.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/linear_interpolators.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/nested_interpolators.h'),
+        _pkg_root.joinpath('beam_elements/spacecharge_src/nestedspacecharge3d.h'),
+    ]
+
+    def __init__(self,
+                 _context=None,
+                 _buffer=None,
+                 _offset=None,
+                 update_on_track=True,
+                 length=None,
+                 apply_z_kick=True,
+                 fieldmap=None,
+                 **kwargs):
+
+        if '_xobject' in kwargs.keys():
+            self.xoinitialize(**kwargs)
+            return
+
+        assert fieldmap is not None, 'A nested fieldmap must be provided'
+        if _buffer is not None:
+            assert _buffer is fieldmap._buffer, (
+                'The buffer of the fieldmap and the buffer of the '
+                'NestedSpaceCharge3D object must be the same')
+
+        self.update_on_track = update_on_track
+
+        self.xoinitialize(
+                 _buffer=fieldmap._buffer,
+                 _offset=_offset,
+                 fieldmap=fieldmap,
+                 length=length,
+                 apply_z_kick=apply_z_kick)
+
+        self._check_z_kick()
+
+    def _check_z_kick(self):
+        if self.apply_z_kick and not self.fieldmap.fine.store_dphi_dz:
+            raise ValueError('apply_z_kick requires a fieldmap storing '
+                             'dphi_dz (store_dphi_dz=True)')
+
+    @property
+    def iscollective(self):
+        return self.update_on_track
+
+    def track(self, particles):
+
+        """
+        Computes and applies the space-charge forces for the provided set of
+        particles.
+
+        Args:
+            particles (Particles Object): Particles to be tracked.
+        """
+
+        self._check_z_kick()
+
+        if self.update_on_track:
+            self.fieldmap.update_from_particles(particles=particles)
+
+        # call C tracking kernel
+        super().track(particles)
+
 class SpaceChargeBiGaussian(xt.BeamElement):
 
     _xofields = {
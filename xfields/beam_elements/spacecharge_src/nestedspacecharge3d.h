@@ -0,0 +1,49 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_NESTEDSPACECHARGE3D_H
+#define XFIELDS_NESTEDSPACECHARGE3D_H
+
+/*gpufun*/
+void NestedSpaceCharge3D_track_local_particle(
+		 NestedSpaceCharge3DData el, LocalParticle* part0){
+
+    const double length = NestedSpaceCharge3DData_get_length(el);
+	const int64_t apply_z_kick = NestedSpaceCharge3DData_get_apply_z_kick(el);
+    NestedTriLinearInterpolatedFieldMapData nmap = NestedSpaceCharge3DData_getp_fieldmap(el);
+
+    //start_per_particle_block (part0->part)
+		double const x = LocalParticle_get_x(part);
+		double const y = LocalParticle_get_y(part);
+		double const z = LocalParticle_get_zeta(part);
+
+		double const q0 = LocalParticle_get_q0(part);
+		double const mass0 = LocalParticle_get_mass0(part);
+		double const chi = LocalParticle_get_chi(part);
+		double const beta0 = LocalParticle_get_beta0(part);
+		double const gamma0 = LocalParticle_get_gamma0(part);
+
+		double dphi_dx, dphi_dy, dphi_dz;
+		NestedTriLinearInterpolatedFieldMap_interpolate_gradient(nmap, x, y, z,
+				apply_z_kick, &dphi_dx, &dphi_dy, &dphi_dz);
+
+		const double charge_mass_ratio =
+						chi*QELEM*q0/(mass0*QELEM/(C_LIGHT*C_LIGHT));
+		const double factor = -(charge_mass_ratio
+								*length*(1.-beta0*beta0)
+								/(gamma0*beta0*beta0*C_LIGHT*C_LIGHT));
+
+		LocalParticle_add_to_px(part, factor*dphi_dx);
+		LocalParticle_add_to_py(part, factor*dphi_dy);
+
+		if (apply_z_kick){
+			LocalParticle_update_delta(part,
+				LocalParticle_get_delta(part) + factor*dphi_dz);
+		}
+
+    //end_per_particle_block
+}
+
+#endif
@@ -16,8 +16,11 @@ void SpaceCharge3D_track_local_particle(
 
     /*gpuglmem*/ double* dphi_dx_map = SpaceCharge3DData_getp1_fieldmap_dphi_dx(el, 0);
     /*gpuglmem*/ double* dphi_dy_map = SpaceCharge3DData_getp1_fieldmap_dphi_dy(el, 0);
-	/*gpuglmem*/ double* dphi_dz_map = SpaceCharge3DData_getp1_fieldmap_dphi_dz(el, 0);
+	// dphi_dz is not stored if the fieldmap is transverse only
+	/*gpuglmem*/ double* dphi_dz_map = (SpaceCharge3DData_len_fieldmap_dphi_dz(el) > 0) ?
+		SpaceCharge3DData_getp1_fieldmap_dphi_dz(el, 0) : NULL;
     TriLinearInterpolatedFieldMapData fmap = SpaceCharge3DData_getp_fieldmap(el);
+    const int64_t shape_order = TriLinearInterpolatedFieldMapData_get_shape_order(fmap);
 
     //start_per_particle_block (part0->part)
 		double const x = LocalParticle_get_x(part);
@@ -30,13 +33,27 @@ void SpaceCharge3D_track_local_particle(
 		double const beta0 = LocalParticle_get_beta0(part);
 		double const gamma0 = LocalParticle_get_gamma0(part);
 
-		const IndicesAndWeights iw = 
-			TriLinearInterpolatedFieldMap_compute_indeces_and_weights(fmap, x, y, z);
-
-		const double dphi_dx = 
-			TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dx_map, iw);
-		const double dphi_dy = 
-			TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dy_map, iw);
+		double dphi_dx, dphi_dy;
+		double dphi_dz = 0.;
+		const int64_t compute_z_kick = (apply_z_kick > 0 && dphi_dz_map != NULL);
+		if (shape_order > 1){
+			const ShapeIndicesAndWeights siw =
+				TriLinearInterpolatedFieldMap_compute_shape_indices_and_weights(fmap, x, y, z);
+			dphi_dx = ParticleShape_interpolate_3d_map_scalar(dphi_dx_map, siw);
+			dphi_dy = ParticleShape_interpolate_3d_map_scalar(dphi_dy_map, siw);
+			if (compute_z_kick){
+				dphi_dz = ParticleShape_interpolate_3d_map_scalar(dphi_dz_map, siw);
+			}
+		}
+		else{
+			const IndicesAndWeights iw =
+				TriLinearInterpolatedFieldMap_compute_indeces_and_weights(fmap, x, y, z);
+			dphi_dx = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dx_map, iw);
+			dphi_dy = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dy_map, iw);
+			if (compute_z_kick){
+				dphi_dz = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dz_map, iw);
+			}
+		}
 
 		const double charge_mass_ratio = 
 						chi*QELEM*q0/(mass0*QELEM/(C_LIGHT*C_LIGHT));
@@ -47,9 +64,7 @@ void SpaceCharge3D_track_local_particle(
 		LocalParticle_add_to_px(part, factor*dphi_dx);
 		LocalParticle_add_to_py(part, factor*dphi_dy);
 
-		if (apply_z_kick > 0){
-			const double dphi_dz =
-				TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dz_map, iw);
+		if (compute_z_kick){
 			LocalParticle_update_delta(part,
 				LocalParticle_get_delta(part) + factor*dphi_dz);
 		}
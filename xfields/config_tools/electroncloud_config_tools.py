@@ -3,6 +3,9 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import os
+import tempfile
+
 import numpy as np
 
 import xfields as xf
@@ -11,7 +14,18 @@ import xtrack as xt
 
 
 def get_electroncloud_fieldmap_from_h5(
-        filename, tau_max=None, buffer=None, ecloud_name="e-cloud"):
+        filename, tau_max=None, buffer=None, ecloud_name="e-cloud",
+        cache_coefficients=False, phi_taylor_dtype="float64", npy_cache=None):
+    """
+    Creates a TriCubicInterpolatedFieldMap from an e-cloud h5 file.
+
+    If ``npy_cache`` (a file path) is given, the scaled ``phi_taylor`` of all
+    the slices is converted once to a contiguous ``.npy`` file, which is then
+    memory-mapped and copied into the fieldmap in large blocks. The cache is
+    reused by later calls unless it is older than the h5 file or its first
+    slice differs from the one of the h5 file scaled by the cell sizes of
+    the grid (e.g. it was written from another file).
+    """
     assert buffer is not None
     import h5py
     ff = h5py.File(filename, "r")
@@ -48,11 +62,17 @@ def get_electroncloud_fieldmap_from_h5(
     z_grid = ff["grid/zg"][iz1:iz2]
 
     mirror2D = ff["settings/symmetric2D"][()]
-    # (in GB), 8 bytes per double-precision number
-    memory_estimate = (ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 8 * 8 * 1.e-9
+    # (in GB)
+    bytes_per_value = np.dtype(phi_taylor_dtype).itemsize
+    memory_estimate = (ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 8 * bytes_per_value * 1.e-9
+    if cache_coefficients is True:
+        # 64 coefficients in double precision per cell
+        memory_estimate += (ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 64 * 8 * 1.e-9
     print(f"Creating fieldmap... (Memory estimate = {memory_estimate:.2f} GB)")
     fieldmap = xf.TriCubicInterpolatedFieldMap(x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
-                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer)
+                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer,
+                                               cache_coefficients=cache_coefficients,
+                                               phi_taylor_dtype=phi_taylor_dtype)
     print(f"Reading {ecloud_name}: ")
     kk = 0.
     scale = [1., fieldmap.dx, fieldmap.dy, fieldmap.dz,
@@ -60,21 +80,25 @@ def get_electroncloud_fieldmap_from_h5(
              fieldmap.dz, fieldmap.dy * fieldmap.dz,
              fieldmap.dx * fieldmap.dy * fieldmap.dz]
 
-    ####### Optimized version of the loop in the block below. ################
-    for iz in range(iz1, iz2):
-        if (iz - iz1) / (iz2 - iz1) > kk:
-            while (iz - iz1) / (iz2 - iz1) > kk:
-                kk += 0.2
-            print(f"{int(np.round(100*kk)):d}%..")
-        phi_slice = ff[f"slices/slice{iz}/phi"][ix1:ix2,
-                                                iy1:iy2, :].transpose(1, 0, 2)
-        for ll in range(8):
-            phi_slice[:, :, ll] *= scale[ll]
-        index_offset = 8 * nx * ny * (iz - iz1)
-        len_slice = phi_slice.shape[0] * \
-            phi_slice.shape[1] * phi_slice.shape[2]
-        fieldmap._phi_taylor[index_offset:index_offset +
-                             len_slice] = fieldmap._context.nparray_to_context_array(phi_slice.flatten())
+    if npy_cache is not None:
+        phi_taylor = _phi_taylor_npy_cache(ff, filename, npy_cache, scale)
+        chunk = max(1, int(_npy_cache_chunk_bytes // phi_taylor[0].nbytes))
+        for iz in range(iz1, iz2, chunk):
+            fieldmap.update_phi_taylor(phi_taylor[iz:min(iz + chunk, iz2)],
+                                       first_slice=iz - iz1)
+        del phi_taylor
+    else:
+        ####### Optimized version of the loop in the block below. ################
+        for iz in range(iz1, iz2):
+            if (iz - iz1) / (iz2 - iz1) > kk:
+                while (iz - iz1) / (iz2 - iz1) > kk:
+                    kk += 0.2
+                print(f"{int(np.round(100*kk)):d}%..")
+            phi_slice = ff[f"slices/slice{iz}/phi"][ix1:ix2,
+                                                    iy1:iy2, :].transpose(1, 0, 2)
+            for ll in range(8):
+                phi_slice[:, :, ll] *= scale[ll]
+            fieldmap.update_phi_taylor(phi_slice, first_slice=iz - iz1)
     ##########################################################################
     # for iz in range(iz1, iz2):
     #     if (iz-iz1)/nz > kk:
@@ -89,9 +113,62 @@ def get_electroncloud_fieldmap_from_h5(
     #                 fieldmap._phi_taylor[index] = phi_slice[ix, iy, ll] * scale[ll]
     ##########################################################################
 
+    if phi_taylor_dtype != "float64":
+        max_error = max(fieldmap.phi_taylor_storage_error().values())
+        print(f"Maximum relative error of the {phi_taylor_dtype} storage: {max_error:.2e}")
+
+    if cache_coefficients is True:
+        fieldmap.update_coefficient_cache()
+
     return fieldmap
 
 
+_npy_cache_chunk_bytes = 2**28
+
+
+def _phi_taylor_npy_cache(ff, filename, npy_cache, scale):
+    # Returns a read-only memory map of the scaled phi_taylor of all the
+    # slices, with shape (nz, ny, nx, 8), writing the cache file if needed
+    nx = len(ff["grid/xg"][()])
+    ny = len(ff["grid/yg"][()])
+    nz = len(ff["grid/zg"][()])
+    shape = (nz, ny, nx, 8)
+    scale = np.array(scale)
+
+    def scaled_slice(iz):
+        return ff[f"slices/slice{iz}/phi"][()].transpose(1, 0, 2) * scale
+
+    if (os.path.exists(npy_cache)
+            and os.path.getmtime(npy_cache) >= os.path.getmtime(filename)):
+        phi_taylor = np.load(npy_cache, mmap_mode="r")
+        if (phi_taylor.shape == shape and phi_taylor.dtype == np.float64
+                and np.array_equal(phi_taylor[0], scaled_slice(0))):
+            print(f"Using cache {npy_cache}")
+            return phi_taylor
+        del phi_taylor
+
+    print(f"Writing cache {npy_cache}...")
+    # Written to a temporary file first, so that other processes never see a
+    # partially written file
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(npy_cache)), suffix=".npy",
+            delete=False) as fid:
+        tmp_name = fid.name
+    try:
+        out = np.lib.format.open_memmap(tmp_name, mode="w+",
+                                        dtype=np.float64, shape=shape)
+        for iz in range(nz):
+            out[iz] = scaled_slice(iz)
+        out.flush()
+        del out
+        os.replace(tmp_name, npy_cache)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+    return np.load(npy_cache, mmap_mode="r")
+
+
 def insert_electronclouds(eclouds, fieldmap=None, line=None):
     assert line is not None
     for name in eclouds.keys():
@@ -163,17 +240,46 @@ def electroncloud_dipolar_kicks_of_fieldmap(fieldmap=None, p0c=None):
 
 
 def full_electroncloud_setup(line=None, ecloud_info=None, filenames=None, context=None,
-                             tau_max=None, subtract_dipolar_kicks=True, shift_to_closed_orbit=True):
-
-    buffer = context.new_buffer()
-    fieldmaps = {
-        ecloud_type: get_electroncloud_fieldmap_from_h5(
-            filename=filename,
-            buffer=buffer,
-            tau_max=tau_max,
-            ecloud_name=ecloud_type) for (
-            ecloud_type,
-            filename) in filenames.items()}
+                             tau_max=None, subtract_dipolar_kicks=True, shift_to_closed_orbit=True,
+                             shared_fieldmaps_file=None, cache_coefficients=False,
+                             phi_taylor_dtype="float64", npy_cache=None):
+    """
+    Inserts and configures the electron clouds of ``ecloud_info`` in the line,
+    with the fieldmaps read from the h5 files ``filenames`` (by e-cloud type)
+    or attached from ``shared_fieldmaps_file``.
+
+    ``cache_coefficients`` and ``phi_taylor_dtype`` are passed to
+    ``get_electroncloud_fieldmap_from_h5``. ``npy_cache`` gives the npy cache
+    of each e-cloud type, either as a dict of file paths by e-cloud type or
+    as a directory, in which the cache of each type is ``<ecloud_type>.npy``.
+    """
+
+    if npy_cache is None or isinstance(npy_cache, dict):
+        npy_caches = npy_cache or {}
+    else:
+        npy_caches = {
+            ecloud_type: os.path.join(npy_cache, f"{ecloud_type}.npy")
+            for ecloud_type in filenames.keys()}
+
+    if shared_fieldmaps_file is not None:
+        # Fieldmaps written with xf.save_shared_fieldmaps, their memory is
+        # shared with the other processes using the same file
+        fieldmaps = xf.attach_shared_fieldmaps(shared_fieldmaps_file,
+                                               _context=context)
+        buffer = next(iter(fieldmaps.values()))._buffer
+    else:
+        buffer = context.new_buffer()
+        fieldmaps = {
+            ecloud_type: get_electroncloud_fieldmap_from_h5(
+                filename=filename,
+                buffer=buffer,
+                tau_max=tau_max,
+                ecloud_name=ecloud_type,
+                cache_coefficients=cache_coefficients,
+                phi_taylor_dtype=phi_taylor_dtype,
+                npy_cache=npy_caches.get(ecloud_type)) for (
+                ecloud_type,
+                filename) in filenames.items()}
 
     for ecloud_type, fieldmap in fieldmaps.items():
         print(f"Inserting \"{ecloud_type}\" electron clouds...")
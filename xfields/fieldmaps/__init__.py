@@ -4,5 +4,7 @@
 # ########################################### #
 
 from .interpolated import TriLinearInterpolatedFieldMap
+from .nested_interpolated import NestedTriLinearInterpolatedFieldMap
 from .tricubicinterpolated import TriCubicInterpolatedFieldMap
+from .shared import save_shared_fieldmaps, attach_shared_fieldmaps
 from .bigaussian import BiGaussianFieldMap, mean_and_std
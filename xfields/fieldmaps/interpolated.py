@@ -3,12 +3,20 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import os
+from collections import OrderedDict
+
 import numpy as np
+from scipy.constants import e as qe
 
 import xobjects as xo
 import xtrack as xt
 
-from ..solvers.fftsolvers import FFTSolver3D, FFTSolver2p5D, FFTSolver2p5DAveraged
+from ..solvers.fftsolvers import (FFTSolver3D, FFTSolver2p5D,
+                                  FFTSolver2p5DAveraged,
+                                  RFFTSolver3D, RFFTSolver2p5D,
+                                  DSTSolver2p5D)
+from ..solvers.base import _submit_async
 from ..general import _pkg_root
 
 _TriLinearInterpolatedFielmap_kernels = {
@@ -25,10 +33,31 @@ _TriLinearInterpolatedFielmap_kernels = {
             ],
         n_threads='nelem'
         ),
+    'central_diff_3d': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_x'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_y'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_z'),
+            xo.Arg(xo.Int32,   pointer=False, name='with_z'),
+            xo.Arg(xo.Int8,    pointer=True,  name='buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='matrix_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_x_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_y_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_z_offset'),
+            ],
+        n_threads='nelem'
+        ),
     'p2m_rectmesh3d_xparticles': xo.Kernel(
         args=[
             xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
             xo.Arg(xt.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='charge_factor'),
+            xo.Arg(xo.Int64,   pointer=True,  name='indices'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_indices'),
             xo.Arg(xo.Float64, pointer=False, name='x0'),
             xo.Arg(xo.Float64, pointer=False, name='y0'),
             xo.Arg(xo.Float64, pointer=False, name='z0'),
@@ -50,7 +79,37 @@ _TriLinearInterpolatedFielmap_kernels = {
             xo.Arg(xo.Float64, pointer=True, name='y'),
             xo.Arg(xo.Float64, pointer=True, name='z'),
             xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Float64, pointer=False, name='charge_factor'),
+            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_state'),
+            xo.Arg(xo.Int64,   pointer=True,  name='indices'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_indices'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        n_threads='nparticles'
+        ),
+    'p2m_rectmesh3d_shape': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True, name='x'),
+            xo.Arg(xo.Float64, pointer=True, name='y'),
+            xo.Arg(xo.Float64, pointer=True, name='z'),
+            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Float64, pointer=False, name='charge_factor'),
             xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_state'),
+            xo.Arg(xo.Int64,   pointer=True,  name='indices'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_indices'),
             xo.Arg(xo.Float64, pointer=False, name='x0'),
             xo.Arg(xo.Float64, pointer=False, name='y0'),
             xo.Arg(xo.Float64, pointer=False, name='z0'),
@@ -60,6 +119,7 @@ _TriLinearInterpolatedFielmap_kernels = {
             xo.Arg(xo.Int32,   pointer=False, name='nx'),
             xo.Arg(xo.Int32,   pointer=False, name='ny'),
             xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='shape_order'),
             xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
             xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
             ],
@@ -72,6 +132,8 @@ _TriLinearInterpolatedFielmap_kernels = {
             xo.Arg(xo.Float64, pointer=True,  name='x'),
             xo.Arg(xo.Float64, pointer=True,  name='y'),
             xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Int64,   pointer=True,  name='indices'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_indices'),
             xo.Arg(xo.Int64,   pointer=False, name='n_quantities'),
             xo.Arg(xo.Int8,    pointer=True,  name='buffer_mesh_quantities'),
             xo.Arg(xo.Int64,   pointer=True,  name='offsets_mesh_quantities'),
@@ -81,6 +143,79 @@ _TriLinearInterpolatedFielmap_kernels = {
         ),
     }
 
+_grid_args = [
+    xo.Arg(xo.Float64, pointer=False, name='x0'),
+    xo.Arg(xo.Float64, pointer=False, name='y0'),
+    xo.Arg(xo.Float64, pointer=False, name='z0'),
+    xo.Arg(xo.Float64, pointer=False, name='dx'),
+    xo.Arg(xo.Float64, pointer=False, name='dy'),
+    xo.Arg(xo.Float64, pointer=False, name='dz'),
+    xo.Arg(xo.Int32,   pointer=False, name='nx'),
+    xo.Arg(xo.Int32,   pointer=False, name='ny'),
+    xo.Arg(xo.Int32,   pointer=False, name='nz'),
+    ]
+
+_deposition_kernels = {
+    'p2m_rectmesh3d_private_grids': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Float64, pointer=True,  name='part_weights'),
+            xo.Arg(xo.Float64, pointer=False, name='charge_factor'),
+            xo.Arg(xo.Int64,   pointer=True,  name='part_state'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_state'),
+            ] + _grid_args + [
+            xo.Arg(xo.Int32,   pointer=False, name='n_grids'),
+            xo.Arg(xo.Float64, pointer=True,  name='private_grids'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        ),
+    'p2m_rectmesh3d_cell_index': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Int64,   pointer=True,  name='part_state'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_state'),
+            ] + _grid_args + [
+            xo.Arg(xo.Int64,   pointer=True,  name='cell_index'),
+            ],
+        n_threads='nparticles'
+        ),
+    'p2m_rectmesh3d_sorted': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='n_segments'),
+            xo.Arg(xo.Int64,   pointer=True,  name='segment_start'),
+            xo.Arg(xo.Int64,   pointer=True,  name='sorted_particles'),
+            xo.Arg(xo.Int64,   pointer=True,  name='cell_index'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Float64, pointer=True,  name='part_weights'),
+            xo.Arg(xo.Float64, pointer=False, name='charge_factor'),
+            ] + _grid_args + [
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        n_threads='n_segments'
+        ),
+    }
+
+_deposition_strategies = ('atomic', 'private_grids', 'sorted')
+
+# Maximum memory used by the grid copies of the `private_grids` deposition
+_private_grids_max_bytes = 2**29
+
+# Order of the shape functions used for deposition and interpolation
+_particle_shapes = {'cic': 1, 'tsc': 2, 'cubic': 3}
+
+# Maps that can be interpolated at given points
+_gather_quantities = ('rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz')
+
 
 class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
@@ -121,8 +256,11 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DAveraged``, ``RFFTSolver3D``,
+            ``RFFTSolver2p5D`` and ``DSTSolver2p5D`` (rectangular conducting
+            pipe one cell outside the grid). A Xfields solver object can also
+            be provided.
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
         scale_coordinates_in_solver (tuple): Three coefficients used to rescale
@@ -130,6 +268,71 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        solver_dtype (np.dtype): Floating point precision of the Poisson
+            solver generated from a solver name, ``np.float64`` (default) or
+            ``np.float32``. The maps stored in the field map are always in
+            double precision.
+        adaptive_grid (str): Planes (e.g. ``'xy'`` or ``'xyz'``) in which
+            the grid is moved and rescaled, at each update from particles,
+            so that the alive particles cover a fraction ``grid_coverage``
+            of the grid. The number of cells does not change. The cell sizes
+            are taken from a geometric sequence around the initial ones, with
+            ``grid_steps_per_octave`` values per factor two, within a factor
+            ``max_grid_rescale``, and one solver is generated for each of
+            them. The ``max_adaptive_solvers`` most recently used solvers are
+            kept. Requires ``solver`` to be given by name. If ``None``
+            (default) the grid is fixed.
+        grid_coverage (float): Fraction of the grid covered by the beam when
+            ``adaptive_grid`` is used. The default is 0.8.
+        grid_steps_per_octave (int): Number of cell sizes per factor two
+            when ``adaptive_grid`` is used. The default is 4.
+        max_grid_rescale (float): Maximum rescaling of the cell sizes with
+            respect to the initial ones when ``adaptive_grid`` is used. The
+            default is 4.
+        max_adaptive_solvers (int): Maximum number of solvers kept in memory
+            when ``adaptive_grid`` is used, the least recently used one is
+            dropped when a new cell size is reached. The defaults of
+            ``grid_steps_per_octave`` and ``max_grid_rescale`` allow 17 cell
+            sizes per plane, i.e. up to 17**3 solvers for ``'xyz'``. Each
+            solver holds its own Green function, i.e. 128*nx*ny*nz bytes for
+            ``FFTSolver3D`` and 64*nx*ny bytes (plus 8*nx*ny*nz bytes for its
+            output) for ``FFTSolver2p5D`` in double precision, while the
+            workspaces are shared. The default is 8.
+        store_rho (bool): If ``False`` the charge density is not stored
+            separately: the charge is deposited in the buffer of the potential
+            and the solver overwrites it with the potential, which saves the
+            memory of one map and its initialization at each update. In this
+            case ``rho`` is not available after the potential is computed.
+            The default is ``True``.
+        store_dphi_dz (bool): If ``False`` the longitudinal derivative of
+            the potential is neither computed nor stored (e.g. for transverse
+            only kicks), which saves the memory of one map and part of the
+            update. The default is ``True``.
+        particle_shape (str): Shape of the macroparticles used both for the
+            charge deposition and for the interpolation of the maps:
+            ``'cic'`` (cloud in cell, linear, default), ``'tsc'``
+            (triangular shaped cloud, quadratic) or ``'cubic'`` (cubic
+            B-spline). Higher order shapes reduce the grid noise at the cost
+            of 27 or 64 grid nodes per particle instead of 8. Particles whose
+            shape is not entirely inside the grid are ignored.
+        sort_particles_every (int): If provided, the particles passed to
+            :meth:`update_from_particles` are reordered by grid cell (see
+            :meth:`sort_particles`) once every ``sort_particles_every``
+            updates, to improve the memory locality of the deposition and of
+            the interpolation. If ``None`` (default) the particles are never
+            reordered.
+        rho_update_weight (float): Weight of the newly deposited charge
+            density at each update from particles. If smaller than one, the
+            stored charge density is an exponential moving average of the
+            deposited ones, ``rho = w * rho_new + (1 - w) * rho``, which
+            reduces the noise for slowly evolving beams. The default is 1
+            (the charge density is replaced at each update).
+        rho_change_threshold (float): If provided, the potential is
+            recomputed by :meth:`update_from_particles` only when the relative
+            change of the charge density (L2 norm) with respect to the one
+            used for the last solve exceeds this threshold, otherwise the
+            stored potential is kept (quasi-frozen model). If ``None``
+            (default) the potential is recomputed at each update.
     Returns:
         (TriLinearInterpolatedFieldMap): Interpolator object.
     """
@@ -149,6 +352,7 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         'dphi_dx': xo.Float64[:],
         'dphi_dy': xo.Float64[:],
         'dphi_dz': xo.Float64[:],
+        'shape_order': xo.Int64,
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -159,6 +363,7 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         _pkg_root.joinpath('headers/constants.h'),
         xt.general._pkg_root.joinpath('headers/atomicadd.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/central_diff.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/particle_shapes.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/linear_interpolators.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/charge_deposition.h'),
         ]
@@ -167,6 +372,19 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
     _kernels = _TriLinearInterpolatedFielmap_kernels
 
+    # Attributes not stored in the xobject, with their defaults (also for the
+    # fieldmaps built from an existing xobject). They are defined on the class
+    # so that a container dressing the fieldmap again after a move or a copy
+    # keeps the values set on the instance.
+    sort_particles_every = None
+    adaptive_grid = None
+    rho_update_weight = 1.
+    rho_change_threshold = None
+    _n_updates_since_sort = 0
+    _n_solves_skipped = 0
+    _rho_deposited = False
+    _phi_holds_rho = False
+
     def __init__(self,
                  _context=None,
                  _buffer=None,
@@ -180,15 +398,42 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  solver=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
-                 fftplan=None
+                 fftplan=None,
+                 solver_dtype=np.float64,
+                 adaptive_grid=None,
+                 grid_coverage=0.8,
+                 grid_steps_per_octave=4,
+                 max_grid_rescale=4.,
+                 max_adaptive_solvers=8,
+                 store_rho=True,
+                 store_dphi_dz=True,
+                 particle_shape='cic',
+                 sort_particles_every=None,
+                 rho_update_weight=1.,
+                 rho_change_threshold=None,
                  ):
 
+        self._init_python_state()
+
         if _xobject is not None:
             self.xoinitialize(_xobject=_xobject, _context=_context,
                              _buffer=_buffer, _offset=_offset)
+            # Grids from the stored parameters
+            self._x_grid = self._x_min + self._dx * np.arange(self._nx)
+            self._y_grid = self._y_min + self._dy * np.arange(self._ny)
+            self._z_grid = self._z_min + self._dz * np.arange(self._nz)
             return
 
+        if particle_shape not in _particle_shapes:
+            raise ValueError(f'particle_shape {particle_shape} not recognized, '
+                             f'use one of {tuple(_particle_shapes)}')
+
+        if sort_particles_every is not None:
+            assert sort_particles_every > 0, (
+                'sort_particles_every must be a positive integer')
+
         self.updatable = updatable
+        self.sort_particles_every = sort_particles_every
         self.scale_coordinates_in_solver = scale_coordinates_in_solver
 
         self._x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
@@ -209,20 +454,54 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  dx = self.dx,
                  dy = self.dy,
                  dz = self.dz,
-                 rho = nelem,
+                 rho = (nelem if store_rho else 0),
                  phi = nelem,
                  dphi_dx = nelem,
                  dphi_dy = nelem,
-                 dphi_dz = nelem)
+                 dphi_dz = (nelem if store_dphi_dz else 0),
+                 shape_order = _particle_shapes[particle_shape])
 
         self.compile_kernels(only_if_needed=True)
 
         if isinstance(solver, str):
-            self.solver = self.generate_solver(solver, fftplan)
+            self.solver = self.generate_solver(solver, fftplan,
+                                               dtype=solver_dtype)
         else:
             #TODO: consistency check to be added
             self.solver = solver
 
+        self.adaptive_grid = adaptive_grid
+        if adaptive_grid is not None:
+            assert set(adaptive_grid) <= set('xyz'), (
+                'adaptive_grid must contain only the planes x, y, z')
+            assert isinstance(solver, str), (
+                'adaptive_grid requires the solver to be given by name')
+            assert 0 < grid_coverage <= 1, (
+                'grid_coverage must be in (0, 1]')
+            assert max_adaptive_solvers >= 1, (
+                'max_adaptive_solvers must be a positive integer')
+            self.grid_coverage = grid_coverage
+            self.grid_steps_per_octave = grid_steps_per_octave
+            self.max_grid_rescale = max_grid_rescale
+            self.max_adaptive_solvers = max_adaptive_solvers
+            self._initial_cell_sizes = (self.dx, self.dy, self.dz)
+            self._grid_steps = (0, 0, 0)
+            self._adaptive_solver_name = solver
+            self._adaptive_solver_dtype = solver_dtype
+            # Solvers by grid steps, from the least to the most recently used
+            self._adaptive_solvers = OrderedDict(
+                                        [(self._grid_steps, self.solver)])
+
+        assert 0 < rho_update_weight <= 1, (
+            'rho_update_weight must be in (0, 1]')
+        if rho_update_weight < 1 or rho_change_threshold is not None:
+            assert store_rho, ('rho_update_weight and rho_change_threshold '
+                               'require store_rho=True')
+            assert adaptive_grid is None, ('rho_update_weight and '
+                'rho_change_threshold cannot be used with adaptive_grid')
+        self.rho_update_weight = rho_update_weight
+        self.rho_change_threshold = rho_change_threshold
+
         # Set rho
         if rho is not None:
             self.update_rho(rho, force=True)
@@ -234,17 +513,57 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             if solver is not None and rho is not None:
                 self.update_phi_from_rho()
 
+    def _init_python_state(self):
+
+        # Work arrays and caches, allocated when first needed (the settings
+        # have class-level defaults)
+        self._rho_previous = None
+        self._rho_at_last_solve = None
+        self._private_grids = None
+        self._placeholder = None
+        self._gather_offsets_cache = {}
+        self._gather_offsets_location = None
+
     def _assert_updatable(self):
         assert self.updatable, 'This FieldMap is not updatable!'
 
+    @property
+    def store_rho(self):
+        """
+        ``True`` if the charge density is stored separately from the potential.
+        """
+        return len(self._xobject.rho) > 0
+
+    @property
+    def particle_shape(self):
+        """
+        Shape of the macroparticles (``'cic'``, ``'tsc'`` or ``'cubic'``).
+        """
+        return {vv: kk for kk, vv in _particle_shapes.items()}[
+                                                        self._shape_order]
+
+    @property
+    def store_dphi_dz(self):
+        """
+        ``True`` if the longitudinal derivative of the potential is stored.
+        """
+        return len(self._xobject.dphi_dz) > 0
+
+    def _rho_target(self):
+        # Array in which the charge density is deposited (the potential
+        # buffer if rho is not stored)
+        if self.store_rho:
+            return self._xobject.rho, self.rho
+        return self._xobject.phi, self.phi
+
     #@profile
     def get_values_at_points(self,
             x, y, z,
-            return_rho=True,
+            return_rho=None,
             return_phi=True,
             return_dphi_dx=True,
             return_dphi_dy=True,
-            return_dphi_dz=True):
+            return_dphi_dz=None):
 
         """
         Returns the charge density, the field potential and its derivatives
@@ -256,66 +575,137 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             y (float64 array): Vertical coordinates at which the field is evaluated.
             z (float64 array): Longitudinal coordinates at which the field is evaluated.
             return_rho (bool): If ``True``, the charge density at the given points is
-                returned.
+                returned. If ``None`` (default), it is returned if it is stored
+                in the fieldmap (see ``store_rho``).
             return_phi (bool): If ``True``, the potential at the given points is returned.
             return_dphi_dx (bool): If ``True``, the horizontal derivative of the potential
                 at the given points is returned.
             return_dphi_dy: If ``True``, the vertical derivative of the potential
                 at the given points is returned.
             return_dphi_dz: If ``True``, the longitudinal derivative of the potential
-                at the given points is returned.
+                at the given points is returned. If ``None`` (default), it is
+                returned if it is stored in the fieldmap (see ``store_dphi_dz``).
         Returns:
             (tuple of float64 array): The required quantities at the provided points.
         """
 
-        assert len(x) == len(y) == len(z)
-
-        pos_in_buffer_of_maps_to_interp = []
-        if return_rho:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.rho._offset + self._xobject.rho._data_offset)
-        if return_phi:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.phi._offset + self._xobject.phi._data_offset)
-        if return_dphi_dx:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dx._offset + self._xobject.dphi_dx._data_offset)
-        if return_dphi_dy:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dy._offset + self._xobject.dphi_dy._data_offset)
-        if return_dphi_dz:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dz._offset + self._xobject.dphi_dz._data_offset)
+        if return_rho is None:
+            return_rho = self.store_rho
+        if return_dphi_dz is None:
+            return_dphi_dz = self.store_dphi_dz
+
+        quantities = [name for name, flag in zip(_gather_quantities,
+                        [return_rho, return_phi, return_dphi_dx,
+                         return_dphi_dy, return_dphi_dz]) if flag]
+
+        if len(quantities) == 0:
+            return []
+
+        out = self.gather_at_points(x, y, z, quantities=quantities)
+
+        # Split buffer
+        particles_quantities = [out[ii, :] for ii in range(len(quantities))]
+
+        return particles_quantities
+
+    def gather_at_points(self, x, y, z,
+                         quantities=('dphi_dx', 'dphi_dy', 'dphi_dz'),
+                         out=None, indices=None):
+
+        """
+        Interpolates several maps at the points specified by x, y, z with a
+        single kernel call. The buffer offsets of the requested maps are
+        cached on the device, so that repeated calls do not involve any
+        host-to-device transfer, and the result can be written into a
+        caller-provided array, so that no memory is allocated.
+        Zeros are returned for points outside the grid.
+
+        Args:
+            x (float64 array): Horizontal coordinates at which the field is evaluated.
+            y (float64 array): Vertical coordinates at which the field is evaluated.
+            z (float64 array): Longitudinal coordinates at which the field is evaluated.
+            quantities (tuple of str): Maps to be interpolated, among ``'rho'``,
+                ``'phi'``, ``'dphi_dx'``, ``'dphi_dy'`` and ``'dphi_dz'``.
+            out (float64 array): Optional C-contiguous array of shape
+                (len(quantities), len(x)) in which the result is written.
+                If ``None``, a new array is allocated.
+            indices (int64 array): If provided, the maps are interpolated only
+                at the points with these indices (e.g. the alive particles,
+                see :meth:`alive_particle_indices`) and the result has shape
+                (len(quantities), len(indices)).
+        Returns:
+            (float64 array): Array of shape (len(quantities), len(x)) with
+            the required quantities at the provided points.
+        """
+
+        assert len(y) == len(x) and len(z) == len(x)
+        n_points = len(x) if indices is None else len(indices)
+
+        offsets = self._gather_offsets(tuple(quantities))
+        n_quantities = len(quantities)
 
         context = self._buffer.context
+        if out is None:
+            out = context.zeros(shape=(n_quantities, n_points),
+                                dtype=np.float64)
+        else:
+            assert out.shape == (n_quantities, n_points), (
+                f'out must have shape {(n_quantities, n_points)}')
 
-        pos_in_buffer_of_maps_to_interp = context.nparray_to_context_array(
-                        np.array(pos_in_buffer_of_maps_to_interp, dtype=np.int64))
-        nmaps_to_interp = len(pos_in_buffer_of_maps_to_interp)
-        buffer_out = context.zeros(
-                shape=(nmaps_to_interp * len(x),), dtype=np.float64)
-        if nmaps_to_interp > 0:
+        if n_quantities > 0 and n_points > 0:
             context.kernels.TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
                     fmap=self._xobject,
-                    n_points=len(x),
+                    n_points=n_points,
                     x=x, y=y, z=z,
-                    n_quantities=nmaps_to_interp,
+                    indices=(self._int64_placeholder() if indices is None
+                             else indices),
+                    use_indices=int(indices is not None),
+                    n_quantities=n_quantities,
                     buffer_mesh_quantities=self._buffer.buffer,
-                    offsets_mesh_quantities=pos_in_buffer_of_maps_to_interp,
-                    particles_quantities=buffer_out)
-
-        # Split buffer
-        particles_quantities = [buffer_out[ii*len(x):(ii+1)*len(x)]
-                                        for ii in range(nmaps_to_interp)]
-
-        return particles_quantities
+                    offsets_mesh_quantities=offsets,
+                    particles_quantities=out)
+
+        return out
+
+    def _gather_offsets(self, quantities):
+
+        # Device array with the buffer offsets of the given maps, built once
+        # for each combination of quantities. The cache is cleared when the
+        # xobject is not where it was (e.g. the fieldmap has been moved or
+        # copied).
+        location = (self._buffer, self._offset)
+        if (self._gather_offsets_location is None
+                or self._gather_offsets_location[0] is not location[0]
+                or self._gather_offsets_location[1] != location[1]):
+            self._gather_offsets_cache = {}
+            self._gather_offsets_location = location
+        if quantities not in self._gather_offsets_cache:
+            offsets = []
+            for name in quantities:
+                if name not in _gather_quantities:
+                    raise ValueError(f'Unknown quantity {name}, valid ones '
+                                     f'are {_gather_quantities}')
+                if name == 'rho' and not self.store_rho:
+                    raise ValueError('rho is not stored in this fieldmap '
+                                     '(store_rho=False)')
+                if name == 'dphi_dz' and not self.store_dphi_dz:
+                    raise ValueError('dphi_dz is not stored in this fieldmap '
+                                     '(store_dphi_dz=False)')
+                xoarr = getattr(self._xobject, name)
+                offsets.append(xoarr._offset + xoarr._data_offset)
+            self._gather_offsets_cache[quantities] = (
+                self._buffer.context.nparray_to_context_array(
+                    np.array(offsets, dtype=np.int64)))
+
+        return self._gather_offsets_cache[quantities]
 
     #@profile
     def update_from_particles(self,
                         particles=None,
                         x_p=None, y_p=None, z_p=None,
                         ncharges_p=None, state_p=None, q0_coulomb=None,
-                        reset=True, update_phi=True, solver=None, force=False):
+                        reset=True, update_phi=True, solver=None, force=False,
+                        deposition='atomic', particle_indices=None):
 
         """
         Updates the charge density at the grid using a given set of particles,
@@ -341,54 +731,431 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                 attached to the fieldmap is used (if any). The default is ``None``.
             force (bool): If ``True`` the potential is updated even if the
                 map is declared as not updateable. The default is ``False``.
+            deposition (str): Strategy used to deposit the charge on the grid.
+                ``'atomic'`` (default): each particle adds its contribution
+                to the grid with atomic operations. ``'private_grids'``
+                (CPU only): each OpenMP thread deposits on its own copy of
+                the grid and the copies are summed at the end. The number of
+                copies is limited so that each of them receives at least as
+                many particles as grid points and that they take at most
+                512 MB, the atomic deposition is used if a single copy is
+                left.
+                ``'sorted'`` (CPU and CUDA): the particles are sorted by cell
+                and the contributions of the particles in the same cell are
+                summed before being added to the grid. The two latter avoid
+                the contention of the threads on the cells in the core of the
+                beam.
+            particle_indices (int64 array): If provided, only the particles
+                with these indices are deposited (e.g. the alive particles,
+                see :meth:`alive_particle_indices`), so that the cost of the
+                deposition scales with the number of indices rather than with
+                the size of the particle arrays. Only available with the
+                ``'atomic'`` deposition.
         """
 
         if not force:
             self._assert_updatable()
 
-        if reset:
-            self.rho[:,:,:] = 0.
+        if deposition not in _deposition_strategies:
+            raise ValueError(f'deposition {deposition} not recognized, '
+                             f'use one of {_deposition_strategies}')
+
+        if particle_indices is not None:
+            if deposition != 'atomic':
+                raise NotImplementedError(
+                    'particle_indices is available only with the atomic '
+                    'deposition')
+            assert self.sort_particles_every is None, (
+                'particle_indices cannot be used with sort_particles_every '
+                '(sorting changes the order of the particles)')
 
         context = self._buffer.context
 
+        if reset and self.adaptive_grid is not None:
+            if particles is None:
+                self._adapt_grid(x_p, y_p, z_p, state_p)
+            else:
+                self._adapt_grid(particles.x, particles.y, particles.zeta,
+                                 particles.state)
+
+        if particles is not None and self.sort_particles_every is not None:
+            if self._n_updates_since_sort % self.sort_particles_every == 0:
+                self.sort_particles(particles)
+                self._n_updates_since_sort = 0
+            self._n_updates_since_sort += 1
+
+        if not reset and not self.store_rho:
+            assert self._phi_holds_rho, (
+                'Charge cannot be added: rho is not stored in this fieldmap')
+        rho_xo, rho_grid = self._rho_target()
+        rho_offset = rho_xo._offset + rho_xo._data_offset
+
+        blend_rho = (reset and self.rho_update_weight < 1
+                     and self._rho_deposited)
+        if blend_rho:
+            rho_previous = self._store_copy('_rho_previous', rho_grid)
+
+        if reset:
+            rho_grid[:,:,:] = 0.
+        self._phi_holds_rho = not self.store_rho
+
         if particles is None:
             assert (len(x_p) == len(y_p) == len(z_p) == len(ncharges_p))
-            if state_p is None:
-                state_p = context.zeros(shape=x_p.shape, dtype=np.int64) + 1
-            else:
+            if state_p is not None:
                 assert len(state_p) == len(x_p)
 
+        if self._shape_order > 1 and deposition != 'atomic':
+            raise NotImplementedError(
+                f'deposition {deposition} is not available for '
+                f'particle_shape {self.particle_shape}')
+
+        if deposition != 'atomic' or self._shape_order > 1:
+            if particles is not None:
+                assert (x_p is None and y_p is None and z_p is None
+                        and ncharges_p is None and state_p is None)
+                x_p, y_p, z_p = particles.x, particles.y, particles.zeta
+                state_p = particles.state
+                ncharges_p = particles.weight
+                q0_coulomb = particles.q0 * qe
+            if self._shape_order > 1:
+                context.kernels.p2m_rectmesh3d_shape(
+                    **self._indices_kernel_args(particle_indices, len(x_p)),
+                    x=x_p, y=y_p, z=z_p,
+                    part_weights=ncharges_p,
+                    charge_factor=q0_coulomb,
+                    **self._state_kernel_args(state_p),
+                    **self._grid_kernel_args(),
+                    shape_order=self._shape_order,
+                    grid1d_buffer=rho_xo._buffer.buffer,
+                    grid1d_offset=rho_offset)
+            elif deposition == 'private_grids':
+                self._deposit_private_grids(x_p, y_p, z_p, ncharges_p,
+                                            q0_coulomb, state_p, rho_xo)
+            else:
+                self._deposit_sorted(x_p, y_p, z_p, ncharges_p, q0_coulomb,
+                                     state_p, rho_xo)
+        elif particles is None:
+            # The weights are scaled and the state is checked in the kernel
+            # (no temporary arrays)
             context.kernels.p2m_rectmesh3d(
-                    nparticles=len(x_p),
+                    **self._indices_kernel_args(particle_indices, len(x_p)),
                     x=x_p, y=y_p, z=z_p,
-                    part_weights=q0_coulomb*ncharges_p,
-                    part_state=state_p,
+                    part_weights=ncharges_p,
+                    charge_factor=q0_coulomb,
+                    **self._state_kernel_args(state_p),
                     x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
                     dx=self.dx, dy=self.dy, dz=self.dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
-                    grid1d_buffer=self._xobject.rho._buffer.buffer,
-                    grid1d_offset=self._xobject.rho._offset
-                                 +self._xobject.rho._data_offset)
+                    grid1d_buffer=rho_xo._buffer.buffer,
+                    grid1d_offset=rho_offset)
         else:
             assert (x_p is None and y_p is None and z_p is None
                     and ncharges_p is None and state_p is None)
             context.kernels.p2m_rectmesh3d_xparticles(
-                    nparticles=particles._capacity,
+                    **self._indices_kernel_args(particle_indices,
+                                                particles._capacity),
                     particles=particles,
+                    charge_factor=particles.q0 * qe,
                     x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
                     dx=self.dx, dy=self.dy, dz=self.dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
-                    grid1d_buffer=self._xobject.rho._buffer.buffer,
-                    grid1d_offset=self._xobject.rho._offset
-                                 +self._xobject.rho._data_offset)
+                    grid1d_buffer=rho_xo._buffer.buffer,
+                    grid1d_offset=rho_offset)
 
         if hasattr(self, '_average_transverse_distribution'):
             raise NotImplementedError(
                 '`_average_transverse_distribution` has been removed, '
                 'use `solver=FFTSolver2p5DAveraged` instead')
 
+        if blend_rho:
+            # Exponential moving average of the charge density
+            rho_grid *= self.rho_update_weight
+            rho_previous *= 1 - self.rho_update_weight
+            rho_grid += rho_previous
+        self._rho_deposited = True
+
         if update_phi:
-            self.update_phi_from_rho(solver=solver)
+            if self._rho_change_below_threshold():
+                self._n_solves_skipped += 1
+            else:
+                self.update_phi_from_rho(solver=solver)
+
+    def _store_copy(self, name, grid):
+
+        # Copies a grid in an array allocated at the first call and kept in
+        # the attribute `name`
+        stored = getattr(self, name)
+        if stored is None:
+            stored = grid.copy()
+            setattr(self, name, stored)
+        else:
+            stored[:,:,:] = grid
+        return stored
+
+    def _rho_change_below_threshold(self):
+
+        # True if the charge density changed less than rho_change_threshold
+        # since the last solve
+        if self.rho_change_threshold is None or self._rho_at_last_solve is None:
+            return False
+        change = _relative_change(self._buffer.context, self.rho,
+                                  self._rho_at_last_solve)
+        return change <= self.rho_change_threshold
+
+    def sort_particles(self, particles):
+
+        """
+        Reorders in place the particles by grid cell, so that particles close
+        to each other in space are close in memory. The active particles are
+        sorted by cell index (the ones outside the grid are placed after
+        them) and the lost particles are moved to the end of the arrays. The
+        order of the particles in the particles object is changed, the
+        ``particle_id`` can be used to identify them.
+
+        Args:
+            particles (xtrack.Particles): xtrack particle object.
+        Returns:
+            (array): Permutation applied to the active particles (new to old
+            position).
+        """
+
+        context = self._buffer.context
+        if isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                'Sorting the particles is not available on PyOpenCL')
+        _compile_deposition_kernels(context)
+        nplike = context.nplike_lib
+
+        n_active, _ = particles.reorganize()
+
+        cell_index = context.zeros(n_active, dtype=np.int64)
+        if n_active > 0:
+            context.kernels.p2m_rectmesh3d_cell_index(
+                    nparticles=n_active,
+                    x=particles.x, y=particles.y, z=particles.zeta,
+                    **self._state_kernel_args(particles.state),
+                    **self._grid_kernel_args(),
+                    cell_index=cell_index)
+        # Particles outside the grid after the others
+        cell_index[cell_index < 0] = self.nx*self.ny*self.nz
+        sorted_index = nplike.argsort(cell_index)
+
+        with particles._bypass_linked_vars():
+            for tt, nn in particles.per_particle_vars:
+                if nn.startswith('_rng'):
+                    continue
+                vv = getattr(particles, nn)
+                vv[:n_active] = vv[:n_active][sorted_index]
+
+        return sorted_index
+
+    def _grid_kernel_args(self):
+        return dict(x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz)
+
+    def _int64_placeholder(self):
+
+        # Passed to the kernels in place of an optional int64 array
+        if self._placeholder is None:
+            self._placeholder = self._buffer.context.zeros(1, dtype=np.int64)
+        return self._placeholder
+
+    def _state_kernel_args(self, state):
+
+        # Arguments of the deposition kernels for the particle state. If no
+        # state is given all particles are deposited and a placeholder array
+        # is passed to the kernel.
+        if state is not None:
+            return dict(part_state=state, use_state=1)
+        return dict(part_state=self._int64_placeholder(), use_state=0)
+
+    def _indices_kernel_args(self, indices, nparticles):
+
+        # Arguments of the deposition kernels for an optional list of
+        # particle indices
+        if indices is not None:
+            return dict(nparticles=len(indices), indices=indices,
+                        use_indices=1)
+        return dict(nparticles=nparticles, indices=self._int64_placeholder(),
+                    use_indices=0)
+
+    def alive_particle_indices(self, particles):
+
+        """
+        Returns the indices of the alive particles, to be passed as
+        ``particle_indices`` to :meth:`update_from_particles` and as
+        ``indices`` to :meth:`gather_at_points`. It can be computed once and
+        reused for as long as no particle is lost.
+
+        Args:
+            particles (xtrack.Particles): xtrack particle object.
+        Returns:
+            (int64 array): Indices of the particles with state > 0.
+        """
+
+        context = self._buffer.context
+        if isinstance(context, xo.ContextPyopencl):
+            state = context.nparray_from_context_array(particles.state)
+            return context.nparray_to_context_array(
+                np.flatnonzero(state > 0).astype(np.int64))
+        return context.nplike_lib.flatnonzero(
+                                    particles.state > 0).astype(np.int64)
+
+    def _deposit_private_grids(self, x, y, z, part_weights, charge_factor,
+                               state, rho_xo):
+
+        context = self._buffer.context
+        if not isinstance(context, xo.ContextCpu):
+            raise NotImplementedError(
+                'deposition `private_grids` is available only on CPU, '
+                'use `sorted` instead')
+        _compile_deposition_kernels(context)
+
+        n_grids = self._n_private_grids(len(x))
+        if n_grids == 1:
+            # A single copy of the grid brings no gain
+            context.kernels.p2m_rectmesh3d(
+                    **self._indices_kernel_args(None, len(x)),
+                    x=x, y=y, z=z,
+                    part_weights=part_weights,
+                    charge_factor=charge_factor,
+                    **self._state_kernel_args(state),
+                    **self._grid_kernel_args(),
+                    grid1d_buffer=rho_xo._buffer.buffer,
+                    grid1d_offset=rho_xo._offset + rho_xo._data_offset)
+            return
+
+        nelem = self.nx*self.ny*self.nz
+        if (self._private_grids is None
+                or self._private_grids.size != n_grids*nelem):
+            self._private_grids = np.zeros(n_grids*nelem, dtype=np.float64)
+
+        context.kernels.p2m_rectmesh3d_private_grids(
+                nparticles=len(x),
+                x=x, y=y, z=z,
+                part_weights=part_weights,
+                charge_factor=charge_factor,
+                **self._state_kernel_args(state),
+                **self._grid_kernel_args(),
+                n_grids=n_grids,
+                private_grids=self._private_grids,
+                grid1d_buffer=rho_xo._buffer.buffer,
+                grid1d_offset=rho_xo._offset + rho_xo._data_offset)
+
+    def _n_private_grids(self, nparticles):
+
+        # One copy of the grid per thread, as long as zeroing and summing the
+        # copies costs less than the deposition and they fit the memory budget
+        omp_num_threads = self._buffer.context.omp_num_threads
+        if omp_num_threads == 'auto':
+            n_threads = os.cpu_count() or 1
+        elif omp_num_threads > 0:
+            n_threads = omp_num_threads
+        else:
+            n_threads = 1
+
+        nelem = self.nx*self.ny*self.nz
+        return max(1, min(n_threads, nparticles // nelem,
+                          _private_grids_max_bytes // (8 * nelem)))
+
+    def _deposit_sorted(self, x, y, z, part_weights, charge_factor, state,
+                        rho_xo):
+
+        context = self._buffer.context
+        if isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                'deposition `sorted` is not available on PyOpenCL')
+        _compile_deposition_kernels(context)
+        nplike = context.nplike_lib
+
+        nparticles = len(x)
+        cell_index = context.zeros(nparticles, dtype=np.int64)
+        context.kernels.p2m_rectmesh3d_cell_index(
+                nparticles=nparticles,
+                x=x, y=y, z=z,
+                **self._state_kernel_args(state),
+                **self._grid_kernel_args(),
+                cell_index=cell_index)
+
+        # Segments of particles in the same cell
+        sorted_particles = nplike.argsort(cell_index).astype(np.int64)
+        sorted_cells = cell_index[sorted_particles]
+        segment_start = nplike.concatenate([
+                nplike.zeros(1, dtype=np.int64),
+                nplike.flatnonzero(nplike.diff(sorted_cells) != 0) + 1,
+                nplike.full(1, nparticles, dtype=np.int64)]).astype(np.int64)
+        n_segments = len(segment_start) - 1
+        if n_segments <= 0:
+            return
+
+        context.kernels.p2m_rectmesh3d_sorted(
+                n_segments=n_segments,
+                segment_start=segment_start,
+                sorted_particles=sorted_particles,
+                cell_index=cell_index,
+                x=x, y=y, z=z,
+                part_weights=part_weights,
+                charge_factor=charge_factor,
+                **self._grid_kernel_args(),
+                grid1d_buffer=rho_xo._buffer.buffer,
+                grid1d_offset=rho_xo._offset + rho_xo._data_offset)
+
+    def _adapt_grid(self, x, y, z, state):
+
+        """
+        Moves and rescales the grid in the planes listed in ``adaptive_grid``
+        so that the alive particles cover a fraction ``grid_coverage`` of it,
+        and selects the corresponding solver.
+        """
+
+        context = self._buffer.context
+        k_max = int(np.floor(self.grid_steps_per_octave
+                             * np.log2(self.max_grid_rescale)))
+
+        grids = [self.x_grid, self.y_grid, self.z_grid]
+        steps = list(self._grid_steps)
+        for ii, (vname, coord) in enumerate(zip('xyz', (x, y, z))):
+            if vname not in self.adaptive_grid:
+                continue
+            v_min, v_max = _alive_extent(context, coord, state)
+            if not np.isfinite(v_min):
+                return # No alive particles, grid unchanged
+            nv = len(grids[ii])
+            dv_ref = self._initial_cell_sizes[ii]
+            dv_needed = (v_max - v_min) / self.grid_coverage / (nv - 1)
+            if dv_needed > 0:
+                kk = int(np.round(self.grid_steps_per_octave
+                                  * np.log2(dv_needed / dv_ref)))
+            else:
+                kk = -k_max
+            steps[ii] = int(np.clip(kk, -k_max, k_max))
+            dv = dv_ref * 2**(steps[ii] / self.grid_steps_per_octave)
+            v_start = 0.5 * (v_min + v_max) - 0.5 * (nv - 1) * dv
+            grids[ii] = v_start + np.arange(nv) * dv
+
+        self._x_grid, self._y_grid, self._z_grid = grids
+        self._x_min = self._x_grid[0]
+        self._y_min = self._y_grid[0]
+        self._z_min = self._z_grid[0]
+        self._dx = self.dx
+        self._dy = self.dy
+        self._dz = self.dz
+
+        self._grid_steps = tuple(steps)
+        solvers = self._adaptive_solvers
+        if self._grid_steps in solvers:
+            solvers.move_to_end(self._grid_steps)
+        else:
+            # Drop the current solver before generating the new one, so that
+            # the memory of its Green function can be reused
+            self.solver = None
+            while len(solvers) >= self.max_adaptive_solvers:
+                solvers.popitem(last=False)
+            solvers[self._grid_steps] = self.generate_solver(
+                    self._adaptive_solver_name, fftplan=None,
+                    dtype=self._adaptive_solver_dtype)
+        self.solver = solvers[self._grid_steps]
 
     def update_rho(self, rho, reset=True, force=False):
         """
@@ -407,7 +1174,9 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             self._assert_updatable()
 
         if reset:
-            self.rho[:,:,:] = rho
+            self._rho_target()[1][:,:,:] = rho
+            self._phi_holds_rho = not self.store_rho
+            self._rho_deposited = True
         else:
             raise ValueError('Not implemented!')
 
@@ -434,43 +1203,31 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             self.phi.T[:,:,:] = phi.T
         else:
             raise ValueError('Not implemented!')
+        self._phi_holds_rho = False
 
-        context = self._buffer.context
+        self._update_phi_derivatives()
 
-        # Compute gradient
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nx,
-                stride_in_dbl = self.phi.strides[0]/8,
-                factor = 1/(2*self.dx),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dx._buffer.buffer,
-                res_offset = (self._xobject.dphi_dx._offset
-                            + self._xobject.dphi_dx._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.ny,
-                stride_in_dbl = self.phi.strides[1]/8,
-                factor = 1/(2*self.dy),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dy._buffer.buffer,
-                res_offset = (self._xobject.dphi_dy._offset
-                            + self._xobject.dphi_dy._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nz,
-                stride_in_dbl = self.phi.strides[2]/8,
-                factor = 1/(2*self.dz),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dz._buffer.buffer,
-                res_offset = (self._xobject.dphi_dz._offset
-                            + self._xobject.dphi_dz._data_offset))
+    def _update_phi_derivatives(self):
+
+        # Compute gradient (single pass over phi)
+        context = self._buffer.context
+        xobj = self._xobject
+        if self.store_dphi_dz:
+            res_z_offset = xobj.dphi_dz._offset + xobj.dphi_dz._data_offset
+        else:
+            res_z_offset = 0
+        context.kernels.central_diff_3d(
+                nx=self.nx, ny=self.ny, nz=self.nz,
+                nelem=self.nx*self.ny*self.nz,
+                factor_x=1/(2*self.dx),
+                factor_y=1/(2*self.dy),
+                factor_z=1/(2*self.dz),
+                with_z=int(self.store_dphi_dz),
+                buffer=xobj._buffer.buffer,
+                matrix_offset=xobj.phi._offset + xobj.phi._data_offset,
+                res_x_offset=xobj.dphi_dx._offset + xobj.dphi_dx._data_offset,
+                res_y_offset=xobj.dphi_dy._offset + xobj.dphi_dy._data_offset,
+                res_z_offset=res_z_offset)
 
     #@profile
     def update_phi_from_rho(self, solver=None):
@@ -494,18 +1251,63 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             else:
                 raise ValueError('I have no solver to compute phi!')
 
-        new_phi = solver.solve(self.rho)
-        self.update_phi(new_phi)
+        if not self.store_rho:
+            assert self._phi_holds_rho, (
+                'rho is not stored in this fieldmap and has been overwritten '
+                'by phi')
+
+        rho = self._rho_target()[1]
+        if self.rho_change_threshold is not None:
+            self._store_copy('_rho_at_last_solve', rho)
+        if hasattr(solver, 'solve_into'):
+            # The solver writes directly in the buffer of the fieldmap
+            solver.solve_into(rho, self.phi)
+        else:
+            self.phi.T[:,:,:] = solver.solve(rho).T
+        self._phi_holds_rho = False
+        self._update_phi_derivatives()
+
+    def update_phi_from_rho_async(self, solver=None):
+
+        """
+        Same as :meth:`update_phi_from_rho`, but without blocking the caller.
+        The solve and the computation of the derivatives are executed by a
+        thread pool (on GPU in a separate CUDA stream), so that they can
+        overlap with other work, e.g. the charge deposition of another bunch
+        on another fieldmap. The charge density must not be modified and the
+        potential must not be used before the returned future is done.
+
+        Args:
+            solver (Solver object): solver object to be used to solve Poisson's
+                equation. If ``None`` is provided the solver attached to the fieldmap
+                is used (if any). The default is ``None``.
+        Returns:
+            (concurrent.futures.Future): Future whose result is ``None``.
+        """
+
+        self._assert_updatable()
+
+        if solver is None:
+            if hasattr(self, 'solver'):
+                solver = self.solver
+            else:
+                raise ValueError('I have no solver to compute phi!')
+
+        return _submit_async(self._buffer.context,
+                             lambda: self.update_phi_from_rho(solver=solver))
 
-    def generate_solver(self, solver, fftplan):
+    def generate_solver(self, solver, fftplan, dtype=np.float64):
 
         """
         Generates a Poisson solver associated to the defined grid.
 
         Args:
             solver (str): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DAveraged``, ``RFFTSolver3D``,
+            ``RFFTSolver2p5D`` and ``DSTSolver2p5D``.
+            dtype (np.dtype): Floating point precision of the solver,
+            ``np.float64`` (default) or ``np.float32``.
         Returns:
             (Solver): Solver object associated to the defined grid.
         """
@@ -519,7 +1321,8 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                     dz=self.dz*scale_dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan,
+                    dtype=dtype)
         elif solver == 'FFTSolver2p5D':
             solver = FFTSolver2p5D(
                     dx=self.dx*scale_dx,
@@ -527,7 +1330,8 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                     dz=self.dz*scale_dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan,
+                    dtype=dtype)
         elif solver == 'FFTSolver2p5DAveraged':
             solver = FFTSolver2p5DAveraged(
                     dx=self.dx*scale_dx,
@@ -535,7 +1339,32 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                     dz=self.dz*scale_dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan,
+                    dtype=dtype)
+        elif solver == 'RFFTSolver3D':
+            solver = RFFTSolver3D(
+                    dx=self.dx*scale_dx,
+                    dy=self.dy*scale_dy,
+                    dz=self.dz*scale_dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    context=self._buffer.context,
+                    dtype=dtype)
+        elif solver == 'RFFTSolver2p5D':
+            solver = RFFTSolver2p5D(
+                    dx=self.dx*scale_dx,
+                    dy=self.dy*scale_dy,
+                    dz=self.dz*scale_dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    context=self._buffer.context,
+                    dtype=dtype)
+        elif solver == 'DSTSolver2p5D':
+            solver = DSTSolver2p5D(
+                    dx=self.dx*scale_dx,
+                    dy=self.dy*scale_dy,
+                    dz=self.dz*scale_dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    context=self._buffer.context,
+                    dtype=dtype)
         else:
             raise ValueError(f'solver name {solver} not recognized')
 
@@ -607,6 +1436,12 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
     # TODO: these reshapes can be avoided by allocating 3d arrays directly in the xobject
     @property
     def rho(self):
+        """
+        Charge density at the grid points in Coulomb/m^3.
+        """
+        if not self.store_rho:
+            raise ValueError('rho is not stored in this fieldmap '
+                             '(store_rho=False)')
         return self._rho.reshape(
                 (self.nx, self.ny, self.nz), order='F')
 
@@ -630,10 +1465,60 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
     @property
     def dphi_dz(self):
+        if not self.store_dphi_dz:
+            raise ValueError('dphi_dz is not stored in this fieldmap '
+                             '(store_dphi_dz=False)')
         return self._dphi_dz.reshape(
                 (self.nx, self.ny, self.nz), order='F')
 
 
+def _compile_deposition_kernels(context):
+    if all(nn in context.kernels.keys() for nn in _deposition_kernels):
+        return
+    context.add_kernels(
+        sources=[
+            _pkg_root.joinpath('headers/constants.h'),
+            xt.general._pkg_root.joinpath('headers/atomicadd.h'),
+            _pkg_root.joinpath(
+                'fieldmaps/interpolated_src/charge_deposition_strategies.h'),
+            ],
+        kernels=_deposition_kernels)
+
+def _alive_extent(context, coord, state):
+
+    # Minimum and maximum coordinate of the alive particles (inf, -inf if
+    # there are none). All particles are alive if state is None.
+    if isinstance(context, xo.ContextPyopencl):
+        coord = context.nparray_from_context_array(coord)
+        if state is not None:
+            state = context.nparray_from_context_array(state)
+        nplike = np
+    else:
+        nplike = context.nplike_lib
+
+    if state is None:
+        return float(coord.min()), float(coord.max())
+
+    alive = state > 0
+    v_min = float(nplike.where(alive, coord, nplike.inf).min())
+    v_max = float(nplike.where(alive, coord, -nplike.inf).max())
+
+    return v_min, v_max
+
+def _relative_change(context, new, ref):
+
+    # Relative difference (L2 norm) between two grids
+    if isinstance(context, xo.ContextPyopencl):
+        new = context.nparray_from_context_array(new)
+        ref = context.nparray_from_context_array(ref)
+        nplike = np
+    else:
+        nplike = context.nplike_lib
+
+    norm_ref = float(nplike.linalg.norm(ref))
+    if norm_ref == 0:
+        return np.inf
+    return float(nplike.linalg.norm(new - ref)) / norm_ref
 
 def _configure_grid(vname, v_grid, dv, v_range, nv):
 
@@ -36,4 +36,68 @@ void central_diff(
 
 }
 
+// Computes the three components of the gradient of a Fortran ordered 3D
+// matrix in a single pass (same result as three calls to central_diff).
+// The longitudinal component is skipped if with_z is zero.
+/*gpukern*/
+void central_diff_3d(
+	      const int     nx,
+	      const int     ny,
+	      const int     nz,
+	      const int     nelem,
+	      const double  factor_x,
+	      const double  factor_y,
+	      const double  factor_z,
+	      const int     with_z,
+/*gpuglmem*/        int8_t* buffer,
+              const int64_t matrix_offset,
+              const int64_t res_x_offset,
+              const int64_t res_y_offset,
+              const int64_t res_z_offset
+              ){
+
+   /*gpuglmem*/ const double* matrix =
+	           (/*gpuglmem*/ double*) (buffer + matrix_offset);
+   /*gpuglmem*/       double*  res_x =
+	           (/*gpuglmem*/ double*) (buffer + res_x_offset);
+   /*gpuglmem*/       double*  res_y =
+	           (/*gpuglmem*/ double*) (buffer + res_y_offset);
+   /*gpuglmem*/       double*  res_z =
+	           (/*gpuglmem*/ double*) (buffer + res_z_offset);
+
+   const int stride_z = nx*ny;
+
+   #pragma omp parallel for //only_for_context cpu_openmp
+   for(int ii=0; ii<nelem; ii++){//vectorize_over ii nelem
+      const int ix = ii % nx;
+      const int iy = (ii / nx) % ny;
+      const int iz = ii / stride_z;
+
+      if (ix==0 || ix==nx-1){
+         res_x[ii] = 0;
+      }
+      else{
+         res_x[ii] = factor_x * (matrix[ii+1] - matrix[ii-1]);
+      }
+
+      if (iy==0 || iy==ny-1){
+         res_y[ii] = 0;
+      }
+      else{
+         res_y[ii] = factor_y * (matrix[ii+nx] - matrix[ii-nx]);
+      }
+
+      if (with_z){
+         if (iz==0 || iz==nz-1){
+            res_z[ii] = 0;
+         }
+         else{
+            res_z[ii] = factor_z * (matrix[ii+stride_z]
+                                    - matrix[ii-stride_z]);
+         }
+      }
+   }//end_vectorize
+
+}
+
 #endif
@@ -69,9 +69,15 @@
         /*gpuglmem*/ const double* x, 
 	/*gpuglmem*/ const double* y, 
 	/*gpuglmem*/ const double* z,
-	  // particle weights and stat flags
+	  // particle weights (multiplied by charge_factor) and state flags
+	  // (ignored if use_state is zero)
 	/*gpuglmem*/ const double* part_weights,
+	             const double  charge_factor,
 	/*gpuglmem*/ const int64_t* part_state,
+	             const int     use_state,
+	  // indices of the particles to deposit (all if use_indices is zero)
+	/*gpuglmem*/ const int64_t* indices,
+	             const int     use_indices,
           // mesh origin
         const double x0, const double y0, const double z0,
           // mesh distances per cell
@@ -86,9 +92,10 @@
 		(/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
 
     #pragma omp parallel for //only_for_context cpu_openmp 
-    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
-        if (part_state[pidx] > 0){
-    	    double pwei = part_weights[pidx];
+    for (int ii=0; ii<nparticles; ii++){ //vectorize_over ii nparticles
+        const int64_t pidx = use_indices ? indices[ii] : ii;
+        if (!use_state || part_state[pidx] > 0){
+    	    double pwei = part_weights[pidx] * charge_factor;
 
             p2m_rectmesh3d_one_particle(x[pidx], y[pidx], z[pidx], pwei,
                                         x0, y0, z0, dx, dy, dz, nx, ny, nz,
@@ -102,6 +109,12 @@
           // length of x, y, z arrays
         const int nparticles,
 	ParticlesData particles,
+	  // charge of the reference particle in Coulomb (the same constant
+	  // as in the deposition from arrays is used)
+	             const double  charge_factor,
+	  // indices of the particles to deposit (all if use_indices is zero)
+	/*gpuglmem*/ const int64_t* indices,
+	             const int     use_indices,
           // mesh origin
         const double x0, const double y0, const double z0,
           // mesh distances per cell
@@ -123,12 +136,12 @@
     /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
     		                                             particles, 0);
     // TODO I am forgetting about charge_ratio and mass_ratio
-    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
 
     #pragma omp parallel for //only_for_context cpu_openmp 
-    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+    for (int ii=0; ii<nparticles; ii++){ //vectorize_over ii nparticles
+        const int64_t pidx = use_indices ? indices[ii] : ii;
         if (part_state[pidx] > 0){
-    	    double pwei = part_weights[pidx] * q0_coulomb;
+    	    double pwei = part_weights[pidx] * charge_factor;
 
             p2m_rectmesh3d_one_particle(x[pidx], y[pidx], z[pidx], pwei,
                                         x0, y0, z0, dx, dy, dz, nx, ny, nz,
@@ -0,0 +1,216 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_CHARGE_DEPOSITION_STRATEGIES_H
+#define XFIELDS_CHARGE_DEPOSITION_STRATEGIES_H
+
+// Alternatives to the atomic deposition in charge_deposition.h, reducing the
+// contention on the cells in the core of the beam.
+
+// Computes the index of the lower corner of the cell containing the particle
+// and the weights of the eight corners (same ordering as in grid1d). Returns
+// -1 (and zero weights) if the particle is outside the grid.
+/*gpufun*/ int64_t p2m_rectmesh3d_cell_and_weights(
+        const double x, const double y, const double z,
+        const double pwei,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        double* w){
+
+    // indices
+    int jx = floor((x - x0) / dx);
+    int ix = floor((y - y0) / dy);
+    int kx = floor((z - z0) / dz);
+
+    if (!(jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
+                && kx >= 0 && kx < nz - 1)){
+        for (int iw=0; iw<8; iw++){
+            w[iw] = 0.;
+        }
+        return -1;
+    }
+
+    double vol_m1 = 1/(dx*dy*dz);
+
+    // distances
+    double dxi = x - (x0 + jx * dx);
+    double dyi = y - (y0 + ix * dy);
+    double dzi = z - (z0 + kx * dz);
+
+    // weights
+    w[0] = pwei * vol_m1 * (1.-dxi/dx) * (1.-dyi/dy) * (1.-dzi/dz);
+    w[1] = pwei * vol_m1 * (dxi/dx)    * (1.-dyi/dy) * (1.-dzi/dz);
+    w[2] = pwei * vol_m1 * (1.-dxi/dx) * (dyi/dy)    * (1.-dzi/dz);
+    w[3] = pwei * vol_m1 * (dxi/dx)    * (dyi/dy)    * (1.-dzi/dz);
+    w[4] = pwei * vol_m1 * (1.-dxi/dx) * (1.-dyi/dy) * (dzi/dz);
+    w[5] = pwei * vol_m1 * (dxi/dx)    * (1.-dyi/dy) * (dzi/dz);
+    w[6] = pwei * vol_m1 * (1.-dxi/dx) * (dyi/dy)    * (dzi/dz);
+    w[7] = pwei * vol_m1 * (dxi/dx)    * (dyi/dy)    * (dzi/dz);
+
+    return jx + ix*nx + ((int64_t) kx)*nx*ny;
+}
+
+// Each OpenMP thread deposits in its own copy of the grid, the copies are
+// summed at the end (no atomic operations). CPU only.
+/*gpukern*/ void p2m_rectmesh3d_private_grids(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x,
+        /*gpuglmem*/ const double* y,
+        /*gpuglmem*/ const double* z,
+          // particle weights (multiplied by charge_factor) and state flags
+          // (ignored if use_state is zero)
+        /*gpuglmem*/ const double* part_weights,
+                     const double  charge_factor,
+        /*gpuglmem*/ const int64_t* part_state,
+                     const int     use_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // number of private grids (at least the number of threads)
+        const int n_grids,
+        // WORK ARRAY (n_grids * nx * ny * nz):
+        /*gpuglmem*/ double* private_grids,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+                     int64_t  grid1d_offset){
+
+    /*gpuglmem*/ double* grid1d =
+                (/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    const int64_t nelem = ((int64_t) nx) * ny * nz;
+    const int64_t nx_ny = ((int64_t) nx) * ny;
+
+    #pragma omp parallel num_threads(n_grids) //only_for_context cpu_openmp
+    {
+        int tid = 0;
+        tid = omp_get_thread_num(); //only_for_context cpu_openmp
+        double* my_grid = private_grids + tid * nelem;
+
+        #pragma omp for //only_for_context cpu_openmp
+        for (int64_t ii=0; ii<n_grids*nelem; ii++){
+            private_grids[ii] = 0;
+        }
+
+        #pragma omp for //only_for_context cpu_openmp
+        for (int pidx=0; pidx<nparticles; pidx++){
+            if (!use_state || part_state[pidx] > 0){
+                double w[8];
+                const int64_t cell = p2m_rectmesh3d_cell_and_weights(
+                                x[pidx], y[pidx], z[pidx],
+                                part_weights[pidx] * charge_factor,
+                                x0, y0, z0, dx, dy, dz, nx, ny, nz, w);
+                if (cell >= 0){
+                    my_grid[cell]                  += w[0];
+                    my_grid[cell + 1]              += w[1];
+                    my_grid[cell + nx]             += w[2];
+                    my_grid[cell + nx + 1]         += w[3];
+                    my_grid[cell + nx_ny]          += w[4];
+                    my_grid[cell + nx_ny + 1]      += w[5];
+                    my_grid[cell + nx_ny + nx]     += w[6];
+                    my_grid[cell + nx_ny + nx + 1] += w[7];
+                }
+            }
+        }
+
+        // Reduction
+        #pragma omp for //only_for_context cpu_openmp
+        for (int64_t ii=0; ii<nelem; ii++){
+            double sum = 0;
+            for (int ig=0; ig<n_grids; ig++){
+                sum += private_grids[ig * nelem + ii];
+            }
+            grid1d[ii] += sum;
+        }
+    }
+}
+
+// Index of the lower corner of the cell of each particle (-1 for lost
+// particles and particles outside the grid), used to sort the particles.
+/*gpukern*/ void p2m_rectmesh3d_cell_index(
+        const int nparticles,
+        /*gpuglmem*/ const double* x,
+        /*gpuglmem*/ const double* y,
+        /*gpuglmem*/ const double* z,
+        /*gpuglmem*/ const int64_t* part_state,
+        const int use_state,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        /*gpuglmem*/ int64_t* cell_index){
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        int64_t cell = -1;
+        if (!use_state || part_state[pidx] > 0){
+            double w[8];
+            cell = p2m_rectmesh3d_cell_and_weights(
+                                x[pidx], y[pidx], z[pidx], 0.,
+                                x0, y0, z0, dx, dy, dz, nx, ny, nz, w);
+        }
+        cell_index[pidx] = cell;
+    }//end_vectorize
+}
+
+// Deposition of particles sorted by cell: the contributions of the particles
+// in the same cell (segment) are summed before being added to the grid,
+// so that only eight atomic additions per occupied cell are needed.
+/*gpukern*/ void p2m_rectmesh3d_sorted(
+        const int n_segments,
+        /*gpuglmem*/ const int64_t* segment_start,
+        /*gpuglmem*/ const int64_t* sorted_particles,
+        /*gpuglmem*/ const int64_t* cell_index,
+        /*gpuglmem*/ const double* x,
+        /*gpuglmem*/ const double* y,
+        /*gpuglmem*/ const double* z,
+        /*gpuglmem*/ const double* part_weights,
+        const double charge_factor,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+                     int64_t  grid1d_offset){
+
+    /*gpuglmem*/ double* grid1d =
+                (/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    const int64_t nx_ny = ((int64_t) nx) * ny;
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int iseg=0; iseg<n_segments; iseg++){ //vectorize_over iseg n_segments
+        const int64_t cell = cell_index[sorted_particles[segment_start[iseg]]];
+        if (cell >= 0){
+            double w_sum[8] = {0., 0., 0., 0., 0., 0., 0., 0.};
+            for (int64_t ip=segment_start[iseg]; ip<segment_start[iseg+1];
+                                                                        ip++){
+                const int64_t pidx = sorted_particles[ip];
+                double w[8];
+                p2m_rectmesh3d_cell_and_weights(
+                        x[pidx], y[pidx], z[pidx],
+                        part_weights[pidx] * charge_factor,
+                        x0, y0, z0, dx, dy, dz, nx, ny, nz, w);
+                for (int iw=0; iw<8; iw++){
+                    w_sum[iw] += w[iw];
+                }
+            }
+            atomicAdd(&grid1d[cell],                  w_sum[0]);
+            atomicAdd(&grid1d[cell + 1],              w_sum[1]);
+            atomicAdd(&grid1d[cell + nx],             w_sum[2]);
+            atomicAdd(&grid1d[cell + nx + 1],         w_sum[3]);
+            atomicAdd(&grid1d[cell + nx_ny],          w_sum[4]);
+            atomicAdd(&grid1d[cell + nx_ny + 1],      w_sum[5]);
+            atomicAdd(&grid1d[cell + nx_ny + nx],     w_sum[6]);
+            atomicAdd(&grid1d[cell + nx_ny + nx + 1], w_sum[7]);
+        }
+    }//end_vectorize
+}
+
+#endif
@@ -6,38 +6,139 @@
 #ifndef XFIELDS_CUBIC_INTERPOLATORS_H
 #define XFIELDS_CUBIC_INTERPOLATORS_H
 
+// Value number l of phi_taylor at the node inode (in slice iz), converted to
+// double precision from the storage type of the map
+/*gpufun*/
+double TriCubicInterpolatedFieldMap_phi_taylor_at(
+	TriCubicInterpolatedFieldMapData fmap, const int64_t storage,
+	   const int64_t l, const int64_t inode, const int64_t iz){
+
+    const int64_t index = l + 8 * inode;
+    if (storage == 1){
+        return (double) TriCubicInterpolatedFieldMapData_get_phi_taylor_f32(fmap, index);
+    }
+    else if (storage == 2){
+        return TriCubicInterpolatedFieldMapData_get_phi_taylor_scale(fmap, l + 8 * iz)
+               * (double) TriCubicInterpolatedFieldMapData_get_phi_taylor_i16(fmap, index);
+    }
+    return TriCubicInterpolatedFieldMapData_get_phi_taylor(fmap, index);
+}
+
 /*gpufun*/
 void TriCubicInterpolatedFieldMap_construct_b(
 	TriCubicInterpolatedFieldMapData fmap,
 	   const int64_t ix, const int64_t iy, const int64_t iz, 
        double* b_vector){
 
-    /*gpuglmem*/ double* phi_taylor = TriCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
     // Optimization TODO: change int64 to int for less register pressure?
     const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
     const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+    const int64_t storage = TriCubicInterpolatedFieldMapData_get_phi_taylor_storage(fmap);
 
-    // Optimization TODO: reorganize b_vector to align memory access
-    for(int l = 0; l < 8; l++)
+    // Corners of the cell in the order (x, y, z) = (0,0,0), (1,0,0), (0,1,0),
+    // (1,1,0), (0,0,1), ...
+    for(int corner = 0; corner < 8; corner++)
     {
-        const int m = 8 * l;
-        b_vector[m    ] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy    ) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 1] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy    ) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 2] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy + 1) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 3] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy + 1) + ny * ( (iz    ) ) ) ) ];
-        b_vector[m + 4] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy    ) + ny * ( (iz + 1) ) ) ) ];
-        b_vector[m + 5] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy    ) + ny * ( (iz + 1) ) ) ) ];
-        b_vector[m + 6] = phi_taylor[ l + 8 * ( (ix    ) + nx * ( (iy + 1) + ny * ( (iz + 1) ) ) ) ];
-        b_vector[m + 7] = phi_taylor[ l + 8 * ( (ix + 1) + nx * ( (iy + 1) + ny * ( (iz + 1) ) ) ) ];
+        const int64_t jx = ix + (corner & 1);
+        const int64_t jy = iy + ((corner >> 1) & 1);
+        const int64_t jz = iz + ((corner >> 2) & 1);
+        const int64_t inode = jx + nx * ( jy + ny * jz );
+        for(int l = 0; l < 8; l++)
+        {
+            b_vector[8 * l + corner] = TriCubicInterpolatedFieldMap_phi_taylor_at(
+                                            fmap, storage, l, inode, jz);
+        }
     }
     return ;
 }
 
+// Position in the coefficient cache of the cell with lower corner
+// (ix, iy, iz), or -1 if its coefficients are not cached
 /*gpufun*/
-int TriCubicInterpolatedFieldMap_interpolate_grad(
+int64_t TriCubicInterpolatedFieldMap_cached_slot(
 	TriCubicInterpolatedFieldMapData fmap,
-	   const double x, const double y, const double z, 
-	   double* dphi_dx, double* dphi_dy, double* dphi_dtau){
+	   const int64_t ix, const int64_t iy, const int64_t iz){
+
+    if (TriCubicInterpolatedFieldMapData_len_coefficient_slots(fmap) == 0){
+        return -1;
+    }
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+    return TriCubicInterpolatedFieldMapData_get_coefficient_slots(fmap,
+                    ix + (nx - 1) * (iy + (ny - 1) * iz));
+}
+
+// Computes the coefficients of the interpolating polynomial of the listed
+// cells and stores them in the cache, in the order of the list
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_fill_coefficient_cache(
+    TriCubicInterpolatedFieldMapData fmap,
+                        const int64_t  n_cells,
+           /*gpuglmem*/ const int64_t* cells){
+
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int ii=0; ii<n_cells; ii++){ //vectorize_over ii n_cells
+        const int64_t cell = cells[ii];
+        const int64_t ix = cell % (nx - 1);
+        const int64_t iy = (cell / (nx - 1)) % (ny - 1);
+        const int64_t iz = cell / ((nx - 1) * (ny - 1));
+
+        double b_vector[64];
+        TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+        double coefs[64];
+        TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+
+        /*gpuglmem*/ double* cached =
+            TriCubicInterpolatedFieldMapData_getp1_coefficients(fmap, 64 * ii);
+        for (int ll = 0; ll < 64; ll++){
+            cached[ll] = coefs[ll];
+        }
+    }//end_vectorize
+}
+
+// Evaluates the tricubic polynomial with coefficients coefs[i + 4*j + 16*k]
+// and its derivatives with respect to the normalized coordinates in one
+// Horner pass (first along x, then y, then z). phi can be NULL.
+/*gpufun*/
+void TriCubicInterpolatedFieldMap_eval_polynomial(const double* coefs,
+	   const double xn, const double yn, const double zn,
+	   double* phi, double* dphi_dxn, double* dphi_dyn, double* dphi_dzn){
+
+    double p = 0., p_x = 0., p_y = 0., p_z = 0.;
+    for (int k = 3; k >= 0; k--){
+        double q = 0., q_x = 0., q_y = 0.;
+        for (int j = 3; j >= 0; j--){
+            const double* c = coefs + 4 * j + 16 * k;
+            const double r = ((c[3] * xn + c[2]) * xn + c[1]) * xn + c[0];
+            const double r_x = (3. * c[3] * xn + 2. * c[2]) * xn + c[1];
+            q_y = q_y * yn + q;
+            q = q * yn + r;
+            q_x = q_x * yn + r_x;
+        }
+        p_z = p_z * zn + p;
+        p = p * zn + q;
+        p_x = p_x * zn + q_x;
+        p_y = p_y * zn + q_y;
+    }
+
+    if (phi != NULL){
+        *phi = p;
+    }
+    *dphi_dxn = p_x;
+    *dphi_dyn = p_y;
+    *dphi_dzn = p_z;
+}
+
+// Potential (if phi is not NULL) and gradient at one point. Returns 1 without
+// changing the outputs if the point is outside the grid.
+/*gpufun*/
+int TriCubicInterpolatedFieldMap_interpolate_phi_grad(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const double x, const double y, const double z,
+	   double* phi, double* dphi_dx, double* dphi_dy, double* dphi_dtau){
 	
     double const x_min = TriCubicInterpolatedFieldMapData_get_x_min(fmap);
     double const y_min = TriCubicInterpolatedFieldMapData_get_y_min(fmap);
@@ -87,60 +188,64 @@ int TriCubicInterpolatedFieldMap_interpolate_grad(
         return 1;                // no need for interpolation
     }
 
-    double b_vector[64];
-    TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
-
     double coefs[64];
-    TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
-
-    double x_power[4], y_power[4], z_power[4];
-    x_power[0] = 1;
-    y_power[0] = 1;
-    z_power[0] = 1;
-
-    x_power[1] = xn;
-    y_power[1] = yn;
-    z_power[1] = zn;
-
-    x_power[2] = xn * xn;
-    y_power[2] = yn * yn;
-    z_power[2] = zn * zn;
-
-    x_power[3] = x_power[2] * xn;
-    y_power[3] = y_power[2] * yn;
-    z_power[3] = z_power[2] * zn;
-
-    for( int i = 1; i < 4; i++ ){
-        for( int j = 0; j < 4; j++ ){
-            for( int k = 0; k < 4; k++ ){
-                *dphi_dx += i * ( ( ( coefs[i + 4 * j + 16 * k] * x_power[i-1] ) 
-                                    * y_power[j] ) * z_power[k] );
-            }
+    const int64_t slot = TriCubicInterpolatedFieldMap_cached_slot(fmap, ix, iy, iz);
+    if (slot >= 0){ // coefficients precomputed for this cell
+        /*gpuglmem*/ const double* cached =
+            TriCubicInterpolatedFieldMapData_getp1_coefficients(fmap, 64 * slot);
+        for (int ll = 0; ll < 64; ll++){
+            coefs[ll] = cached[ll];
         }
     }
-    *dphi_dx *= sign_x * inv_dx; 
-
-    for( int i = 0; i < 4; i++ ){
-        for( int j = 1; j < 4; j++ ){
-            for( int k = 0; k < 4; k++ ){
-                *dphi_dy += j * ( ( ( coefs[i + 4 * j + 16 * k] * x_power[i] ) 
-                                    * y_power[j-1] ) * z_power[k] );
-            }
-        }
-    }
-    *dphi_dy *= sign_y * inv_dy; 
-
-    for( int i = 0; i < 4; i++){
-        for( int j = 0; j < 4; j++){
-            for( int k = 1; k < 4; k++){
-                *dphi_dtau += k * ( ( ( coefs[i + 4 * j + 16 * k] * x_power[i] ) 
-                                    * y_power[j] ) * z_power[k-1] );
-            }
-        }
+    else{
+        double b_vector[64];
+        TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+        TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
     }
-    *dphi_dtau *= sign_z * inv_dz; 
+
+    double gx, gy, gz;
+    TriCubicInterpolatedFieldMap_eval_polynomial(coefs, xn, yn, zn,
+                                                 phi, &gx, &gy, &gz);
+    *dphi_dx = sign_x * inv_dx * gx;
+    *dphi_dy = sign_y * inv_dy * gy;
+    *dphi_dtau = sign_z * inv_dz * gz;
 
 	return 0;
 }
 
+/*gpufun*/
+int TriCubicInterpolatedFieldMap_interpolate_grad(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const double x, const double y, const double z, 
+	   double* dphi_dx, double* dphi_dy, double* dphi_dtau){
+
+    return TriCubicInterpolatedFieldMap_interpolate_phi_grad(fmap, x, y, z,
+                                        NULL, dphi_dx, dphi_dy, dphi_dtau);
+}
+
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_interpolate_vector(
+    TriCubicInterpolatedFieldMapData  fmap,
+                        const int64_t  n_points,
+           /*gpuglmem*/ const double*  x,
+           /*gpuglmem*/ const double*  y,
+           /*gpuglmem*/ const double*  z,
+           /*gpuglmem*/       double*  phi,
+           /*gpuglmem*/       double*  dphi_dx,
+           /*gpuglmem*/       double*  dphi_dy,
+           /*gpuglmem*/       double*  dphi_dz) {
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int pidx=0; pidx<n_points; pidx++){ //vectorize_over pidx n_points
+        double phi_p = 0., dphi_dx_p = 0., dphi_dy_p = 0., dphi_dz_p = 0.;
+        TriCubicInterpolatedFieldMap_interpolate_phi_grad(fmap,
+                x[pidx], y[pidx], z[pidx],
+                &phi_p, &dphi_dx_p, &dphi_dy_p, &dphi_dz_p);
+        phi[pidx] = phi_p;
+        dphi_dx[pidx] = dphi_dx_p;
+        dphi_dy[pidx] = dphi_dy_p;
+        dphi_dz[pidx] = dphi_dz_p;
+    }//end_vectorize
+}
+
 #endif
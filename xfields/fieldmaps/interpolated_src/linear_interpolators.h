@@ -103,6 +103,100 @@ double TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
     return val;
 }
 
+/*gpufun*/
+ShapeIndicesAndWeights TriLinearInterpolatedFieldMap_compute_shape_indices_and_weights(
+	TriLinearInterpolatedFieldMapData fmap,
+	double x, double y, double z){
+
+	return ParticleShape_compute_indices_and_weights(
+		TriLinearInterpolatedFieldMapData_get_shape_order(fmap),
+		TriLinearInterpolatedFieldMapData_get_x_min(fmap),
+		TriLinearInterpolatedFieldMapData_get_y_min(fmap),
+		TriLinearInterpolatedFieldMapData_get_z_min(fmap),
+		TriLinearInterpolatedFieldMapData_get_dx(fmap),
+		TriLinearInterpolatedFieldMapData_get_dy(fmap),
+		TriLinearInterpolatedFieldMapData_get_dz(fmap),
+		TriLinearInterpolatedFieldMapData_get_nx(fmap),
+		TriLinearInterpolatedFieldMapData_get_ny(fmap),
+		TriLinearInterpolatedFieldMapData_get_nz(fmap),
+		x, y, z);
+}
+
+// Interpolates n_quantities maps, stored in buffer_mesh_quantities at the
+// given offsets, at one point. The result for the quantity iq is written in
+// particles_quantities[iq*n_points + pidx].
+/*gpufun*/
+void TriLinearInterpolatedFieldMap_interpolate_3d_maps_at_point(
+    TriLinearInterpolatedFieldMapData  fmap,
+                        const double   x,
+                        const double   y,
+                        const double   z,
+                        const int64_t  n_quantities,
+           /*gpuglmem*/ const int8_t*  buffer_mesh_quantities,
+           /*gpuglmem*/ const int64_t* offsets_mesh_quantities,
+                        const int64_t  n_points,
+                        const int64_t  pidx,
+           /*gpuglmem*/       double*  particles_quantities) {
+
+    if (TriLinearInterpolatedFieldMapData_get_shape_order(fmap) > 1){
+	const ShapeIndicesAndWeights siw =
+	    TriLinearInterpolatedFieldMap_compute_shape_indices_and_weights(
+	                                                      fmap, x, y, z);
+	for (int iq=0; iq<n_quantities; iq++){
+	    particles_quantities[iq*n_points + pidx] =
+		ParticleShape_interpolate_3d_map_scalar(
+	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
+		   siw);
+	}
+    }
+    else{
+	const IndicesAndWeights iw =
+	    TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
+	                                                      fmap, x, y, z);
+	for (int iq=0; iq<n_quantities; iq++){
+	    particles_quantities[iq*n_points + pidx] =
+		TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
+	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
+		   iw);
+	}
+    }
+}
+
+// Gradient of the potential at one point (dphi_dz is set to zero if
+// with_z is zero or if it is not stored in the map)
+/*gpufun*/
+void TriLinearInterpolatedFieldMap_interpolate_gradient(
+    TriLinearInterpolatedFieldMapData fmap,
+    const double x, const double y, const double z, const int64_t with_z,
+    double* dphi_dx, double* dphi_dy, double* dphi_dz){
+
+    /*gpuglmem*/ double* dphi_dx_map = TriLinearInterpolatedFieldMapData_getp1_dphi_dx(fmap, 0);
+    /*gpuglmem*/ double* dphi_dy_map = TriLinearInterpolatedFieldMapData_getp1_dphi_dy(fmap, 0);
+    const int64_t compute_z = (with_z && TriLinearInterpolatedFieldMapData_len_dphi_dz(fmap) > 0);
+
+    *dphi_dz = 0.;
+    if (TriLinearInterpolatedFieldMapData_get_shape_order(fmap) > 1){
+	const ShapeIndicesAndWeights siw =
+	    TriLinearInterpolatedFieldMap_compute_shape_indices_and_weights(fmap, x, y, z);
+	*dphi_dx = ParticleShape_interpolate_3d_map_scalar(dphi_dx_map, siw);
+	*dphi_dy = ParticleShape_interpolate_3d_map_scalar(dphi_dy_map, siw);
+	if (compute_z){
+	    *dphi_dz = ParticleShape_interpolate_3d_map_scalar(
+		    TriLinearInterpolatedFieldMapData_getp1_dphi_dz(fmap, 0), siw);
+	}
+    }
+    else{
+	const IndicesAndWeights iw =
+	    TriLinearInterpolatedFieldMap_compute_indeces_and_weights(fmap, x, y, z);
+	*dphi_dx = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dx_map, iw);
+	*dphi_dy = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dy_map, iw);
+	if (compute_z){
+	    *dphi_dz = TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
+		    TriLinearInterpolatedFieldMapData_getp1_dphi_dz(fmap, 0), iw);
+	}
+    }
+}
+
 /*gpukern*/
 void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
     TriLinearInterpolatedFieldMapData  fmap,
@@ -110,23 +204,22 @@ void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
            /*gpuglmem*/ const double*  x,
            /*gpuglmem*/ const double*  y,
            /*gpuglmem*/ const double*  z,
+           /*gpuglmem*/ const int64_t* indices,
+                        const int      use_indices,
                         const int64_t  n_quantities,
            /*gpuglmem*/ const int8_t*  buffer_mesh_quantities,
            /*gpuglmem*/ const int64_t* offsets_mesh_quantities,
            /*gpuglmem*/       double*  particles_quantities) {
 
+    // If use_indices is non zero, the maps are interpolated at the points
+    // x[indices[ii]], y[indices[ii]], z[indices[ii]] for ii < n_points
     #pragma omp parallel for //only_for_context cpu_openmp 
-    for (int pidx=0; pidx<n_points; pidx++){ //vectorize_over pidx n_points
-
-	const IndicesAndWeights iw = 
-		TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
-	                                      fmap, x[pidx], y[pidx], z[pidx]);
-    	for (int iq=0; iq<n_quantities; iq++){
-	    particles_quantities[iq*n_points + pidx] = 
-		TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
-	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
-		   iw);
-	}
+    for (int ii=0; ii<n_points; ii++){ //vectorize_over ii n_points
+	const int64_t pidx = use_indices ? indices[ii] : ii;
+	TriLinearInterpolatedFieldMap_interpolate_3d_maps_at_point(fmap,
+		x[pidx], y[pidx], z[pidx],
+		n_quantities, buffer_mesh_quantities, offsets_mesh_quantities,
+		n_points, ii, particles_quantities);
     }//end_vectorize
 }
 #endif
@@ -0,0 +1,125 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_NESTED_INTERPOLATORS_H
+#define XFIELDS_NESTED_INTERPOLATORS_H
+
+// Returns 1 if the point is in the core of the fine grid, i.e. at least
+// `margin` cells away from its boundaries, so that the support of the
+// particle shape and the nodes used for the derivatives are all inside the
+// fine grid.
+/*gpufun*/
+int64_t NestedTriLinearInterpolatedFieldMap_is_in_fine_core(
+	TriLinearInterpolatedFieldMapData fine, const int64_t margin,
+	const double x, const double y, const double z){
+
+    const double ux = (x - TriLinearInterpolatedFieldMapData_get_x_min(fine))
+			/ TriLinearInterpolatedFieldMapData_get_dx(fine);
+    const double uy = (y - TriLinearInterpolatedFieldMapData_get_y_min(fine))
+			/ TriLinearInterpolatedFieldMapData_get_dy(fine);
+    const double uz = (z - TriLinearInterpolatedFieldMapData_get_z_min(fine))
+			/ TriLinearInterpolatedFieldMapData_get_dz(fine);
+    const int64_t nx = TriLinearInterpolatedFieldMapData_get_nx(fine);
+    const int64_t ny = TriLinearInterpolatedFieldMapData_get_ny(fine);
+    const int64_t nz = TriLinearInterpolatedFieldMapData_get_nz(fine);
+
+    return (ux >= margin && ux < nx - 1 - margin
+	    && uy >= margin && uy < ny - 1 - margin
+	    && uz >= margin && uz < nz - 1 - margin);
+}
+
+// Splits the alive particles between the core of the fine grid and the
+// rest of the coarse grid
+/*gpukern*/
+void NestedTriLinearInterpolatedFieldMap_split_state(
+    NestedTriLinearInterpolatedFieldMapData nmap,
+                        const int64_t  n_points,
+           /*gpuglmem*/ const double*  x,
+           /*gpuglmem*/ const double*  y,
+           /*gpuglmem*/ const double*  z,
+           /*gpuglmem*/ const int64_t* part_state,
+                        const int      use_state,
+           /*gpuglmem*/       int64_t* state_fine,
+           /*gpuglmem*/       int64_t* state_outer) {
+
+    TriLinearInterpolatedFieldMapData fine =
+		NestedTriLinearInterpolatedFieldMapData_getp_fine(nmap);
+    const int64_t margin = NestedTriLinearInterpolatedFieldMapData_get_margin(nmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int pidx=0; pidx<n_points; pidx++){ //vectorize_over pidx n_points
+	const int64_t state = use_state ? part_state[pidx] : 1;
+	if (NestedTriLinearInterpolatedFieldMap_is_in_fine_core(fine, margin,
+					      x[pidx], y[pidx], z[pidx])){
+	    state_fine[pidx] = state;
+	    state_outer[pidx] = 0;
+	}
+	else{
+	    state_fine[pidx] = 0;
+	    state_outer[pidx] = state;
+	}
+    }//end_vectorize
+}
+
+// Gradient of the potential at one point, from the finest grid containing it
+/*gpufun*/
+void NestedTriLinearInterpolatedFieldMap_interpolate_gradient(
+    NestedTriLinearInterpolatedFieldMapData nmap,
+    const double x, const double y, const double z, const int64_t with_z,
+    double* dphi_dx, double* dphi_dy, double* dphi_dz){
+
+    TriLinearInterpolatedFieldMapData fine =
+		NestedTriLinearInterpolatedFieldMapData_getp_fine(nmap);
+    const int64_t margin = NestedTriLinearInterpolatedFieldMapData_get_margin(nmap);
+
+    if (NestedTriLinearInterpolatedFieldMap_is_in_fine_core(fine, margin, x, y, z)){
+	TriLinearInterpolatedFieldMap_interpolate_gradient(fine, x, y, z,
+				    with_z, dphi_dx, dphi_dy, dphi_dz);
+    }
+    else{
+	TriLinearInterpolatedFieldMap_interpolate_gradient(
+		NestedTriLinearInterpolatedFieldMapData_getp_coarse(nmap),
+		x, y, z, with_z, dphi_dx, dphi_dy, dphi_dz);
+    }
+}
+
+/*gpukern*/
+void NestedTriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
+    NestedTriLinearInterpolatedFieldMapData  nmap,
+                        const int64_t  n_points,
+           /*gpuglmem*/ const double*  x,
+           /*gpuglmem*/ const double*  y,
+           /*gpuglmem*/ const double*  z,
+                        const int64_t  n_quantities,
+           /*gpuglmem*/ const int8_t*  buffer_mesh_quantities,
+           /*gpuglmem*/ const int64_t* offsets_fine,
+           /*gpuglmem*/ const int64_t* offsets_coarse,
+           /*gpuglmem*/       double*  particles_quantities) {
+
+    TriLinearInterpolatedFieldMapData fine =
+		NestedTriLinearInterpolatedFieldMapData_getp_fine(nmap);
+    TriLinearInterpolatedFieldMapData coarse =
+		NestedTriLinearInterpolatedFieldMapData_getp_coarse(nmap);
+    const int64_t margin = NestedTriLinearInterpolatedFieldMapData_get_margin(nmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int pidx=0; pidx<n_points; pidx++){ //vectorize_over pidx n_points
+	if (NestedTriLinearInterpolatedFieldMap_is_in_fine_core(fine, margin,
+					      x[pidx], y[pidx], z[pidx])){
+	    TriLinearInterpolatedFieldMap_interpolate_3d_maps_at_point(fine,
+		    x[pidx], y[pidx], z[pidx],
+		    n_quantities, buffer_mesh_quantities, offsets_fine,
+		    n_points, pidx, particles_quantities);
+	}
+	else{
+	    TriLinearInterpolatedFieldMap_interpolate_3d_maps_at_point(coarse,
+		    x[pidx], y[pidx], z[pidx],
+		    n_quantities, buffer_mesh_quantities, offsets_coarse,
+		    n_points, pidx, particles_quantities);
+	}
+    }//end_vectorize
+}
+
+#endif
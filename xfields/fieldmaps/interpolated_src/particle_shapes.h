@@ -0,0 +1,188 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_PARTICLE_SHAPES_H
+#define XFIELDS_PARTICLE_SHAPES_H
+
+// Particle shapes of order 1 (cloud in cell), 2 (triangular shaped cloud)
+// and 3 (cubic B-spline). A particle is spread over (order + 1) grid nodes
+// per plane. The same weights are used for the charge deposition and for the
+// interpolation of the maps at the particle positions.
+
+typedef struct{
+    int64_t ix;         // first node of the support (-999 if outside the grid)
+    int64_t iy;
+    int64_t iz;
+    int64_t nx;
+    int64_t ny;
+    int64_t n_support;  // nodes per plane
+    double wx[4];
+    double wy[4];
+    double wz[4];
+}ShapeIndicesAndWeights;
+
+
+// Weights of the nodes of the support for the normalized coordinate
+// u = (x - x0) / dx. Returns the first node of the support, or -1 if the
+// support is not entirely inside the grid.
+/*gpufun*/
+int64_t ParticleShape_weights_1d(const int64_t order, const double u,
+                                 const int64_t n, double* w){
+
+    int64_t i0;
+    w[2] = 0.;
+    w[3] = 0.;
+    if (order == 2){
+        const int64_t ic = floor(u + 0.5); // nearest node
+        const double d = u - ic;
+        w[0] = 0.5 * (0.5 - d) * (0.5 - d);
+        w[1] = 0.75 - d * d;
+        w[2] = 0.5 * (0.5 + d) * (0.5 + d);
+        i0 = ic - 1;
+    }
+    else if (order == 3){
+        const int64_t ic = floor(u);
+        const double t = u - ic;
+        const double t2 = t * t;
+        const double t3 = t2 * t;
+        w[0] = (1. - t) * (1. - t) * (1. - t) / 6.;
+        w[1] = (3. * t3 - 6. * t2 + 4.) / 6.;
+        w[2] = (-3. * t3 + 3. * t2 + 3. * t + 1.) / 6.;
+        w[3] = t3 / 6.;
+        i0 = ic - 1;
+    }
+    else{
+        const int64_t ic = floor(u);
+        const double t = u - ic;
+        w[0] = 1. - t;
+        w[1] = t;
+        i0 = ic;
+    }
+
+    if (i0 < 0 || i0 + order > n - 1){
+        return -1;
+    }
+    return i0;
+}
+
+
+/*gpufun*/
+ShapeIndicesAndWeights ParticleShape_compute_indices_and_weights(
+        const int64_t order,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int64_t nx, const int64_t ny, const int64_t nz,
+        const double x, const double y, const double z){
+
+    ShapeIndicesAndWeights siw;
+
+    siw.nx = nx;
+    siw.ny = ny;
+    siw.n_support = order + 1;
+
+    siw.ix = ParticleShape_weights_1d(order, (x - x0) / dx, nx, siw.wx);
+    siw.iy = ParticleShape_weights_1d(order, (y - y0) / dy, ny, siw.wy);
+    siw.iz = ParticleShape_weights_1d(order, (z - z0) / dz, nz, siw.wz);
+
+    if (siw.ix < 0 || siw.iy < 0 || siw.iz < 0){
+        siw.ix = -999;
+        siw.iy = -999;
+        siw.iz = -999;
+    }
+
+    return siw;
+}
+
+
+/*gpufun*/
+double ParticleShape_interpolate_3d_map_scalar(
+        /*gpuglmem*/ const double* map,
+        const ShapeIndicesAndWeights siw){
+
+    if (siw.ix < 0){
+        return 0.;
+    }
+
+    double val = 0.;
+    for (int lz=0; lz<siw.n_support; lz++){
+        const int64_t offset_z = (siw.iz + lz) * siw.nx * siw.ny;
+        for (int ly=0; ly<siw.n_support; ly++){
+            const int64_t offset_yz = offset_z + (siw.iy + ly) * siw.nx;
+            const double wyz = siw.wy[ly] * siw.wz[lz];
+            for (int lx=0; lx<siw.n_support; lx++){
+                val += siw.wx[lx] * wyz * map[siw.ix + lx + offset_yz];
+            }
+        }
+    }
+
+    return val;
+}
+
+
+/*gpukern*/
+void p2m_rectmesh3d_shape(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x,
+        /*gpuglmem*/ const double* y,
+        /*gpuglmem*/ const double* z,
+          // particle weights (multiplied by charge_factor) and state flags
+          // (ignored if use_state is zero)
+        /*gpuglmem*/ const double* part_weights,
+                     const double  charge_factor,
+        /*gpuglmem*/ const int64_t* part_state,
+                     const int     use_state,
+          // indices of the particles to deposit (all if use_indices is zero)
+        /*gpuglmem*/ const int64_t* indices,
+                     const int     use_indices,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // order of the particle shape
+        const int shape_order,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+                     int64_t  grid1d_offset){
+
+    /*gpuglmem*/ double* grid1d =
+                (/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    const double vol_m1 = 1/(dx*dy*dz);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int ii=0; ii<nparticles; ii++){ //vectorize_over ii nparticles
+        const int64_t pidx = use_indices ? indices[ii] : ii;
+        if (!use_state || part_state[pidx] > 0){
+            const ShapeIndicesAndWeights siw =
+                ParticleShape_compute_indices_and_weights(shape_order,
+                    x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                    x[pidx], y[pidx], z[pidx]);
+            if (siw.ix >= 0){
+                const double pwei = part_weights[pidx] * charge_factor * vol_m1;
+                // Loops over the support (the particle index is ii)
+                for (int lz=0; lz<siw.n_support; lz++){
+                    const int64_t offset_z = (siw.iz + lz) * siw.nx * siw.ny;
+                    for (int ly=0; ly<siw.n_support; ly++){
+                        const int64_t offset_yz =
+                                        offset_z + (siw.iy + ly) * siw.nx;
+                        const double wyz = pwei * siw.wy[ly] * siw.wz[lz];
+                        for (int lx=0; lx<siw.n_support; lx++){
+                            atomicAdd(&grid1d[siw.ix + lx + offset_yz],
+                                      siw.wx[lx] * wyz);
+                        }
+                    }
+                }
+            }
+        }
+    }//end_vectorize
+
+}
+
+#endif
@@ -0,0 +1,413 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+from scipy.constants import e as qe
+
+import xobjects as xo
+import xtrack as xt
+
+from .interpolated import TriLinearInterpolatedFieldMap
+from ..general import _pkg_root
+
+# Number of fine cells, from each boundary of the fine grid, in which the
+# coarse grid is used (enough for the support of all particle shapes and for
+# the derivatives)
+_fine_grid_margin = 2
+
+_NestedTriLinearInterpolatedFieldMap_kernels = {
+    'NestedTriLinearInterpolatedFieldMap_split_state': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='nmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_points'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Int64,   pointer=True,  name='part_state'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_state'),
+            xo.Arg(xo.Int64,   pointer=True,  name='state_fine'),
+            xo.Arg(xo.Int64,   pointer=True,  name='state_outer'),
+            ],
+        n_threads='n_points'
+        ),
+    'NestedTriLinearInterpolatedFieldMap_interpolate_3d_map_vector': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='nmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_points'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_quantities'),
+            xo.Arg(xo.Int8,    pointer=True,  name='buffer_mesh_quantities'),
+            xo.Arg(xo.Int64,   pointer=True,  name='offsets_fine'),
+            xo.Arg(xo.Int64,   pointer=True,  name='offsets_coarse'),
+            xo.Arg(xo.Float64, pointer=True,  name='particles_quantities'),
+            ],
+        n_threads='n_points'
+        ),
+    }
+
+
+class NestedTriLinearInterpolatedFieldMap(xo.HybridClass):
+
+    """
+    Field map made of two nested linear interpolators, a coarse grid covering
+    the full beam (e.g. core and halo) and a fine grid covering the core, to
+    resolve the core with a fraction of the cells of a uniformly fine grid.
+    The fields at a given point are taken from the finest grid containing it.
+
+    The potential on the coarse grid is computed from the charge of all the
+    particles. The potential on the fine grid is the sum of the one computed
+    on the fine grid from the particles in the core of the fine grid and of
+    the one computed on the coarse grid from the other particles, interpolated
+    at the nodes of the fine grid. The Poisson solvers need to have open
+    boundaries (FFT solvers).
+
+    Args:
+        context (xobjects context): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        x_range (tuple): Horizontal extent (in meters) of the coarse grid.
+        y_range (tuple): Vertical extent (in meters) of the coarse grid.
+        z_range (tuple): Longitudinal extent (in meters) of the coarse grid.
+        nx (int): Number of cells of the coarse grid in the horizontal
+            direction.
+        ny (int): Number of cells of the coarse grid in the vertical
+            direction.
+        nz (int): Number of cells of the coarse grid in the longitudinal
+            direction.
+        dx (float): Horizontal cell size of the coarse grid in meters. It can
+            be provided alternatively to ``nx``.
+        dy (float): Vertical cell size of the coarse grid in meters. It can
+            be provided alternatively to ``ny``.
+        dz (float): Longitudinal cell size of the coarse grid in meters. It
+            can be provided alternatively to ``nz``.
+        fine_x_range (tuple): Horizontal extent (in meters) of the fine grid.
+        fine_y_range (tuple): Vertical extent (in meters) of the fine grid.
+        fine_z_range (tuple): Longitudinal extent (in meters) of the fine
+            grid. If ``None`` (default) the one of the coarse grid reduced
+            by two coarse cells on each side is used.
+        refinement (int or tuple): Ratio between the cell sizes of the coarse
+            and of the fine grid, either the same for all planes or given
+            per plane as ``(rx, ry, rz)``. The default is 2.
+        solver (str): Poisson solver used on both grids, ``FFTSolver3D``,
+            ``FFTSolver2p5D`` (default), ``FFTSolver2p5DAveraged``,
+            ``RFFTSolver3D`` or ``RFFTSolver2p5D``.
+        scale_coordinates_in_solver (tuple): Three coefficients used to rescale
+            the grid coordinates in the definition of the solvers. The default
+            is (1.,1.,1.).
+        updatable (bool): If ``True`` the field map can be updated after
+            creation. Default is ``True``.
+        solver_dtype (np.dtype): Floating point precision of the Poisson
+            solvers, ``np.float64`` (default) or ``np.float32``.
+        store_dphi_dz (bool): If ``False`` the longitudinal derivative of
+            the potential is neither computed nor stored. The default is
+            ``True``.
+        particle_shape (str): Shape of the macroparticles, ``'cic'``
+            (default), ``'tsc'`` or ``'cubic'`` (see
+            :class:`TriLinearInterpolatedFieldMap`).
+    Returns:
+        (NestedTriLinearInterpolatedFieldMap): Interpolator object.
+    """
+
+    _xofields = {
+        'fine': TriLinearInterpolatedFieldMap,
+        'coarse': TriLinearInterpolatedFieldMap,
+        'margin': xo.Int64,
+    }
+
+    _extra_c_sources = [
+        _pkg_root.joinpath('headers/constants.h'),
+        xt.general._pkg_root.joinpath('headers/atomicadd.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/particle_shapes.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/linear_interpolators.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/nested_interpolators.h'),
+        ]
+
+    _kernels = _NestedTriLinearInterpolatedFieldMap_kernels
+
+    def __init__(self,
+                 _context=None,
+                 _buffer=None,
+                 _offset=None,
+                 _xobject=None,
+                 x_range=None, y_range=None, z_range=None,
+                 nx=None, ny=None, nz=None,
+                 dx=None, dy=None, dz=None,
+                 fine_x_range=None, fine_y_range=None, fine_z_range=None,
+                 refinement=2,
+                 solver='FFTSolver2p5D',
+                 scale_coordinates_in_solver=(1.,1.,1.),
+                 updatable=True,
+                 solver_dtype=np.float64,
+                 store_dphi_dz=True,
+                 particle_shape='cic',
+                 ):
+
+        self._init_python_state()
+
+        if _xobject is not None:
+            self.xoinitialize(_xobject=_xobject, _context=_context,
+                             _buffer=_buffer, _offset=_offset)
+            return
+
+        assert isinstance(solver, str), 'solver must be given by name'
+        assert fine_x_range is not None and fine_y_range is not None, (
+            'fine_x_range and fine_y_range must be provided')
+
+        if np.isscalar(refinement):
+            refinement = (refinement, refinement, refinement)
+        assert len(refinement) == 3 and all(rr >= 1 for rr in refinement), (
+            'refinement must be a number or a tuple of three numbers >= 1')
+
+        if _buffer is None:
+            if _context is None:
+                _context = xo.context_default
+            _buffer = _context.new_buffer(capacity=64)
+
+        # The two maps are built in a scratch buffer and copied in the nested
+        # fieldmap by xoinitialize, the scratch buffer is then released
+        scratch_buffer = _buffer.context.new_buffer(capacity=64)
+
+        common_kwargs = dict(
+            _buffer=scratch_buffer,
+            solver=solver,
+            scale_coordinates_in_solver=scale_coordinates_in_solver,
+            updatable=updatable,
+            solver_dtype=solver_dtype,
+            store_dphi_dz=store_dphi_dz,
+            particle_shape=particle_shape)
+
+        coarse = TriLinearInterpolatedFieldMap(
+            x_range=x_range, y_range=y_range, z_range=z_range,
+            nx=nx, ny=ny, nz=nz, dx=dx, dy=dy, dz=dz,
+            **common_kwargs)
+
+        if fine_z_range is None:
+            fine_z_range = (coarse.z_grid[0] + _fine_grid_margin * coarse.dz,
+                            coarse.z_grid[-1] - _fine_grid_margin * coarse.dz)
+
+        fine = TriLinearInterpolatedFieldMap(
+            x_range=fine_x_range, y_range=fine_y_range, z_range=fine_z_range,
+            dx=coarse.dx/refinement[0],
+            dy=coarse.dy/refinement[1],
+            dz=coarse.dz/refinement[2],
+            **common_kwargs)
+
+        # The potential of the coarse grid is interpolated at all the nodes
+        # of the fine grid
+        for vv in 'xyz':
+            c_grid = getattr(coarse, f'{vv}_grid')
+            f_grid = getattr(fine, f'{vv}_grid')
+            tol = 1e-9 * (c_grid[1] - c_grid[0])
+            dc = _fine_grid_margin * (c_grid[1] - c_grid[0])
+            assert (f_grid[0] >= c_grid[0] + dc - tol
+                    and f_grid[-1] <= c_grid[-1] - dc + tol), (
+                f'The fine grid must be inside the coarse grid, at least '
+                f'{_fine_grid_margin} coarse cells away from its boundaries '
+                f'({vv} plane)')
+
+        self.xoinitialize(
+                 _buffer=_buffer,
+                 _offset=_offset,
+                 fine=fine,
+                 coarse=coarse,
+                 margin=_fine_grid_margin)
+
+        self.updatable = updatable
+
+        self.compile_kernels(only_if_needed=True)
+
+    def _init_python_state(self):
+
+        # Work maps and arrays not stored in the xobject, allocated when
+        # first needed
+        self._outer = None
+        self._fine_nodes_xyz = None
+        self._phi_outer_on_fine = None
+        self._state_fine = None
+        self._state_outer = None
+
+    def _outer_map(self):
+
+        # Coarse map for the charge outside the core of the fine grid (not
+        # part of the xobject)
+        if self._outer is None:
+            self._outer = TriLinearInterpolatedFieldMap(
+                _buffer=self._buffer,
+                x_grid=self.coarse.x_grid,
+                y_grid=self.coarse.y_grid,
+                z_grid=self.coarse.z_grid,
+                store_dphi_dz=False,
+                particle_shape=self.coarse.particle_shape)
+        return self._outer
+
+    def _fine_nodes(self):
+
+        # Coordinates of the nodes of the fine grid (Fortran order)
+        if self._fine_nodes_xyz is None:
+            XX, YY, ZZ = np.meshgrid(self.fine.x_grid, self.fine.y_grid,
+                                     self.fine.z_grid, indexing='ij')
+            context = self._buffer.context
+            self._fine_nodes_xyz = tuple(
+                context.nparray_to_context_array(vv.flatten(order='F'))
+                for vv in (XX, YY, ZZ))
+            self._phi_outer_on_fine = context.zeros(
+                shape=(1, len(self._fine_nodes_xyz[0])), dtype=np.float64)
+        return self._fine_nodes_xyz
+
+    def _split_state(self, x, y, z, state):
+
+        context = self._buffer.context
+        n_points = len(x)
+        if self._state_fine is None or len(self._state_fine) != n_points:
+            self._state_fine = context.zeros(n_points, dtype=np.int64)
+            self._state_outer = context.zeros(n_points, dtype=np.int64)
+        if n_points > 0:
+            context.kernels.NestedTriLinearInterpolatedFieldMap_split_state(
+                    nmap=self._xobject, n_points=n_points,
+                    x=x, y=y, z=z,
+                    **self.coarse._state_kernel_args(state),
+                    state_fine=self._state_fine,
+                    state_outer=self._state_outer)
+        return self._state_fine, self._state_outer
+
+    def update_from_particles(self,
+                        particles=None,
+                        x_p=None, y_p=None, z_p=None,
+                        ncharges_p=None, state_p=None, q0_coulomb=None,
+                        update_phi=True, force=False):
+
+        """
+        Updates the charge density on both grids using a given set of
+        particles, which can be provided by a particles object or by
+        individual arrays. The potential can be optionally updated
+        accordingly.
+
+        Args:
+            particles (xtrack.Particles): xtrack particle object.
+            x_p (float64 array): Horizontal coordinates of the macroparticles.
+            y_p (float64 array): Vertical coordinates of the macroparticles.
+            z_p (float64 array): Longitudinal coordinates of the macroparticles.
+            ncharges_p (float64 array): Number of reference charges in the
+                macroparticles.
+            state_p (int64 array): particle state (>0 active, lost otherwise)
+            q0_coulomb (float64): Reference charge in Coulomb.
+            update_phi (bool): If ``True`` the potential is recalculated.
+                The default is ``True``.
+            force (bool): If ``True`` the potential is updated even if the
+                map is declared as not updateable. The default is ``False``.
+        """
+
+        if not force:
+            assert self.updatable, 'This FieldMap is not updatable!'
+
+        if particles is not None:
+            assert (x_p is None and y_p is None and z_p is None
+                    and ncharges_p is None and state_p is None)
+            x_p, y_p, z_p = particles.x, particles.y, particles.zeta
+            ncharges_p = particles.weight
+            state_p = particles.state
+            q0_coulomb = particles.q0 * qe
+        else:
+            assert (len(x_p) == len(y_p) == len(z_p) == len(ncharges_p))
+            if state_p is not None:
+                assert len(state_p) == len(x_p)
+
+        state_fine, state_outer = self._split_state(x_p, y_p, z_p, state_p)
+
+        dep_kwargs = dict(x_p=x_p, y_p=y_p, z_p=z_p, ncharges_p=ncharges_p,
+                          q0_coulomb=q0_coulomb, update_phi=False, force=True)
+        self.coarse.update_from_particles(state_p=state_p, **dep_kwargs)
+        self.fine.update_from_particles(state_p=state_fine, **dep_kwargs)
+        self._outer_map().update_from_particles(state_p=state_outer,
+                                                **dep_kwargs)
+
+        if update_phi:
+            self.update_phi_from_rho(force=True)
+
+    def update_phi_from_rho(self, force=False):
+
+        """
+        Updates the potential on both grids from the charge densities.
+
+        Args:
+            force (bool): If ``True`` the potential is updated even if the
+                map is declared as not updateable. The default is ``False``.
+        """
+
+        if not force:
+            assert self.updatable, 'This FieldMap is not updatable!'
+
+        coarse = self.coarse
+        fine = self.fine
+        outer = self._outer_map()
+
+        # Coarse grid: all the charge
+        coarse.update_phi_from_rho()
+
+        # Fine grid: charge in the core of the fine grid, plus the potential
+        # of the remaining charge computed on the coarse grid
+        coarse.solver.solve_into(outer.rho, outer.phi)
+        fine.solver.solve_into(fine.rho, fine.phi)
+        x_nodes, y_nodes, z_nodes = self._fine_nodes()
+        outer.gather_at_points(x_nodes, y_nodes, z_nodes,
+                               quantities=('phi',),
+                               out=self._phi_outer_on_fine)
+        fine.phi.T[:,:,:] += self._phi_outer_on_fine[0, :].reshape(
+                                    (fine.nx, fine.ny, fine.nz), order='F').T
+        fine._update_phi_derivatives()
+
+    def gather_at_points(self, x, y, z,
+                         quantities=('dphi_dx', 'dphi_dy', 'dphi_dz'),
+                         out=None):
+
+        """
+        Interpolates several maps at the points specified by x, y, z, using
+        for each point the finest grid containing it (see
+        :meth:`TriLinearInterpolatedFieldMap.gather_at_points`). Zeros are
+        returned for points outside the coarse grid.
+
+        Args:
+            x (float64 array): Horizontal coordinates at which the field is evaluated.
+            y (float64 array): Vertical coordinates at which the field is evaluated.
+            z (float64 array): Longitudinal coordinates at which the field is evaluated.
+            quantities (tuple of str): Maps to be interpolated, among ``'rho'``,
+                ``'phi'``, ``'dphi_dx'``, ``'dphi_dy'`` and ``'dphi_dz'``.
+            out (float64 array): Optional C-contiguous array of shape
+                (len(quantities), len(x)) in which the result is written.
+                If ``None``, a new array is allocated.
+        Returns:
+            (float64 array): Array of shape (len(quantities), len(x)) with
+            the required quantities at the provided points.
+        """
+
+        n_points = len(x)
+        assert len(y) == n_points and len(z) == n_points
+
+        quantities = tuple(quantities)
+        offsets_fine = self.fine._gather_offsets(quantities)
+        offsets_coarse = self.coarse._gather_offsets(quantities)
+        n_quantities = len(quantities)
+
+        context = self._buffer.context
+        if out is None:
+            out = context.zeros(shape=(n_quantities, n_points),
+                                dtype=np.float64)
+        else:
+            assert out.shape == (n_quantities, n_points), (
+                f'out must have shape {(n_quantities, n_points)}')
+
+        if n_quantities > 0 and n_points > 0:
+            context.kernels.NestedTriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
+                    nmap=self._xobject,
+                    n_points=n_points,
+                    x=x, y=y, z=z,
+                    n_quantities=n_quantities,
+                    buffer_mesh_quantities=self._buffer.buffer,
+                    offsets_fine=offsets_fine,
+                    offsets_coarse=offsets_coarse,
+                    particles_quantities=out)
+
+        return out
@@ -0,0 +1,129 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import json
+import os
+
+import numpy as np
+
+import xobjects as xo
+from xobjects.context_cpu import BufferNumpy
+
+from .tricubicinterpolated import TriCubicInterpolatedFieldMap
+
+_header_size_bytes = 8
+_data_alignment = 4096
+
+
+class _CopyOnWriteBuffer(BufferNumpy):
+
+    # Numpy buffer backed by a private (copy-on-write) memory map of a file:
+    # the pages that are only read are shared by all the processes mapping the
+    # file, the ones that are written become private to the process. The
+    # buffer cannot grow, as it would become a private copy of the file.
+
+    def __init__(self, filename, context):
+        self._filename = filename
+        super().__init__(capacity=os.path.getsize(filename), context=context)
+
+    def _new_buffer(self, capacity):
+        # Called by XBuffer.__init__ to allocate the buffer
+        return np.memmap(self._filename, dtype='int8', mode='c',
+                         shape=(capacity,))
+
+    def grow(self, capacity):
+        raise MemoryError(
+            f'The buffer of the shared fieldmaps is full ({self.capacity} '
+            'bytes) and cannot grow, increase `extra_capacity` in '
+            '`save_shared_fieldmaps`')
+
+
+def save_shared_fieldmaps(fieldmaps, filename, extra_capacity=2**28):
+
+    """
+    Writes tricubic fieldmaps to a file that can be attached by many processes
+    with :func:`attach_shared_fieldmaps`, sharing the memory of the maps.
+
+    Args:
+        fieldmaps (dict): Fieldmaps (:class:`TriCubicInterpolatedFieldMap`)
+            to be written, by name.
+        filename (str): Path of the file. A file in ``/dev/shm`` is kept in
+            POSIX shared memory.
+        extra_capacity (int): Space in bytes left after the fieldmaps for the
+            objects created by each process in the same buffer (e.g. the
+            beam elements of a line). It does not use disk space nor memory
+            until it is written. The default is 256 MB.
+    """
+
+    entries = {}
+    data_end = _data_alignment
+    for name, fieldmap in fieldmaps.items():
+        assert isinstance(fieldmap, TriCubicInterpolatedFieldMap), (
+            'Only TriCubicInterpolatedFieldMap objects can be shared')
+        size = int(fieldmap._xobject._size)
+        entries[name] = [data_end, size]
+        data_end += int(np.ceil(size / _data_alignment)) * _data_alignment
+
+    header = json.dumps({'fieldmaps': entries,
+                         'data_end': data_end}).encode()
+    assert _header_size_bytes + len(header) <= _data_alignment, (
+        'Too many fieldmaps')
+
+    with open(filename, 'wb') as fid:
+        fid.write(np.int64(len(header)).tobytes())
+        fid.write(header)
+        for name, fieldmap in fieldmaps.items():
+            offset, size = entries[name]
+            fid.seek(offset)
+            fid.write(fieldmap._buffer.to_bytearray(fieldmap._offset, size))
+        fid.truncate(data_end + extra_capacity)
+
+
+def attach_shared_fieldmaps(filename, _context=None):
+
+    """
+    Attaches the fieldmaps written by :func:`save_shared_fieldmaps`. The data
+    of the maps are memory-mapped and shared with all the other processes
+    attaching the same file. The maps are not updatable.
+
+    The fieldmaps are in a single buffer, in which the elements using them
+    (e.g. :class:`ElectronCloud`) need to be created. Changes to the buffer
+    are private to the process and are never written to the file. The buffer
+    cannot grow: the objects created in it need to fit in the
+    ``extra_capacity`` given to :func:`save_shared_fieldmaps`.
+
+    Args:
+        filename (str): Path of the file.
+        _context (xobjects context): CPU context of the fieldmaps. If ``None``
+            the default context is used.
+    Returns:
+        (dict): Fieldmaps (:class:`TriCubicInterpolatedFieldMap`) by name.
+    """
+
+    if _context is None:
+        _context = xo.context_default
+    if not isinstance(_context, xo.ContextCpu):
+        raise NotImplementedError(
+            'Shared fieldmaps are available only on CPU contexts')
+
+    with open(filename, 'rb') as fid:
+        header_len = int(np.frombuffer(fid.read(_header_size_bytes),
+                                       dtype=np.int64)[0])
+        header = json.loads(fid.read(header_len).decode())
+
+    buffer = _CopyOnWriteBuffer(filename, context=_context)
+    # Reserve the header and the fieldmaps
+    offset = buffer.allocate(header['data_end'])
+    assert offset == 0
+
+    fieldmaps = {}
+    for name, (offset, _) in header['fieldmaps'].items():
+        xobject = TriCubicInterpolatedFieldMap._XoStruct._from_buffer(
+                                            buffer=buffer, offset=offset)
+        fieldmap = TriCubicInterpolatedFieldMap(_xobject=xobject,
+                                                updatable=False)
+        fieldmaps[name] = fieldmap
+
+    return fieldmaps
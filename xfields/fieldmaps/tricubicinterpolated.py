@@ -30,6 +30,9 @@ _TriCubicInterpolatedFieldMap_kernels = {
         args=[
             xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
             xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='charge_factor'),
+            xo.Arg(xo.Int64,   pointer=True,  name='indices'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_indices'),
             xo.Arg(xo.Float64, pointer=False, name='x0'),
             xo.Arg(xo.Float64, pointer=False, name='y0'),
             xo.Arg(xo.Float64, pointer=False, name='z0'),
@@ -51,7 +54,11 @@ _TriCubicInterpolatedFieldMap_kernels = {
             xo.Arg(xo.Float64, pointer=True, name='y'),
             xo.Arg(xo.Float64, pointer=True, name='z'),
             xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Float64, pointer=False, name='charge_factor'),
             xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_state'),
+            xo.Arg(xo.Int64,   pointer=True,  name='indices'),
+            xo.Arg(xo.Int32,   pointer=False, name='use_indices'),
             xo.Arg(xo.Float64, pointer=False, name='x0'),
             xo.Arg(xo.Float64, pointer=False, name='y0'),
             xo.Arg(xo.Float64, pointer=False, name='z0'),
@@ -66,9 +73,37 @@ _TriCubicInterpolatedFieldMap_kernels = {
             ],
         n_threads='nparticles'
         ),
+    'TriCubicInterpolatedFieldMap_fill_coefficient_cache': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_cells'),
+            xo.Arg(xo.Int64,   pointer=True,  name='cells'),
+            ],
+        n_threads='n_cells'
+        ),
+    'TriCubicInterpolatedFieldMap_interpolate_vector': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_points'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Float64, pointer=True,  name='phi'),
+            xo.Arg(xo.Float64, pointer=True,  name='dphi_dx'),
+            xo.Arg(xo.Float64, pointer=True,  name='dphi_dy'),
+            xo.Arg(xo.Float64, pointer=True,  name='dphi_dz'),
+            ],
+        n_threads='n_points'
+        ),
     }
 
 
+_phi_taylor_storages = {'float64': 0, 'float32': 1, 'int16': 2}
+_phi_taylor_names = ('phi', 'dphi_dx', 'dphi_dy', 'dphi_dz', 'd2phi_dxdy',
+                     'd2phi_dxdz', 'd2phi_dydz', 'd3phi_dxdydz')
+_int16_max = np.iinfo(np.int16).max
+
+
 class TriCubicInterpolatedFieldMap(xo.HybridClass):
 
     """
@@ -130,6 +165,23 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        cache_coefficients (bool or int): If ``True``, the 64 coefficients
+            of the interpolating polynomial of each cell are precomputed and
+            stored in the fieldmap (using eight times the memory of a
+            float64 ``phi_taylor``), so that the interpolation reduces to the
+            evaluation of the polynomial. If an integer is given, space is
+            allocated only for that number of cells, which are chosen among
+            the ones visited by the beam (see
+            :meth:`update_coefficient_cache`). The coefficients of the cells
+            that are not cached are computed at each interpolation. The
+            default is ``False``.
+        phi_taylor_dtype (str): Storage type of ``phi_taylor``:
+            ``'float64'`` (default), ``'float32'``, or ``'int16'``. With
+            ``'int16'`` the values are quantized with one scale factor per
+            quantity and longitudinal slice. The values are converted back to
+            double precision when the interpolating polynomial is built, and
+            the stored map can only be set through :meth:`update_phi_taylor`
+            (see also :meth:`phi_taylor_storage_error`).
     Returns:
         (TriCubicInterpolatedFieldMap): Interpolator object.
     """
@@ -148,6 +200,12 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         'dy': xo.Float64,
         'dz': xo.Float64,
         'phi_taylor': xo.Float64[:],
+        'phi_taylor_f32': xo.Float32[:],
+        'phi_taylor_i16': xo.Int16[:],
+        'phi_taylor_scale': xo.Float64[:],
+        'phi_taylor_storage': xo.Int64,
+        'coefficients': xo.Float64[:],
+        'coefficient_slots': xo.Int64[:],
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -183,14 +241,25 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  phi_taylor=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
+                 cache_coefficients=False,
+                 phi_taylor_dtype='float64',
                  ):
 
+        self.updatable = updatable
+        # Largest values and conversion errors of the quantities set through
+        # update_phi_taylor (see phi_taylor_storage_error)
+        self._storage_max_value = np.zeros(8)
+        self._storage_max_error = np.zeros(8)
+
         if _xobject is not None:
             self.xoinitialize(_xobject=_xobject, _context=_context,
                              _buffer=_buffer, _offset=_offset)
+            # Grids from the stored parameters
+            self._x_grid = self._x_min + self._dx * np.arange(self._nx)
+            self._y_grid = self._y_min + self._dy * np.arange(self._ny)
+            self._z_grid = self._z_min + self._dz * np.arange(self._nz)
             return
 
-        self.updatable = updatable
         self.scale_coordinates_in_solver = scale_coordinates_in_solver
 
         self._x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
@@ -198,6 +267,21 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         self._z_grid = _configure_grid('z', z_grid, dz, z_range, nz)
 
         nelem = self.nx*self.ny*self.nz*8
+
+        if phi_taylor_dtype not in _phi_taylor_storages:
+            raise ValueError(f'phi_taylor_dtype {phi_taylor_dtype} not '
+                             f'recognized, use one of {list(_phi_taylor_storages)}')
+        storage = _phi_taylor_storages[phi_taylor_dtype]
+
+        n_cells = (self.nx - 1) * (self.ny - 1) * (self.nz - 1)
+        if cache_coefficients is True:
+            n_cached_cells = n_cells
+        elif cache_coefficients is False or cache_coefficients is None:
+            n_cached_cells = 0
+        else:
+            assert cache_coefficients > 0, (
+                'cache_coefficients must be a boolean or a positive integer')
+            n_cached_cells = min(int(cache_coefficients), n_cells)
         self.xoinitialize(
                  _context=_context,
                  _buffer=_buffer,
@@ -214,13 +298,22 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  mirror_x = mirror_x,
                  mirror_y = mirror_y,
                  mirror_z = mirror_z,
-                 phi_taylor = nelem
+                 phi_taylor = nelem if storage == 0 else 0,
+                 phi_taylor_f32 = nelem if storage == 1 else 0,
+                 phi_taylor_i16 = nelem if storage == 2 else 0,
+                 phi_taylor_scale = 8 * self.nz if storage == 2 else 0,
+                 phi_taylor_storage = storage,
+                 coefficients = 64 * n_cached_cells,
+                 coefficient_slots = n_cells if n_cached_cells > 0 else 0,
                  )
+        self._reset_coefficient_cache()
 
         self.compile_kernels(only_if_needed=True)
 
         if phi_taylor is not None:
-            self.phi_taylor = phi_taylor
+            self.update_phi_taylor(phi_taylor)
+            if n_cached_cells == n_cells:
+                self.update_coefficient_cache()
         else:
             # Set rho
             if rho is not None:
@@ -236,26 +329,191 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
     def _assert_updatable(self):
         assert self.updatable, 'This FieldMap is not updatable!'
 
+    def update_phi_taylor(self, phi_taylor, first_slice=0):
+
+        """
+        Sets the normalized potential and its derivatives at the grid points,
+        converting them to the storage type of the fieldmap. The map can be
+        set slice by slice. The cached coefficients of the cells touching the
+        updated slices are discarded, and computed on the fly until
+        :meth:`update_coefficient_cache` is called again.
+
+        Args:
+            phi_taylor (np.ndarray): Values at the grid points, with shape
+                (n_slices, ny, nx, 8) or flattened in the same order (see the
+                ``phi_taylor`` argument of the constructor).
+            first_slice (int): Longitudinal index of the first provided slice.
+                The default is 0.
+        """
+
+        nx, ny, nz = self._nx, self._ny, self._nz
+        phi_taylor = np.asarray(phi_taylor, dtype=np.float64).reshape(
+                                                            -1, ny, nx, 8)
+        n_slices = phi_taylor.shape[0]
+        assert 0 <= first_slice and first_slice + n_slices <= nz, (
+            'Slices outside the grid')
+
+        self._reset_coefficient_cache(first_slice, n_slices)
+
+        context = self._context
+        start = 8 * nx * ny * first_slice
+        end = start + phi_taylor.size
+
+        storage = self._phi_taylor_storage
+        if storage == 0:
+            # No conversion error, the values are copied directly (also from
+            # a memory-mapped file)
+            self._phi_taylor[start:end] = context.nparray_to_context_array(
+                                                        phi_taylor.ravel())
+            return
+        elif storage == 1:
+            stored = phi_taylor.astype(np.float32)
+            self._phi_taylor_f32[start:end] = context.nparray_to_context_array(
+                                                        stored.flatten())
+        else:
+            # One scale per quantity and slice
+            max_abs = np.abs(phi_taylor).max(axis=(1, 2))
+            scale = np.where(max_abs > 0, max_abs / _int16_max, 1.)
+            quantized = np.round(
+                phi_taylor / scale[:, None, None, :]).astype(np.int16)
+            stored = quantized * scale[:, None, None, :]
+            self._phi_taylor_i16[start:end] = context.nparray_to_context_array(
+                                                        quantized.flatten())
+            self._phi_taylor_scale[8 * first_slice:8 * (first_slice + n_slices)] = (
+                    context.nparray_to_context_array(scale.flatten()))
+
+        self._storage_max_value = np.maximum(self._storage_max_value,
+                np.abs(phi_taylor).max(axis=(0, 1, 2)))
+        self._storage_max_error = np.maximum(self._storage_max_error,
+                np.abs(stored - phi_taylor).max(axis=(0, 1, 2)))
+
+    def phi_taylor_storage_error(self):
+
+        """
+        Returns the maximum error introduced by the storage type on the values
+        set through :meth:`update_phi_taylor`, with respect to the double
+        precision values, relative to the largest absolute value of each
+        quantity.
+
+        Returns:
+            (dict): Relative error for each of the eight quantities stored in
+            ``phi_taylor``.
+        """
+
+        max_value = np.where(self._storage_max_value > 0,
+                             self._storage_max_value, 1.)
+        rel_error = self._storage_max_error / max_value
+        return {nn: float(ee) for nn, ee in zip(_phi_taylor_names, rel_error)}
+
+    @property
+    def n_cached_cells(self):
+        """
+        Number of cells for which the coefficients of the interpolating
+        polynomial can be cached.
+        """
+        return len(self._coefficients) // 64
+
+    def _reset_coefficient_cache(self, first_slice=0, n_slices=None):
+
+        # Marks as not cached the cells touching the given slices of nodes
+        # (all by default)
+        if len(self._coefficient_slots) == 0:
+            return
+        if n_slices is None:
+            n_slices = self._nz - first_slice
+        cells_per_slice = (self._nx - 1) * (self._ny - 1)
+        start = cells_per_slice * max(first_slice - 1, 0)
+        end = cells_per_slice * min(first_slice + n_slices, self._nz - 1)
+        if end > start:
+            self._coefficient_slots[start:end] = (
+                self._context.nparray_to_context_array(
+                    np.full(end - start, -1, dtype=np.int64)))
+
+    def update_coefficient_cache(self, x=None, y=None, z=None):
+
+        """
+        Computes the coefficients of the interpolating polynomial of the
+        cached cells from ``phi_taylor``. It needs to be called again after
+        ``phi_taylor`` is modified.
+
+        Args:
+            x (float64 array): Horizontal coordinates of the particles
+                (as seen by the interpolation, i.e. after any shift).
+            y (float64 array): Vertical coordinates of the particles.
+            z (float64 array): Longitudinal coordinates of the particles.
+                If the coordinates are provided, the cells containing the
+                largest number of particles are cached (up to
+                :attr:`n_cached_cells`). They can be omitted only if all the
+                cells can be cached.
+        """
+
+        n_cells = (self._nx - 1) * (self._ny - 1) * (self._nz - 1)
+        assert self.n_cached_cells > 0, (
+            'The fieldmap has no coefficient cache (see cache_coefficients)')
+
+        context = self._context
+        if x is None:
+            if self.n_cached_cells < n_cells:
+                raise ValueError('The coordinates of the particles are needed '
+                                 'to choose the cells to be cached')
+            cells = np.arange(n_cells, dtype=np.int64)
+        else:
+            cells = self._visited_cells(x, y, z)[:self.n_cached_cells]
+
+        slots = np.full(n_cells, -1, dtype=np.int64)
+        slots[cells] = np.arange(len(cells))
+
+        if len(cells) > 0:
+            context.kernels.TriCubicInterpolatedFieldMap_fill_coefficient_cache(
+                    fmap=self._xobject,
+                    n_cells=len(cells),
+                    cells=context.nparray_to_context_array(cells))
+        self._coefficient_slots[:] = context.nparray_to_context_array(slots)
+
+    def _visited_cells(self, x, y, z):
+
+        # Cells containing the given points, sorted by decreasing number of
+        # points (same conventions as TriCubicInterpolatedFieldMap_interpolate_grad)
+        p2np = self._context.nparray_from_context_array
+        ii = []
+        for coord, v_min, dv, nv, mirror in (
+                (x, self._x_min, self._dx, self._nx, self._mirror_x),
+                (y, self._y_min, self._dy, self._ny, self._mirror_y),
+                (z, self._z_min, self._dz, self._nz, self._mirror_z)):
+            fv = (np.atleast_1d(p2np(coord)) - v_min) / dv
+            if mirror == 1:
+                fv = np.abs(fv)
+            ii.append(np.floor(fv))
+        ix, iy, iz = ii
+
+        inside = ((ix >= 0) & (ix <= self._nx - 2)
+                  & (iy >= 0) & (iy <= self._ny - 2)
+                  & (iz >= 0) & (iz <= self._nz - 2))
+        cells = (ix[inside] + (self._nx - 1) * (iy[inside]
+                 + (self._ny - 1) * iz[inside])).astype(np.int64)
+        cells, counts = np.unique(cells, return_counts=True)
+        return cells[np.argsort(-counts, kind='stable')]
+
     #@profile
     def get_values_at_points(self,
             x, y, z,
-            return_rho=True,
+            return_rho=False,
             return_phi=True,
             return_dphi_dx=True,
             return_dphi_dy=True,
             return_dphi_dz=True):
 
         """
-        Returns the charge density, the field potential and its derivatives
-        at the points specified by x, y, z. The output can be customized (see below).
+        Returns the field potential and its derivatives at the points
+        specified by x, y, z. The output can be customized (see below).
         Zeros are returned for points outside the grid.
 
         Args:
             x (float64 array): Horizontal coordinates at which the field is evaluated.
             y (float64 array): Vertical coordinates at which the field is evaluated.
             z (float64 array): Longitudinal coordinates at which the field is evaluated.
-            return_rho (bool): If ``True``, the charge density at the given points is
-                returned.
+            return_rho (bool): Not available, as the charge density is not
+                stored in the tricubic fieldmap.
             return_phi (bool): If ``True``, the potential at the given points is returned.
             return_dphi_dx (bool): If ``True``, the horizontal derivative of the potential
                 at the given points is returned.
@@ -267,48 +525,29 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
             (tuple of float64 array): The required quantities at the provided points.
         """
 
-        #raise Exception("Method not checked/implemented.")
-        raise NotImplementedError
+        if return_rho:
+            raise NotImplementedError(
+                'The charge density is not stored in the tricubic fieldmap')
 
         assert len(x) == len(y) == len(z)
 
-        pos_in_buffer_of_maps_to_interp = []
-        if return_rho:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.rho._offset + self._xobject.rho._data_offset)
-        if return_phi:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.phi._offset + self._xobject.phi._data_offset)
-        if return_dphi_dx:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dx._offset + self._xobject.dphi_dx._data_offset)
-        if return_dphi_dy:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dy._offset + self._xobject.dphi_dy._data_offset)
-        if return_dphi_dz:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dz._offset + self._xobject.dphi_dz._data_offset)
-
         context = self._buffer.context
 
-        pos_in_buffer_of_maps_to_interp = context.nparray_to_context_array(
-                        np.array(pos_in_buffer_of_maps_to_interp, dtype=np.int64))
-        nmaps_to_interp = len(pos_in_buffer_of_maps_to_interp)
-        buffer_out = context.zeros(
-                shape=(nmaps_to_interp * len(x),), dtype=np.float64)
-        if nmaps_to_interp > 0:
-            context.kernels.TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
+        # The potential and the three derivatives are computed in one pass
+        buffer_out = context.zeros(shape=(4, len(x)), dtype=np.float64)
+        if len(x) > 0:
+            context.kernels.TriCubicInterpolatedFieldMap_interpolate_vector(
                     fmap=self._xobject,
                     n_points=len(x),
                     x=x, y=y, z=z,
-                    n_quantities=nmaps_to_interp,
-                    buffer_mesh_quantities=self._buffer.buffer,
-                    offsets_mesh_quantities=pos_in_buffer_of_maps_to_interp,
-                    particles_quantities=buffer_out)
-
-        # Split buffer 
-        particles_quantities = [buffer_out[ii*len(x):(ii+1)*len(x)]
-                                        for ii in range(nmaps_to_interp)]
+                    phi=buffer_out[0, :],
+                    dphi_dx=buffer_out[1, :],
+                    dphi_dy=buffer_out[2, :],
+                    dphi_dz=buffer_out[3, :])
+
+        flags = (return_phi, return_dphi_dx, return_dphi_dy, return_dphi_dz)
+        particles_quantities = [buffer_out[ii, :]
+                                for ii, ff in enumerate(flags) if ff]
 
         return particles_quantities
 
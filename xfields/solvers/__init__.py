@@ -3,4 +3,7 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
-from .fftsolvers import FFTSolver3D, FFTSolver2p5D
\ No newline at end of file
+from .fftsolvers import FFTSolver2D, FFTSolver3D, FFTSolver2p5D
+from .fftsolvers import RFFTSolver3D, RFFTSolver2p5D
+from .fftsolvers import DSTSolver2D, DSTSolver2p5D
+from .fftsolvers import GreenFunctionCache, green_function_cache
@@ -3,11 +3,110 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import functools
+import os
+import threading
+import weakref
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from xobjects import ContextCupy
+
+# Thread pool used for the asynchronous solves (created when first needed)
+_executor = None
+_executor_lock = threading.Lock()
+
+# Solvers on the same context may share workspaces, hence their use of the
+# workspaces (synchronous or asynchronous) is serialized. The locks do not
+# keep the contexts alive.
+_context_locks = weakref.WeakKeyDictionary()
+
+
+class _ContextLock:
+
+    '''
+    Reentrant lock of a context. On GPU the lock is held only while the
+    kernels are queued, hence the last holder records an event on its stream
+    and the next holder waits for it on its own stream, so that the work on
+    the shared workspaces is ordered also across streams.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.event = None
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                    max_workers=min(4, os.cpu_count() or 1),
+                    thread_name_prefix='xfields_solver')
+        return _executor
+
+def _get_context_lock(context):
+    with _executor_lock:
+        return _context_locks.setdefault(context, _ContextLock())
+
+def _serialized_on_context(method):
+
+    '''
+    Decorator for the solver methods using workspaces shared on the context:
+    they hold the lock of the context, hence they never use the workspaces
+    concurrently with another solve, synchronous or asynchronous (the lock
+    is reentrant, so that they can call each other).
+    '''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        context_lock = _get_context_lock(self.context)
+        with context_lock.lock:
+            if not isinstance(self.context, ContextCupy):
+                return method(self, *args, **kwargs)
+            import cupy
+            stream = cupy.cuda.get_current_stream()
+            if context_lock.event is not None:
+                stream.wait_event(context_lock.event)
+            res = method(self, *args, **kwargs)
+            context_lock.event = stream.record()
+            return res
+    return wrapper
+
+def _submit_async(context, func):
+
+    '''
+    Runs ``func`` (a function without arguments) in the thread pool of the
+    solvers and returns the corresponding future. On GPU the task waits for
+    the work already queued on the stream of the caller (e.g. the charge
+    deposition).
+    '''
+
+    event = None
+    if isinstance(context, ContextCupy):
+        import cupy
+        event = cupy.cuda.get_current_stream().record()
+    return _get_executor().submit(_run_on_context, context, func, event)
+
+def _run_on_context(context, func, event=None):
+    if isinstance(context, ContextCupy):
+        import cupy
+        stream = cupy.cuda.Stream(non_blocking=True)
+        if event is not None:
+            stream.wait_event(event)
+        with stream:
+            res = func()
+        stream.synchronize()
+        return res
+    return func()
 
 
 class Solver(ABC):
 
+    # True for the solvers whose solve returns an array owned by the solver,
+    # which is overwritten by the next solve
+    _solve_returns_solver_storage = False
+
     @abstractmethod
     def __init__(self, context=None, **kwargs):
         pass
@@ -16,4 +115,52 @@ class Solver(ABC):
     def solve(self, rho):
         return phi
 
+    def solve_async(self, rho):
+
+        '''
+        Solves Poisson's equation for a given charge density without
+        blocking the caller. The solve is executed by a thread pool (on GPU
+        in a separate CUDA stream), so that it can overlap with other work,
+        e.g. the charge deposition of another bunch.
+
+        Args:
+            rho (float array): charge density at the grid points in
+                Coulomb/m^3. It must not be modified before the result is
+                available.
+        Returns:
+            (concurrent.futures.Future): Future whose result is the electric
+            potential at the grid points in Volts (an array owned by the
+            caller).
+        '''
+
+        if self._solve_returns_solver_storage:
+            return _submit_async(self.context,
+                                 lambda: self._solve_and_copy(rho))
+        return _submit_async(self.context, lambda: self.solve(rho))
+
+    @_serialized_on_context
+    def _solve_and_copy(self, rho):
+        # The result is written into an array allocated by the context (not
+        # all the array types support copying in Fortran order) before
+        # another solve can overwrite it
+        phi = self.context.zeros(rho.shape, dtype=self.dtype, order='F')
+        self.solve_into(rho, phi)
+        return phi
+
+    def solve_into(self, rho, phi):
+
+        '''
+        Solves Poisson's equation for a given charge density and writes the
+        potential into a provided array, avoiding intermediate copies where
+        the solver allows it.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+            phi (float64 array): Fortran ordered array receiving the electric
+                potential at the grid points in Volts. It can be the same
+                array as ``rho``.
+        '''
 
+        # The transposes make it faster in cupy (C-contigous arrays)
+        phi.T[:, :, :] = self.solve(rho).T
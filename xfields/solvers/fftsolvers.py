@@ -3,18 +3,304 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import hashlib
+import inspect
+import os
+import tempfile
+import weakref
+from pathlib import Path
+
 import numpy as np
 from scipy.constants import epsilon_0
 from numpy import pi
 
-from .base import Solver
+from .base import Solver, _serialized_on_context
+
+import xobjects as xo
+from xobjects import context_default, ContextPyopencl
+
+from ..general import _pkg_root
+
+# Workspaces (and the associated fft plans) are shared among all solvers
+# having the same grid shape on the same context. Entries are dropped
+# automatically when no solver refers to them anymore.
+_workspace_pool = weakref.WeakValueDictionary()
+
+
+class FFTWorkspace:
+
+    '''
+    Complex array, with the associated fft plan, used by the FFT solvers to
+    store the (zero-padded) charge density and compute the potential in place.
+
+    Args:
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the workspace is allocated.
+        shape (tuple): Shape of the workspace array.
+        dtype (np.dtype): Data type of the workspace array.
+        axes (tuple): Axes along which the fft is performed.
+        fftplan (FFT plan object): fft plan to be used. If ``None`` a new plan
+            is created. No plan is created for real workspaces (real-to-complex
+            transforms are not performed in place).
+        with_plan (bool): If ``False`` no plan is created also for complex
+            workspaces (e.g. the half spectrum of real-to-complex transforms).
+    Returns:
+        (FFTWorkspace): Workspace object.
+    '''
+
+    def __init__(self, context, shape, dtype, axes, fftplan=None,
+                 with_plan=True):
+
+        self.context = context
+        self.data = context.zeros(shape, dtype=dtype, order='F')
+        if (fftplan is None and with_plan
+                and np.issubdtype(dtype, np.complexfloating)):
+            fftplan = context.plan_FFT(self.data, axes=axes)
+        self.fftplan = fftplan
+
+        # True when the padding region needs to be cleared before use
+        self.padding_dirty = False
+
+
+def get_fft_workspace(context, shape, dtype=np.complex128, axes=(0, 1, 2),
+                      fftplan=None, with_plan=True):
+
+    '''
+    Returns the workspace shared by all solvers with the given shape, context,
+    dtype, fft axes and fft plan, creating it if it does not exist.
+
+    Args:
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the workspace is allocated.
+        shape (tuple): Shape of the workspace array.
+        dtype (np.dtype): Data type of the workspace array.
+        axes (tuple): Axes along which the fft is performed.
+        fftplan (FFT plan object): fft plan to be used. If ``None`` the
+            workspace is shared with all solvers not providing a plan (a new
+            plan is created if needed), otherwise only with the solvers
+            providing the same plan.
+        with_plan (bool): If ``False`` no plan is created for a complex
+            workspace.
+    Returns:
+        (FFTWorkspace): Workspace object.
+    '''
+
+    # A workspace holds its plan, hence the id of a provided plan is not
+    # reused while the workspace is in the pool
+    key = (context, tuple(shape), np.dtype(dtype), tuple(axes),
+           None if fftplan is None else id(fftplan), with_plan)
+    workspace = _workspace_pool.get(key, None)
+    if workspace is None:
+        workspace = FFTWorkspace(context=context, shape=shape, dtype=dtype,
+                                 axes=axes, fftplan=fftplan,
+                                 with_plan=with_plan)
+        _workspace_pool[key] = workspace
+    return workspace
+
+
+class GreenFunctionCache:
+
+    '''
+    Store of the transformed integrated Green functions used by the FFT
+    solvers. Solvers with the same kind and grid on the same context share
+    the same array, which is dropped from memory when no solver refers to it
+    anymore (e.g. with adaptive grids). If ``cache_dir`` is set, the Green
+    functions are also
+    saved there as .npy files, named after a hash of the kind and of the
+    grid, and are memory-mapped when loaded in a later session.
+
+    Args:
+        cache_dir (str or Path): Directory in which the Green functions are
+            stored. If ``None`` (default) they are kept only in memory.
+    Returns:
+        (GreenFunctionCache): Cache object.
+    '''
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._arrays = weakref.WeakValueDictionary()
+
+    def clear(self):
+        '''
+        Removes all the Green functions held in memory (files on disk are
+        kept).
+        '''
+        self._arrays.clear()
+
+    def get(self, context, kind, cell_sizes, shape, dtype, builder):
+
+        '''
+        Returns a transformed Green function, building it if it is not found
+        in memory or on disk.
+
+        Args:
+            context (XfContext): identifies the :doc:`context <contexts>`
+                on which the Green function is needed.
+            kind (str): Kind of Green function (identifies the solver type).
+            cell_sizes (tuple): Cell sizes (after rescaling) in meters.
+            shape (tuple): Number of cells.
+            dtype (np.dtype): Data type of the returned array.
+            builder (callable): Function without arguments returning the
+                Green function as a double precision numpy array.
+        Returns:
+            (array): Green function on the given context. It is shared and
+            must not be modified.
+        '''
+
+        grid_key = ((kind,) + tuple(float(dd) for dd in cell_sizes)
+                            + tuple(int(nn) for nn in shape))
+        key = (context, grid_key, np.dtype(dtype))
+
+        gfun_dev = self._arrays.get(key, None)
+        if gfun_dev is None:
+            gfun = self._load_or_build(grid_key, builder)
+            gfun = gfun.astype(dtype, order='F', copy=False)
+            gfun_dev = context.nparray_to_context_array(gfun)
+            self._arrays[key] = gfun_dev
+
+        return gfun_dev
+
+    def _load_or_build(self, grid_key, builder):
+
+        if self.cache_dir is None:
+            return np.asfortranarray(builder())
+
+        cache_dir = Path(self.cache_dir)
+        fname = cache_dir.joinpath(
+            hashlib.sha256(repr(grid_key).encode()).hexdigest()[:32] + '.npy')
+
+        if fname.exists():
+            return np.load(fname, mmap_mode='r')
+
+        gfun = np.asfortranarray(builder())
+
+        # Write to a temporary file first, so that other processes never
+        # see a partially written file
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npy',
+                                         delete=False) as fid:
+            np.save(fid, gfun)
+        os.replace(fid.name, fname)
+
+        return np.load(fname, mmap_mode='r')
+
+green_function_cache = GreenFunctionCache()
 
-from xobjects import context_default
 
 class FFTSolver2D(Solver):
 
+    '''
+    Creates a Poisson solver object that solves the 2D Poisson equation
+    using the FFT method (free space). A stack of independent 2D charge
+    densities (e.g. several lenses or slices) can be solved with a single
+    batched FFT.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        dtype (np.dtype): Floating point precision used in the solver,
+            ``np.float64`` (default) or ``np.float32``.
+    Returns:
+        (FFTSolver2D): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, nx, ny, context=None, fftplan=None,
+                 dtype=np.float64):
+
+        if context is None:
+            context = context_default
+        self.context = context
+        self.dtype = np.dtype(dtype)
+        complex_dtype = _get_complex_dtype(dtype)
+
+        _compile_solver_kernels(context)
+
+        # Transformed integrated Green function
+        gint_rep_transf_dev = green_function_cache.get(
+                context=context, kind='FFTSolver2D',
+                cell_sizes=(dx, dy), shape=(nx, ny),
+                dtype=complex_dtype,
+                builder=lambda: np.fft.fftn(
+                    _integrated_green_function_2p5d(dx, dy, nx, ny),
+                    axes=(0,1)))
+
+        self.dx = dx
+        self.dy = dy
+        self.nx = nx
+        self.ny = ny
+        self._gint_rep_transf_dev = gint_rep_transf_dev
+        self._kernel_suffix = '_f32' if self.dtype == np.float32 else ''
+        self._workspaces = {}
+        self.fftplan = self._get_workspace(1, fftplan=fftplan).fftplan
+
+    def _get_workspace(self, n_maps, fftplan=None):
+        if n_maps not in self._workspaces:
+            self._workspaces[n_maps] = get_fft_workspace(
+                    context=self.context,
+                    shape=(2*self.nx, 2*self.ny, n_maps),
+                    dtype=_get_complex_dtype(self.dtype), axes=(0,1),
+                    fftplan=fftplan)
+        return self._workspaces[n_maps]
+
+    #@profile
+    @_serialized_on_context
     def solve(self, rho):
-        pass
+
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+
+        Args:
+            rho (float array): charge density at the grid points in
+                Coulomb/m^3, with shape (nx, ny), or a stack of independent
+                charge densities with shape (nx, ny, n_maps).
+        Returns:
+            phi (float array): electric potential at the grid points in Volts,
+                with the same shape as ``rho`` (an array owned by the caller).
+        '''
+
+        nx, ny = self.nx, self.ny
+
+        if rho.ndim == 2:
+            rho_maps = rho.reshape((nx, ny, 1), order='F')
+        else:
+            rho_maps = rho
+        n_maps = rho_maps.shape[2]
+
+        workspace = self._get_workspace(n_maps)
+        _workspace_dev = workspace.data
+        if workspace.padding_dirty:
+            # The transposes make it faster in cupy (C-contigous arrays)
+            _workspace_dev.T[:, :, nx:] = 0
+            _workspace_dev.T[:, ny:, :nx] = 0
+            workspace.padding_dirty = False
+
+        _workspace_dev.T[:, :ny, :nx] = rho_maps.T
+        workspace.fftplan.transform(_workspace_dev) # rho_rep_hat
+
+        # The same Green function is applied to all maps
+        self.context.kernels['fftsolver2p5d_multiply_green'
+                             + self._kernel_suffix](
+                nelem_slice=4*nx*ny, nelem=4*nx*ny*n_maps,
+                gint_rep_transf=self._gint_rep_transf_dev.T.view(self.dtype),
+                workspace=_workspace_dev.T.view(self.dtype)) # phi_rep_hat
+
+        workspace.fftplan.itransform(_workspace_dev) #phi_rep
+        workspace.padding_dirty = True
+
+        # The workspace is shared with other solvers, the result is copied
+        # into an array allocated by the context (not all the array types
+        # support copying in Fortran order)
+        phi = self.context.zeros((nx, ny, n_maps), dtype=self.dtype,
+                                 order='F')
+        # The transposes make it faster in cupy (C-contigous arrays)
+        phi.T[:, :, :] = _workspace_dev.real[:nx, :ny, :].T
+        if rho.ndim == 2:
+            phi = phi[:, :, 0]
+        return phi
 
 class FFTSolver3D(Solver):
 
@@ -31,65 +317,38 @@ class FFTSolver3D(Solver):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        dtype (np.dtype): Floating point precision used in the solver,
+            ``np.float64`` (default) or ``np.float32``. In single precision
+            the ffts are performed in complex64 and the potential is
+            returned as a float32 array.
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 dtype=np.float64):
 
         if context is None:
             context = context_default
 
         self.context = context
-
-        # Prepare arrays
-        workspace_dev = context.nparray_to_context_array(
-                    np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F'))
-
-
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        zg_F = np.arange(0, nz+2) * dz - dz/2
-        XX_F, YY_F, ZZ_F = np.meshgrid(xg_F, yg_F, zg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_3d(XX_F, YY_F, ZZ_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1, :nz+1] = (F_temp[ 1:,  1:,  1:]
-                                       - F_temp[:-1,  1:,  1:]
-                                       - F_temp[ 1:, :-1,  1:]
-                                       + F_temp[:-1, :-1,  1:]
-                                       - F_temp[ 1:,  1:, :-1]
-                                       + F_temp[:-1,  1:, :-1]
-                                       + F_temp[ 1:, :-1, :-1]
-                                       - F_temp[:-1, :-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1, :nz+1] = gint_rep[nx-1:0:-1, :ny+1,     :nz+1    ]
-        gint_rep[:nx+1, ny+1:, :nz+1] = gint_rep[:nx+1,     ny-1:0:-1, :nz+1    ]
-        gint_rep[nx+1:, ny+1:, :nz+1] = gint_rep[nx-1:0:-1, ny-1:0:-1, :nz+1    ]
-        gint_rep[:nx+1, :ny+1, nz+1:] = gint_rep[:nx+1,     :ny+1,     nz-1:0:-1]
-        gint_rep[nx+1:, :ny+1, nz+1:] = gint_rep[nx-1:0:-1, :ny+1,     nz-1:0:-1]
-        gint_rep[:nx+1, ny+1:, nz+1:] = gint_rep[:nx+1,     ny-1:0:-1, nz-1:0:-1]
-        gint_rep[nx+1:, ny+1:, nz+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1, nz-1:0:-1]
-
-        self._gint_rep = gint_rep.copy()
-
-        # Tranasfer to device
-        gint_rep_dev = context.nparray_to_context_array(gint_rep)
-
-        # Prepare fft plan
-        if fftplan is None:
-            fftplan = context.plan_FFT(workspace_dev, axes=(0,1,2))
-
-        # Transform the green function (in place)
-        fftplan.transform(gint_rep_dev)
+        self.dtype = np.dtype(dtype)
+        complex_dtype = _get_complex_dtype(dtype)
+
+        # Get workspace and fft plan (shared with other solvers on the same grid)
+        workspace = get_fft_workspace(context=context,
+                                      shape=(2*nx, 2*ny, 2*nz),
+                                      dtype=complex_dtype, axes=(0,1,2),
+                                      fftplan=fftplan)
+
+        # Transformed integrated Green function
+        gint_rep_dev = green_function_cache.get(
+                context=context, kind='FFTSolver3D',
+                cell_sizes=(dx, dy, dz), shape=(nx, ny, nz),
+                dtype=complex_dtype,
+                builder=lambda: np.fft.fftn(
+                    _integrated_green_function_3d(dx, dy, dz, nx, ny, nz),
+                    axes=(0,1,2)))
 
         self.dx = dx
         self.dy = dy
@@ -97,11 +356,27 @@ class FFTSolver3D(Solver):
         self.nx = nx
         self.ny = ny
         self.nz = nz
-        self._workspace_dev = workspace_dev
+        self._workspace = workspace
         self._gint_rep_transf_dev = gint_rep_dev
-        self.fftplan = fftplan
+        self.fftplan = workspace.fftplan
+
+    @property
+    def _workspace_dev(self):
+        return self._workspace.data
+
+    def _clear_padding(self):
+        workspace = self._workspace
+        if not workspace.padding_dirty:
+            return
+        # The transposes make it faster in cupy (C-contigous arrays)
+        _workspace_dev = workspace.data
+        _workspace_dev.T[:, :, self.nx:] = 0
+        _workspace_dev.T[:, self.ny:, :self.nx] = 0
+        _workspace_dev.T[self.nz:, :self.ny, :self.nx] = 0
+        workspace.padding_dirty = False
 
     #@profile
+    @_serialized_on_context
     def solve(self, rho):
 
         '''
@@ -111,32 +386,53 @@ class FFTSolver3D(Solver):
             rho (float64 array): charge density at the grid points in
                 Coulomb/m^3.
         Returns:
-            phi (float64 array): electric potential at the grid points in Volts.
+            phi (float array): electric potential at the grid points in Volts
+                (an array owned by the caller).
         '''
 
-        nz_alloc = self.nz
-        if self._gint_rep_transf_dev.shape[2] > 1:
-            nz_alloc = self._gint_rep_transf_dev.shape[2]
-        _workspace_dev = self.context.zeros(
-                (2*self.nx, 2*self.ny, nz_alloc), dtype=np.complex128, order='F')
+        # The workspace is shared with other solvers, the result is copied
+        # into an array allocated by the context (not all the array types
+        # support copying in Fortran order)
+        phi = self.context.zeros((self.nx, self.ny, self.nz),
+                                 dtype=self.dtype, order='F')
+        self.solve_into(rho, phi)
+        return phi
+
+    @_serialized_on_context
+    def solve_into(self, rho, phi):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density
+        and writes the potential into a provided array, directly from the
+        solver workspace.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+            phi (float64 array): Fortran ordered array receiving the electric
+                potential at the grid points in Volts. It can be the same
+                array as ``rho``.
+        '''
+
+        # The transposes make it faster in cupy (C-contigous arrays)
+        phi.T[:, :, :] = self._solve_in_workspace(rho).T
+
+    def _solve_in_workspace(self, rho):
+
+        # Returns a view on the workspace, valid until the next solve of any
+        # solver sharing it
+        _workspace_dev = self._workspace_dev
+        self._clear_padding()
 
         # The transposes make it faster in cupy (C-contigous arrays)
         _workspace_dev.T[:self.nz, :self.ny, :self.nx] = rho.T
         self.fftplan.transform(_workspace_dev) # rho_rep_hat
 
-        try:
-            _workspace_dev.T[:,:,:] *= (
-                        self._gint_rep_transf_dev.T) # phi_rep_hat
-        except Exception: # pyopencl does not support array broadcasting (used in 2.5D)
-            # Check F-contiguity
-            assert _workspace_dev.strides[0] == 16
-            assert self._gint_rep_transf_dev.strides[0] == 16
-
-            for ii in range(self.nz):
-                _workspace_dev.T[ii,:,:] *= (
-                        self._gint_rep_transf_dev.T[0, :, :]) # phi_rep_hat
+        _workspace_dev.T[:,:,:] *= (
+                    self._gint_rep_transf_dev.T) # phi_rep_hat
 
         self.fftplan.itransform(_workspace_dev) #phi_rep
+        self._workspace.padding_dirty = True
         return _workspace_dev.real[:self.nx, :self.ny, :self.nz]
 
 class FFTSolver2p5D(FFTSolver3D):
@@ -145,6 +441,10 @@ class FFTSolver2p5D(FFTSolver3D):
     Creates a Poisson solver object that solve's Poisson equation in
     the 2.5D aaoroximation equation the FFT method (free space).
 
+    The longitudinal slices are solved with a single batched 2D FFT, which
+    includes only the slices with non-negligible charge. The potential is
+    set to zero in the other slices.
+
     Args:
         nx (int): Number of cells in the horizontal direction.
         ny (int): Number of cells in the vertical direction.
@@ -154,55 +454,47 @@ class FFTSolver2p5D(FFTSolver3D):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        dtype (np.dtype): Floating point precision used in the solver,
+            ``np.float64`` (default) or ``np.float32``. In single precision
+            the ffts are performed in complex64 and the potential is
+            returned as a float32 array.
+        slice_charge_threshold (float): Slices for which the sum of the
+            absolute charge density is smaller or equal than this fraction
+            of the largest one are skipped. The default is 0 (only empty
+            slices are skipped).
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    _solve_returns_solver_storage = True
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 slice_charge_threshold=0., dtype=np.float64):
 
         if context is None:
             context = context_default
         self.context = context
-
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        XX_F, YY_F= np.meshgrid(xg_F, yg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_2p5d(XX_F, YY_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
-                                - F_temp[:-1,  1:]
-                                - F_temp[ 1:, :-1]
-                                + F_temp[:-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
-        gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
-        gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
-
-
-        # Prepare fft plan
-        if fftplan is None:
-            temp_dev = context.zeros((2*nx, 2*ny, nz),
-                                    dtype=np.complex128, order='F')
-            fftplan = context.plan_FFT(temp_dev, axes=(0,1))
-            del(temp_dev)
-
-        # Transform the green function
-        gint_rep_transf = np.zeros((2*nx, 2*ny),
-                           dtype=np.complex128, order='F')
-        gint_rep_transf[:, :] = np.fft.fftn(gint_rep, axes=(0,1))
-
-        # Transfer to GPU (if needed)
-        gint_rep_transf_dev = context.nparray_to_context_array(
-                                       np.atleast_3d(gint_rep_transf))
+        self.dtype = np.dtype(dtype)
+        complex_dtype = _get_complex_dtype(dtype)
+
+        _compile_solver_kernels(context)
+
+        # Get workspace and fft plan for all slices (shared with other solvers
+        # on the same grid). Workspaces for smaller batches are created when
+        # needed.
+        workspace = get_fft_workspace(context=context,
+                                      shape=(2*nx, 2*ny, nz),
+                                      dtype=complex_dtype, axes=(0,1),
+                                      fftplan=fftplan)
+
+        # Transformed integrated Green function (computed in double precision)
+        gint_rep_transf_dev = green_function_cache.get(
+                context=context, kind='FFTSolver2p5D',
+                cell_sizes=(dx, dy), shape=(nx, ny),
+                dtype=complex_dtype,
+                builder=lambda: np.atleast_3d(np.fft.fftn(
+                    _integrated_green_function_2p5d(dx, dy, nx, ny),
+                    axes=(0,1))))
 
         self.dx = dx
         self.dy = dy
@@ -210,56 +502,166 @@ class FFTSolver2p5D(FFTSolver3D):
         self.nx = nx
         self.ny = ny
         self.nz = nz
+        self.slice_charge_threshold = slice_charge_threshold
+        self._workspace = workspace
+        self._batch_workspaces = {nz: workspace}
         self._gint_rep_transf_dev = gint_rep_transf_dev
-        self.fftplan = fftplan
+        self._slice_charge_dev = context.zeros(nz, dtype=np.float64)
+        self._phi_dev = context.zeros((nx, ny, nz), dtype=self.dtype,
+                                      order='F')
+        # Occupied slices of the last solve and the corresponding index
+        # arrays on the device (uploaded only when the occupancy changes)
+        self._mask_occupied = None
+        self._batch_to_slice_dev = None
+        self._slice_to_batch_dev = None
+        self._kernel_suffix = '_f32' if self.dtype == np.float32 else ''
+        self.fftplan = workspace.fftplan
+
+    def _get_batch_workspace(self, n_occupied):
+        # Batch sizes are rounded up to powers of two to limit the number of
+        # workspaces and fft plans
+        n_batch = min(self.nz, 1 << int(np.ceil(np.log2(n_occupied))))
+        if n_batch not in self._batch_workspaces:
+            self._batch_workspaces[n_batch] = get_fft_workspace(
+                    context=self.context,
+                    shape=(2*self.nx, 2*self.ny, n_batch),
+                    dtype=_get_complex_dtype(self.dtype), axes=(0,1))
+        return self._batch_workspaces[n_batch]
+
+    #@profile
+    @_serialized_on_context
+    def solve(self, rho):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3 (Fortran ordered).
+        Returns:
+            phi (float array): electric potential at the grid points in Volts.
+                The returned array is owned by the solver and is overwritten
+                by the next solve.
+        '''
+
+        return self._solve(rho, self._phi_dev)
+
+    @_serialized_on_context
+    def solve_into(self, rho, phi):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density
+        and writes the potential into a provided array. In double precision
+        the result is written directly by the solver kernels.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3 (Fortran ordered).
+            phi (float64 array): Fortran ordered array receiving the electric
+                potential at the grid points in Volts. It can be the same
+                array as ``rho``.
+        '''
+
+        if self.dtype != np.float64:
+            return Solver.solve_into(self, rho, phi)
+
+        assert phi.flags.f_contiguous, 'phi must be Fortran ordered'
+        self._solve(rho, phi)
+
+    def _solve(self, rho, phi):
+
+        assert rho.flags.f_contiguous, 'rho must be Fortran ordered'
+
+        context = self.context
+        nx, ny, nz = self.nx, self.ny, self.nz
+
+        # Identify occupied slices (only the nz slice charges are read back
+        # from the device)
+        context.kernels.fftsolver2p5d_slice_charge(
+                nx=nx, ny=ny, nz=nz, rho=rho,
+                slice_charge=self._slice_charge_dev)
+        slice_charge = context.nparray_from_context_array(
+                                                self._slice_charge_dev)
+        max_slice_charge = np.max(slice_charge)
+        mask_occupied = ((slice_charge > 0)
+                  & (slice_charge > self.slice_charge_threshold * max_slice_charge))
+        n_occupied = int(np.count_nonzero(mask_occupied))
+
+        if n_occupied == 0:
+            phi[:, :, :] = 0
+            return phi
+
+        if (self._mask_occupied is None
+                or not np.array_equal(mask_occupied, self._mask_occupied)):
+            batch_to_slice = np.where(mask_occupied)[0].astype(np.int64)
+            slice_to_batch = np.zeros(nz, dtype=np.int64) - 1
+            slice_to_batch[batch_to_slice] = np.arange(n_occupied)
+            self._batch_to_slice_dev = context.nparray_to_context_array(
+                                                            batch_to_slice)
+            self._slice_to_batch_dev = context.nparray_to_context_array(
+                                                            slice_to_batch)
+            self._mask_occupied = mask_occupied
+
+        workspace = self._get_batch_workspace(n_occupied)
+        _workspace_dev = workspace.data
+        n_batch = _workspace_dev.shape[2]
+
+        # Complex arrays are passed to the kernels as arrays of reals
+        _workspace_dbl = _workspace_dev.T.view(self.dtype)
+        _gint_rep_transf_dbl = self._gint_rep_transf_dev.T.view(self.dtype)
+        kernels = context.kernels
+        sfx = self._kernel_suffix
+
+        # Copy occupied slices to the workspace (padding is zeroed)
+        kernels['fftsolver2p5d_gather_slices' + sfx](
+                nx=nx, ny=ny, n_batch=n_batch, n_occupied=n_occupied,
+                nelem=4*nx*ny*n_batch,
+                batch_to_slice=self._batch_to_slice_dev,
+                rho=rho, workspace=_workspace_dbl)
+
+        workspace.fftplan.transform(_workspace_dev) # rho_rep_hat
+
+        kernels['fftsolver2p5d_multiply_green' + sfx](
+                nelem_slice=4*nx*ny, nelem=4*nx*ny*n_occupied,
+                gint_rep_transf=_gint_rep_transf_dbl,
+                workspace=_workspace_dbl) # phi_rep_hat
+
+        workspace.fftplan.itransform(_workspace_dev) #phi_rep
+        workspace.padding_dirty = True
+
+        # Copy result to the occupied slices of phi (other slices are zeroed)
+        kernels['fftsolver2p5d_scatter_slices' + sfx](
+                nx=nx, ny=ny, nz=nz, nelem=nx*ny*nz,
+                slice_to_batch=self._slice_to_batch_dev,
+                workspace=_workspace_dbl, phi=phi)
+
+        return phi
 
 class FFTSolver2p5DAveraged(Solver):
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 dtype=np.float64):
 
         if context is None:
             context = context_default
         self.context = context
-
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        XX_F, YY_F= np.meshgrid(xg_F, yg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_2p5d(XX_F, YY_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
-                                - F_temp[:-1,  1:]
-                                - F_temp[ 1:, :-1]
-                                + F_temp[:-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
-        gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
-        gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
-
-
-        # Prepare fft plan
-        if fftplan is None:
-            temp_dev = context.zeros((2*nx, 2*ny),
-                                    dtype=np.complex128, order='F')
-            fftplan = context.plan_FFT(temp_dev, axes=(0,1))
-            del(temp_dev)
-
-        # Transform the green function
-        gint_rep_transf = np.zeros((2*nx, 2*ny),
-                           dtype=np.complex128, order='F')
-        gint_rep_transf[:, :] = np.fft.fftn(gint_rep, axes=(0,1))
-
-        # Transfer to GPU (if needed)
-        gint_rep_transf_dev = context.nparray_to_context_array(
-                                       np.atleast_2d(gint_rep_transf))
+        self.dtype = np.dtype(dtype)
+        complex_dtype = _get_complex_dtype(dtype)
+
+        # Get workspace and fft plan (shared with other solvers on the same grid)
+        workspace = get_fft_workspace(context=context,
+                                      shape=(2*nx, 2*ny),
+                                      dtype=complex_dtype, axes=(0,1),
+                                      fftplan=fftplan)
+
+        # Transformed integrated Green function
+        gint_rep_transf_dev = green_function_cache.get(
+                context=context, kind='FFTSolver2D',
+                cell_sizes=(dx, dy), shape=(nx, ny),
+                dtype=complex_dtype,
+                builder=lambda: np.fft.fftn(
+                    _integrated_green_function_2p5d(dx, dy, nx, ny),
+                    axes=(0,1)))
 
         self.dx = dx
         self.dy = dy
@@ -267,10 +669,12 @@ class FFTSolver2p5DAveraged(Solver):
         self.nx = nx
         self.ny = ny
         self.nz = nz
+        self._workspace = workspace
         self._gint_rep_transf_dev = gint_rep_transf_dev
-        self.fftplan = fftplan
+        self.fftplan = workspace.fftplan
 
     #@profile
+    @_serialized_on_context
     def solve(self, rho):
 
         '''
@@ -283,8 +687,12 @@ class FFTSolver2p5DAveraged(Solver):
             phi (float64 array): electric potential at the grid points in Volts.
         '''
 
-        _workspace_dev = self.context.zeros(
-                (2*self.nx, 2*self.ny), dtype=np.complex128, order='F')
+        workspace = self._workspace
+        _workspace_dev = workspace.data
+        if workspace.padding_dirty:
+            _workspace_dev[self.nx:, :] = 0
+            _workspace_dev[:self.nx, self.ny:] = 0
+            workspace.padding_dirty = False
 
         sum_rho_xy = rho.sum(axis=0).sum(axis=0)
         sum_rho = sum_rho_xy.sum()
@@ -295,9 +703,10 @@ class FFTSolver2p5DAveraged(Solver):
                         self._gint_rep_transf_dev) # phi_rep_hat
 
         self.fftplan.itransform(_workspace_dev) #phi_rep
+        workspace.padding_dirty = True
         phi_sum = _workspace_dev.real[:self.nx, :self.ny]
 
-        phi = 0 * rho
+        phi = self.context.zeros(rho.shape, dtype=self.dtype, order='F')
         for iz in range(self.nz):
             phi[:, :, iz] = phi_sum * sum_rho_xy[iz] / sum_rho
 
@@ -306,6 +715,557 @@ class FFTSolver2p5DAveraged(Solver):
 
         return phi
 
+class RFFTSolver3D(Solver):
+
+    '''
+    Creates a Poisson solver object that solves the full 3D Poisson
+    equation using the FFT method (free space), exploiting the fact that
+    the charge density and the potential are real (real-to-complex
+    transforms). Only half of the spectrum of the Green function and of the
+    charge density is stored. On CPU the transforms write into preallocated
+    workspaces (shared with other solvers on the same grid), on GPU their
+    outputs are taken from the cupy memory pool.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        dtype (np.dtype): Floating point precision used in the solver,
+            ``np.float64`` (default) or ``np.float32``. In single precision
+            the ffts are performed in complex64 and the potential is
+            returned as a float32 array.
+    Returns:
+        (RFFTSolver3D): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 dtype=np.float64):
+
+        if context is None:
+            context = context_default
+        self.context = context
+        self.dtype = np.dtype(dtype)
+        _get_complex_dtype(dtype) # check dtype
+
+        fft = _get_rfft_module(context)
+
+        # Transformed integrated Green function. The replicated Green function
+        # is even, hence its transform is real.
+        gint_rep_transf_dev = green_function_cache.get(
+                context=context, kind='RFFTSolver3D',
+                cell_sizes=(dx, dy, dz), shape=(nx, ny, nz),
+                dtype=self.dtype,
+                builder=lambda: np.fft.rfftn(
+                    _integrated_green_function_3d(dx, dy, dz, nx, ny, nz),
+                    axes=(0,1,2)).real)
+
+        # Real workspace and half spectrum
+        workspace, spectrum_workspace = _get_rfft_workspaces(
+                context=context, shape=(2*nx, 2*ny, 2*nz), dtype=self.dtype,
+                axes=(0,1,2))
+
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.nx = nx
+        self.ny = ny
+        self.nz = nz
+        self._fft = fft
+        self._workspace = workspace
+        self._spectrum_workspace = spectrum_workspace
+        self._gint_rep_transf_dev = gint_rep_transf_dev
+        self._fft_axes = (0,1,2)
+        self.fftplan = None
+
+    @property
+    def _workspace_dev(self):
+        return self._workspace.data
+
+    #@profile
+    @_serialized_on_context
+    def solve(self, rho):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+        Returns:
+            phi (float64 array): electric potential at the grid points in Volts
+                (an array owned by the caller).
+        '''
+
+        # The workspace is shared with other solvers, the result is copied
+        return self._solve_in_workspace(rho).copy(order='F')
+
+    @_serialized_on_context
+    def solve_into(self, rho, phi):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density
+        and writes the potential into a provided array, directly from the
+        solver workspace.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+            phi (float64 array): Fortran ordered array receiving the electric
+                potential at the grid points in Volts. It can be the same
+                array as ``rho``.
+        '''
+
+        # The transposes make it faster in cupy (C-contigous arrays)
+        phi.T[:, :, :] = self._solve_in_workspace(rho).T
+
+    def _clear_padding(self):
+        workspace = self._workspace
+        if not workspace.padding_dirty:
+            return
+        # The transposes make it faster in cupy (C-contigous arrays)
+        _workspace_dev = workspace.data
+        _workspace_dev.T[:, :, self.nx:] = 0
+        _workspace_dev.T[:, self.ny:, :self.nx] = 0
+        _workspace_dev.T[self.nz:, :self.ny, :self.nx] = 0
+        workspace.padding_dirty = False
+
+    def _solve_in_workspace(self, rho):
+
+        # Returns a view on the workspace (or on a temporary array on GPU),
+        # valid until the next solve of any solver sharing it
+        _workspace_dev = self._workspace_dev
+        self._clear_padding()
+
+        # The transposes make it faster in cupy (C-contigous arrays)
+        _workspace_dev.T[:self.nz, :self.ny, :self.nx] = rho.T
+
+        axes = self._fft_axes
+        shape = [_workspace_dev.shape[ii] for ii in axes]
+        if _fft_supports_out(self._fft):
+            rho_rep_hat = self._spectrum_workspace.data
+            _rfftn_into(self._fft, _workspace_dev, axes=axes,
+                        out=rho_rep_hat)
+            rho_rep_hat *= self._gint_rep_transf_dev # phi_rep_hat
+            _irfftn_into(self._fft, rho_rep_hat, s=shape, axes=axes,
+                         out=_workspace_dev) # phi_rep
+            self._workspace.padding_dirty = True
+            phi_rep = _workspace_dev
+        else:
+            rho_rep_hat = self._fft.rfftn(_workspace_dev, axes=axes)
+            rho_rep_hat *= self._gint_rep_transf_dev # phi_rep_hat
+            phi_rep = self._fft.irfftn(rho_rep_hat, s=shape, axes=axes)
+
+        return phi_rep[:self.nx, :self.ny, :self.nz]
+
+class RFFTSolver2p5D(RFFTSolver3D):
+
+    '''
+    Creates a Poisson solver object that solve's Poisson equation in
+    the 2.5D approximation using the FFT method (free space), exploiting
+    the fact that the charge density and the potential are real
+    (real-to-complex transforms).
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        dtype (np.dtype): Floating point precision used in the solver,
+            ``np.float64`` (default) or ``np.float32``. In single precision
+            the ffts are performed in complex64 and the potential is
+            returned as a float32 array.
+    Returns:
+        (RFFTSolver2p5D): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 dtype=np.float64):
+
+        if context is None:
+            context = context_default
+        self.context = context
+        self.dtype = np.dtype(dtype)
+        _get_complex_dtype(dtype) # check dtype
+
+        fft = _get_rfft_module(context)
+
+        # Transformed integrated Green function. The replicated Green function
+        # is even, hence its transform is real.
+        gint_rep_transf_dev = green_function_cache.get(
+                context=context, kind='RFFTSolver2p5D',
+                cell_sizes=(dx, dy), shape=(nx, ny),
+                dtype=self.dtype,
+                builder=lambda: np.atleast_3d(np.fft.rfftn(
+                    _integrated_green_function_2p5d(dx, dy, nx, ny),
+                    axes=(0,1)).real))
+
+        # Real workspace and half spectrum
+        workspace, spectrum_workspace = _get_rfft_workspaces(
+                context=context, shape=(2*nx, 2*ny, nz), dtype=self.dtype,
+                axes=(0,1))
+
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.nx = nx
+        self.ny = ny
+        self.nz = nz
+        self._fft = fft
+        self._workspace = workspace
+        self._spectrum_workspace = spectrum_workspace
+        self._gint_rep_transf_dev = gint_rep_transf_dev
+        self._fft_axes = (0,1)
+        self.fftplan = None
+
+class DSTSolver2D(Solver):
+
+    '''
+    Creates a Poisson solver object that solves the 2D Poisson equation
+    inside a rectangular perfectly conducting pipe, using discrete sine
+    transforms (DST-I). The pipe walls, where the potential is zero, are
+    located one cell outside the grid. The solution is exact for the
+    five-point discrete Laplacian. No doubled grid is needed.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        dtype (np.dtype): Floating point precision used in the solver,
+            ``np.float64`` (default) or ``np.float32``.
+    Returns:
+        (DSTSolver2D): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, nx, ny, context=None, dtype=np.float64):
+
+        if context is None:
+            context = context_default
+        self.context = context
+        self.dtype = np.dtype(dtype)
+        _get_complex_dtype(dtype) # check dtype
+
+        self._fft = _get_dst_module(context)
+
+        self.dx = dx
+        self.dy = dy
+        self.nx = nx
+        self.ny = ny
+        self._inv_eigenvalues_dev = context.nparray_to_context_array(
+                _inverse_laplacian_eigenvalues_dst(dx, dy, nx, ny).astype(
+                                                        self.dtype, order='F'))
+
+    #@profile
+    def solve(self, rho):
+
+        '''
+        Solves Poisson's equation in the conducting pipe for a given charge
+        density.
+
+        Args:
+            rho (float array): charge density at the grid points in
+                Coulomb/m^3. Additional trailing dimensions are solved as
+                independent 2D problems.
+        Returns:
+            phi (float array): electric potential at the grid points in Volts.
+        '''
+
+        inv_eigenvalues = self._inv_eigenvalues_dev
+        if rho.ndim > 2:
+            inv_eigenvalues = inv_eigenvalues.reshape(
+                    inv_eigenvalues.shape + (1,) * (rho.ndim - 2))
+
+        rho_hat = self._fft.dstn(rho.astype(self.dtype, copy=False),
+                                 type=1, axes=(0,1))
+        rho_hat *= inv_eigenvalues # phi_hat
+        phi = self._fft.idstn(rho_hat, type=1, axes=(0,1), overwrite_x=True)
+
+        return phi
+
+class DSTSolver2p5D(DSTSolver2D):
+
+    '''
+    Creates a Poisson solver object that solve's Poisson equation in
+    the 2.5D approximation inside a rectangular perfectly conducting pipe,
+    using discrete sine transforms (DST-I). All longitudinal slices are
+    solved in a single batched transform. The pipe walls, where the
+    potential is zero, are located one cell outside the grid.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        dtype (np.dtype): Floating point precision used in the solver,
+            ``np.float64`` (default) or ``np.float32``.
+    Returns:
+        (DSTSolver2p5D): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 dtype=np.float64):
+
+        super().__init__(dx=dx, dy=dy, nx=nx, ny=ny, context=context,
+                         dtype=dtype)
+
+        self.dz = dz
+        self.nz = nz
+        self.fftplan = None
+
+_solver_kernels = {
+    'fftsolver2p5d_slice_charge': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=True,  name='rho', const=True),
+            xo.Arg(xo.Float64, pointer=True,  name='slice_charge'),
+            ],
+        n_threads='nz'
+        ),
+    'fftsolver2p5d_gather_slices': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_batch'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_occupied'),
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Int64,   pointer=True,  name='batch_to_slice', const=True),
+            xo.Arg(xo.Float64, pointer=True,  name='rho', const=True),
+            xo.Arg(xo.Float64, pointer=True,  name='workspace'),
+            ],
+        n_threads='nelem'
+        ),
+    'fftsolver2p5d_multiply_green': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nelem_slice'),
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Float64, pointer=True,  name='gint_rep_transf', const=True),
+            xo.Arg(xo.Float64, pointer=True,  name='workspace'),
+            ],
+        n_threads='nelem'
+        ),
+    'fftsolver2p5d_scatter_slices': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Int64,   pointer=True,  name='slice_to_batch', const=True),
+            xo.Arg(xo.Float64, pointer=True,  name='workspace', const=True),
+            xo.Arg(xo.Float64, pointer=True,  name='phi'),
+            ],
+        n_threads='nelem'
+        ),
+    'fftsolver2p5d_gather_slices_f32': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_batch'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_occupied'),
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Int64,   pointer=True,  name='batch_to_slice', const=True),
+            xo.Arg(xo.Float64, pointer=True,  name='rho', const=True),
+            xo.Arg(xo.Float32, pointer=True,  name='workspace'),
+            ],
+        n_threads='nelem'
+        ),
+    'fftsolver2p5d_multiply_green_f32': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nelem_slice'),
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Float32, pointer=True,  name='gint_rep_transf', const=True),
+            xo.Arg(xo.Float32, pointer=True,  name='workspace'),
+            ],
+        n_threads='nelem'
+        ),
+    'fftsolver2p5d_scatter_slices_f32': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Int64,   pointer=True,  name='slice_to_batch', const=True),
+            xo.Arg(xo.Float32, pointer=True,  name='workspace', const=True),
+            xo.Arg(xo.Float32, pointer=True,  name='phi'),
+            ],
+        n_threads='nelem'
+        ),
+    }
+
+def _compile_solver_kernels(context):
+    if all(nn in context.kernels.keys() for nn in _solver_kernels):
+        return
+    context.add_kernels(
+        sources=[_pkg_root.joinpath('solvers/solvers_src/fftsolvers.h')],
+        kernels=_solver_kernels)
+
+def _get_complex_dtype(dtype):
+    if np.dtype(dtype) == np.float64:
+        return np.complex128
+    elif np.dtype(dtype) == np.float32:
+        return np.complex64
+    else:
+        raise ValueError(f'dtype {dtype} not supported, '
+                         'use np.float64 or np.float32')
+
+def _get_rfft_module(context):
+    if isinstance(context, ContextPyopencl):
+        raise NotImplementedError(
+            'Real-to-complex FFT solvers are not available on PyOpenCL, '
+            'use FFTSolver3D or FFTSolver2p5D instead')
+    return context.nplike_lib.fft
+
+def _get_rfft_workspaces(context, shape, dtype, axes):
+    # Real workspace and workspace for the half spectrum (along the last
+    # transformed axis) of the real-to-complex transforms
+    workspace = get_fft_workspace(context=context, shape=shape,
+                                  dtype=dtype, axes=axes)
+    spectrum_shape = list(shape)
+    spectrum_shape[axes[-1]] = shape[axes[-1]] // 2 + 1
+    spectrum_workspace = get_fft_workspace(
+            context=context, shape=tuple(spectrum_shape),
+            dtype=_get_complex_dtype(dtype), axes=axes, with_plan=False)
+    return workspace, spectrum_workspace
+
+def _fft_supports_out(fft):
+    # The numpy ffts accept an output array from numpy 2.0
+    return fft is np.fft and 'out' in inspect.signature(np.fft.fft).parameters
+
+def _rfftn_into(fft, a, axes, out):
+    # Same as fft.rfftn, one axis at the time, without temporaries
+    fft.rfft(a, axis=axes[-1], out=out)
+    for ax in axes[-2::-1]:
+        fft.fft(out, axis=ax, out=out)
+
+def _irfftn_into(fft, a, s, axes, out):
+    # Same as fft.irfftn, one axis at the time, overwriting the input
+    for ax in axes[:-1]:
+        fft.ifft(a, axis=ax, out=a)
+    fft.irfft(a, n=s[-1], axis=axes[-1], out=out)
+
+# Number of grid points for which the primitive function is evaluated at once
+# when building the Green function (limits the size of the temporaries)
+_green_function_chunk_size = 2**20
+
+def _get_dst_module(context):
+    if isinstance(context, ContextPyopencl):
+        raise NotImplementedError(
+            'DST solvers are not available on PyOpenCL')
+    if context.nplike_lib is np:
+        import scipy.fft
+        return scipy.fft
+    else:
+        import cupyx.scipy.fft
+        return cupyx.scipy.fft
+
+def _inverse_laplacian_eigenvalues_dst(dx, dy, nx, ny):
+
+    '''
+    Inverse of the eigenvalues of the five-point discrete Laplacian (times
+    -epsilon_0) with zero boundary conditions one cell outside the grid, in
+    the DST-I basis.
+    '''
+
+    lambda_x = (4 / dx**2) * np.sin(pi * np.arange(1, nx+1) / (2*(nx+1)))**2
+    lambda_y = (4 / dy**2) * np.sin(pi * np.arange(1, ny+1) / (2*(ny+1)))**2
+
+    return 1 / (epsilon_0 * (lambda_x[:, None] + lambda_y[None, :]))
+
+def _integrated_green_function_3d(dx, dy, dz, nx, ny, nz):
+
+    '''
+    Integrated Green function on the doubled grid (2*nx, 2*ny, 2*nz), with the
+    replicas needed by the Hockney method. The primitive function is evaluated
+    by chunks of longitudinal planes and the replicas are filled in place, so
+    that no temporary of the size of the grid is needed.
+    '''
+
+    # Grid for primitive function
+    xg_F = np.arange(0, nx+2) * dx - dx/2
+    yg_F = np.arange(0, ny+2) * dy - dy/2
+    zg_F = np.arange(0, nz+2) * dz - dz/2
+
+    gint_rep= np.zeros((2*nx, 2*ny, 2*nz), dtype=np.float64, order='F')
+
+    n_planes = max(1, _green_function_chunk_size // ((nx+2) * (ny+2)) - 1)
+    for iz_start in range(0, nz+1, n_planes):
+        iz_end = min(iz_start + n_planes, nz+1)
+
+        # Compute primitive (consecutive chunks share one plane)
+        F_temp = primitive_func_3d(xg_F[:, None, None], yg_F[None, :, None],
+                                   zg_F[None, None, iz_start:iz_end+1])
+
+        # Integrated Green Function
+        gint_rep[:nx+1, :ny+1, iz_start:iz_end] = (F_temp[ 1:,  1:,  1:]
+                                                 - F_temp[:-1,  1:,  1:]
+                                                 - F_temp[ 1:, :-1,  1:]
+                                                 + F_temp[:-1, :-1,  1:]
+                                                 - F_temp[ 1:,  1:, :-1]
+                                                 + F_temp[:-1,  1:, :-1]
+                                                 + F_temp[ 1:, :-1, :-1]
+                                                 - F_temp[:-1, :-1, :-1])
+        del F_temp
+
+        # Transverse replicas of the planes in the chunk
+        gint_chunk = gint_rep[:, :, iz_start:iz_end]
+        _replicate_transverse(gint_chunk, nx, ny)
+
+    # Longitudinal replica (source and destination do not overlap in memory)
+    gint_rep[:, :, nz+1:] = gint_rep[:, :, nz-1:0:-1]
+
+    return gint_rep
+
+def _replicate_transverse(gint_rep, nx, ny):
+
+    # To define how to make the replicas I have a look at:
+    # np.abs(np.fft.fftfreq(10))*10
+    # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
+    gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
+    gint_rep[:, ny+1:] = gint_rep[:, ny-1:0:-1]
+
+def _integrated_green_function_2p5d(dx, dy, nx, ny):
+
+    '''
+    Integrated Green function on the doubled grid (2*nx, 2*ny), with the
+    replicas needed by the Hockney method.
+    '''
+
+    # Grid for primitive function
+    xg_F = np.arange(0, nx+2) * dx - dx/2
+    yg_F = np.arange(0, ny+2) * dy - dy/2
+
+    # Compute primitive
+    F_temp = primitive_func_2p5d(xg_F[:, None], yg_F[None, :])
+
+    # Integrated Green Function
+    gint_rep= np.zeros((2*nx, 2*ny), dtype=np.float64, order='F')
+    gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
+                            - F_temp[:-1,  1:]
+                            - F_temp[ 1:, :-1]
+                            + F_temp[:-1, :-1])
+    del F_temp
+
+    # Replicate
+    _replicate_transverse(gint_rep, nx, ny)
+
+    return gint_rep
+
 def primitive_func_3d(x,y,z):
     abs_r = np.sqrt(x * x + y * y + z * z)
     inv_abs_r = 1./abs_r
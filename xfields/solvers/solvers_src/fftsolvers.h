@@ -0,0 +1,170 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_FFTSOLVERS_H
+#define XFIELDS_FFTSOLVERS_H
+
+// Complex arrays are passed as interleaved (re, im) double arrays.
+// All arrays are in Fortran order.
+
+/*gpukern*/
+void fftsolver2p5d_slice_charge(
+                 const int     nx,
+                 const int     ny,
+                 const int     nz,
+    /*gpuglmem*/ const double* rho,
+    /*gpuglmem*/       double* slice_charge){
+
+    for (int iz=0; iz<nz; iz++){ //vectorize_over iz nz
+        double sum = 0;
+        for (int ii=0; ii<nx*ny; ii++){
+            sum += fabs(rho[ii + nx*ny*iz]);
+        }
+        slice_charge[iz] = sum;
+    }//end_vectorize
+}
+
+/*gpukern*/
+void fftsolver2p5d_gather_slices(
+                 const int      nx,
+                 const int      ny,
+                 const int      n_batch,
+                 const int      n_occupied,
+                 const int      nelem,
+    /*gpuglmem*/ const int64_t* batch_to_slice,
+    /*gpuglmem*/ const double*  rho,
+    /*gpuglmem*/       double*  workspace){
+
+    // Copies the occupied slices of rho into the first slices of the
+    // workspace (real part) and zeroes all the rest (padding).
+    // nelem = 4*nx*ny*n_batch
+    for (int ii=0; ii<nelem; ii++){ //vectorize_over ii nelem
+        const int ix = ii % (2*nx);
+        const int iy = (ii / (2*nx)) % (2*ny);
+        const int ib = ii / (4*nx*ny);
+        double val = 0;
+        if (ix < nx && iy < ny && ib < n_occupied){
+            val = rho[ix + nx*iy + nx*ny*batch_to_slice[ib]];
+        }
+        workspace[2*ii] = val;
+        workspace[2*ii + 1] = 0;
+    }//end_vectorize
+}
+
+/*gpukern*/
+void fftsolver2p5d_multiply_green(
+                 const int     nelem_slice,
+                 const int     nelem,
+    /*gpuglmem*/ const double* gint_rep_transf,
+    /*gpuglmem*/       double* workspace){
+
+    // Multiplies each slice of the workspace by the (complex) transformed
+    // Green function, which is the same for all slices
+    for (int ii=0; ii<nelem; ii++){ //vectorize_over ii nelem
+        const int ig = ii % nelem_slice;
+        const double g_re = gint_rep_transf[2*ig];
+        const double g_im = gint_rep_transf[2*ig + 1];
+        const double w_re = workspace[2*ii];
+        const double w_im = workspace[2*ii + 1];
+        workspace[2*ii] = w_re * g_re - w_im * g_im;
+        workspace[2*ii + 1] = w_re * g_im + w_im * g_re;
+    }//end_vectorize
+}
+
+/*gpukern*/
+void fftsolver2p5d_scatter_slices(
+                 const int      nx,
+                 const int      ny,
+                 const int      nz,
+                 const int      nelem,
+    /*gpuglmem*/ const int64_t* slice_to_batch,
+    /*gpuglmem*/ const double*  workspace,
+    /*gpuglmem*/       double*  phi){
+
+    // Copies the real part of the workspace into the occupied slices of phi
+    // and zeroes the slices that have been skipped.
+    // nelem = nx*ny*nz
+    for (int ii=0; ii<nelem; ii++){ //vectorize_over ii nelem
+        const int ix = ii % nx;
+        const int iy = (ii / nx) % ny;
+        const int ib = slice_to_batch[ii / (nx*ny)];
+        double val = 0;
+        if (ib >= 0){
+            val = workspace[2*(ix + 2*nx*iy + 4*nx*ny*ib)];
+        }
+        phi[ii] = val;
+    }//end_vectorize
+}
+
+// Single precision versions (complex64 workspace). The charge density is
+// read in double precision.
+
+/*gpukern*/
+void fftsolver2p5d_gather_slices_f32(
+                 const int      nx,
+                 const int      ny,
+                 const int      n_batch,
+                 const int      n_occupied,
+                 const int      nelem,
+    /*gpuglmem*/ const int64_t* batch_to_slice,
+    /*gpuglmem*/ const double*  rho,
+    /*gpuglmem*/       float*   workspace){
+
+    // nelem = 4*nx*ny*n_batch
+    for (int ii=0; ii<nelem; ii++){ //vectorize_over ii nelem
+        const int ix = ii % (2*nx);
+        const int iy = (ii / (2*nx)) % (2*ny);
+        const int ib = ii / (4*nx*ny);
+        float val = 0;
+        if (ix < nx && iy < ny && ib < n_occupied){
+            val = (float) rho[ix + nx*iy + nx*ny*batch_to_slice[ib]];
+        }
+        workspace[2*ii] = val;
+        workspace[2*ii + 1] = 0;
+    }//end_vectorize
+}
+
+/*gpukern*/
+void fftsolver2p5d_multiply_green_f32(
+                 const int    nelem_slice,
+                 const int    nelem,
+    /*gpuglmem*/ const float* gint_rep_transf,
+    /*gpuglmem*/       float* workspace){
+
+    for (int ii=0; ii<nelem; ii++){ //vectorize_over ii nelem
+        const int ig = ii % nelem_slice;
+        const float g_re = gint_rep_transf[2*ig];
+        const float g_im = gint_rep_transf[2*ig + 1];
+        const float w_re = workspace[2*ii];
+        const float w_im = workspace[2*ii + 1];
+        workspace[2*ii] = w_re * g_re - w_im * g_im;
+        workspace[2*ii + 1] = w_re * g_im + w_im * g_re;
+    }//end_vectorize
+}
+
+/*gpukern*/
+void fftsolver2p5d_scatter_slices_f32(
+                 const int      nx,
+                 const int      ny,
+                 const int      nz,
+                 const int      nelem,
+    /*gpuglmem*/ const int64_t* slice_to_batch,
+    /*gpuglmem*/ const float*   workspace,
+    /*gpuglmem*/       float*   phi){
+
+    // nelem = nx*ny*nz
+    for (int ii=0; ii<nelem; ii++){ //vectorize_over ii nelem
+        const int ix = ii % nx;
+        const int iy = (ii / nx) % ny;
+        const int ib = slice_to_batch[ii / (nx*ny)];
+        float val = 0;
+        if (ib >= 0){
+            val = workspace[2*(ix + 2*nx*iy + 4*nx*ny*ib)];
+        }
+        phi[ii] = val;
+    }//end_vectorize
+}
+
+#endif